@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import time
+import uuid
+from pathlib import Path
+import numpy as np
+
+import src.parameters
+from src.logger import setup_logger, summarize_warnings, log_complete
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+
+STORE_VERSION = 2
+INDEX_FN = "crypt_data.json"
+# Fixed points and offsets filenames of version 1 stores
+POINTS_FN = "crypt_data_points.npy"
+OFFSETS_FN = "crypt_data_offsets.npy"
+
+
+def store_fps(index_fp, index):
+    """Returns the index, points and offsets filepaths of the contour store with
+    the given index, read from the index file at index_fp.
+    """
+    index_fp = Path(index_fp)
+    return (
+        index_fp,
+        index_fp.with_name(index.get("points", POINTS_FN)),
+        index_fp.with_name(index.get("offsets", OFFSETS_FN)),
+    )
+
+
+def save_contour_store(all_crypt_data, index_fp, keys=None):
+    """Saves all_crypt_data (dict of crypt data by filename, see get_crypt_data)
+    as a columnar contour store: the points of all contours concatenated in one
+    (P, 2) int16 (or int32 if needed) array, the (C + 1,) offsets of each
+    contour in the points, and a small .json index of each filename's contour
+    range, shape, sizes and count key (if given in keys). The simplified
+    contours of each level of detail are stored in the same points and offsets,
+    with their contour ranges by tolerance in the index. Errors are stored in
+    the index as strings. The points and offsets are written under new names
+    recorded in the index, and the index is replaced last, so that readers
+    always see a complete store, either the previous one or this one.
+    """
+    index_fp = Path(index_fp)
+    keys = keys or {}
+    generation = uuid.uuid4().hex
+    index = {
+        "version": STORE_VERSION,
+        "points": f"{index_fp.stem}_points.{generation}.npy",
+        "offsets": f"{index_fp.stem}_offsets.{generation}.npy",
+        "slices": {},
+    }
+    contours = []
+    for fn, crypt_data in all_crypt_data.items():
+        if type(crypt_data) == str:
+            entry = {"error": crypt_data}
+        else:
+            entry = {
+                "contours": [len(contours), len(contours) + len(crypt_data["contours"])],
+                "shape": [int(x) for x in crypt_data["shape"]],
+                "size_total": int(crypt_data["size_total"]),
+                "size_av": int(crypt_data["size_av"]),
+                "size_std": int(crypt_data["size_std"]),
+            }
+            contours.extend(crypt_data["contours"])
+            entry["lod_contours"] = {}
+            for tolerance, lod_contours in crypt_data.get("lod_contours", {}).items():
+                entry["lod_contours"][str(tolerance)] = [
+                    len(contours),
+                    len(contours) + len(lod_contours),
+                ]
+                contours.extend(lod_contours)
+        if fn in keys:
+            entry["key"] = keys[fn]
+        index["slices"][fn] = entry
+    lengths = [len(c) for c in contours]
+    offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    if contours:
+        points = np.concatenate([c.reshape(-1, 2) for c in contours])
+    else:
+        points = np.zeros((0, 2), dtype=np.int32)
+    if points.size == 0 or (points.min() >= 0 and points.max() <= np.iinfo(np.int16).max):
+        points = points.astype(np.int16)
+    # The new points and offsets are not read until the index refers to them
+    _, points_fp, offsets_fp = store_fps(index_fp, index)
+    for fp, arr in [(points_fp, points), (offsets_fp, offsets)]:
+        with open(fp, "wb") as file:
+            np.save(file, arr)
+    tmp_fp = index_fp.with_name(f"{index_fp.name}.{generation}.tmp")
+    with open(tmp_fp, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp_fp, index_fp)
+    # Delete the superseded points and offsets, including version 1 ones
+    superseded = [
+        fp
+        for pattern in [f"{index_fp.stem}_points*.npy", f"{index_fp.stem}_offsets*.npy"]
+        for fp in index_fp.parent.glob(pattern)
+        if fp not in (points_fp, offsets_fp)
+    ]
+    for fp in superseded:
+        try:
+            fp.unlink()
+        except OSError:
+            pass  # Still open by a reader (on Windows), deleted by a later save
+
+
+class ContourStore:
+
+    def __init__(self, index_fp):
+        """Read access to the contour store with the index file at index_fp (see
+        save_contour_store). Only the index is read up front. The points and
+        offsets are memory-mapped, so that loading one filename's crypt data
+        only reads its own contours, and so that they stay readable if the
+        store is saved again in the meantime.
+        """
+        with open(index_fp) as file:
+            index = json.load(file)
+        if index.get("version") not in (1, STORE_VERSION):
+            raise ValueError(f"Unsupported contour store version in {index_fp}.")
+        self.index_fp, self.points_fp, self.offsets_fp = store_fps(index_fp, index)
+        self.slices = index["slices"]
+        self.points = np.load(self.points_fp, mmap_mode="r")
+        self.offsets = np.load(self.offsets_fp, mmap_mode="r")
+
+    def __contains__(self, fn):
+        return fn in self.slices
+
+    def __iter__(self):
+        return iter(self.slices)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def __getitem__(self, fn):
+        """Returns the crypt data of filename fn, as returned by get_crypt_data,
+        or the error string if counting it failed.
+        """
+        entry = self.slices[fn]
+        if "error" in entry:
+            return entry["error"]
+        # All contours of a filename, including simplified ones, are contiguous
+        ranges = [entry["contours"], *entry.get("lod_contours", {}).values()]
+        start, stop = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        offsets = self.offsets[start : stop + 1]
+        points = self.points[offsets[0] : offsets[-1]]
+        points = np.array(points, dtype=np.int32).reshape(-1, 1, 2)
+        return self.crypt_data(entry, points, offsets - offsets[0], start)
+
+    def items(self):
+        """Yields the filename and crypt data of all filenames, reading the
+        points and offsets just once.
+        """
+        offsets = np.array(self.offsets)
+        points = np.array(self.points, dtype=np.int32).reshape(-1, 1, 2)
+        for fn, entry in self.slices.items():
+            if "error" in entry:
+                yield fn, entry["error"]
+                continue
+            yield fn, self.crypt_data(entry, points, offsets)
+
+    def key(self, fn):
+        """Returns the count key of filename fn, or None if it has none."""
+        return self.slices.get(fn, {}).get("key")
+
+    @staticmethod
+    def crypt_data(entry, points, offsets, first=0):
+        """Returns the crypt data of an index entry, given the points and offsets
+        of the contours from contour index first onwards.
+        """
+
+        def contours(contour_range):
+            start, stop = (i - first for i in contour_range)
+            return [points[offsets[i] : offsets[i + 1]] for i in range(start, stop)]
+
+        return {
+            "shape": tuple(entry["shape"]),
+            "contours": contours(entry["contours"]),
+            "size_total": entry["size_total"],
+            "size_av": entry["size_av"],
+            "size_std": entry["size_std"],
+            "lod_contours": {
+                float(tolerance): contours(contour_range)
+                for tolerance, contour_range in entry.get("lod_contours", {}).items()
+            },
+        }
+
+
+def load_all_crypt_data(crypt_data_fp):
+    """Returns the dict of crypt data by filename in the contour store index
+    (.json) or legacy pickle (.pkl) at crypt_data_fp.
+    """
+    crypt_data_fp = Path(crypt_data_fp)
+    if crypt_data_fp.suffix == ".pkl":
+        with open(crypt_data_fp, "rb") as file:
+            return pickle.load(file)
+    return dict(ContourStore(crypt_data_fp).items())
+
+
+def convert_pkl_to_store(crypt_data_fp):
+    """Converts the legacy crypt_data.pkl at crypt_data_fp into a contour store
+    in the same folder, adding the simplified display contours. Returns the
+    filepath of its index.
+    """
+    from src.count.crypt_count import simplify_contours
+
+    crypt_data_fp = Path(crypt_data_fp)
+    index_fp = crypt_data_fp.with_name(INDEX_FN)
+    logger.info(f"Converting {crypt_data_fp} to contour store {index_fp}.")
+    with open(crypt_data_fp, "rb") as file:
+        all_crypt_data = pickle.load(file)
+    for crypt_data in all_crypt_data.values():
+        if type(crypt_data) != str and "lod_contours" not in crypt_data:
+            crypt_data["lod_contours"] = simplify_contours(crypt_data["contours"])
+    save_contour_store(all_crypt_data, index_fp)
+    return index_fp
+
+
+def benchmark_store_loading(crypt_data_fp, n=20):
+    """Logs the time and size of loading single filenames' crypt data from the
+    legacy crypt_data.pkl at crypt_data_fp (one unpickling each, as the Crypt
+    GUI did) and from the contour store converted from it.
+    """
+    crypt_data_fp = Path(crypt_data_fp)
+    index_fp = convert_pkl_to_store(crypt_data_fp)
+    with open(crypt_data_fp, "rb") as file:
+        all_crypt_data = pickle.load(file)
+    fns = list(all_crypt_data)[:: max(1, len(all_crypt_data) // n)][:n]
+    # Check that the store holds the same contours
+    store = ContourStore(index_fp)
+    for fn in fns:
+        expected, loaded = all_crypt_data[fn], store[fn]
+        if type(expected) == str:
+            assert loaded == expected, fn
+            continue
+        assert len(loaded["contours"]) == len(expected["contours"]), fn
+        assert all(np.array_equal(a, b) for a, b in zip(loaded["contours"], expected["contours"]))
+    times = {}
+    start_time = time.time()
+    for fn in fns:
+        with open(crypt_data_fp, "rb") as file:
+            pickle.load(file)[fn]
+    times["pkl"] = (time.time() - start_time) / len(fns)
+    start_time = time.time()
+    for fn in fns:
+        ContourStore(index_fp)[fn]
+    times["store"] = (time.time() - start_time) / len(fns)
+    pkl_mb = crypt_data_fp.stat().st_size / 2**20
+    fps = [store.index_fp, store.points_fp, store.offsets_fp]
+    store_mb = sum(fp.stat().st_size for fp in fps) / 2**20
+    logger.info(
+        f"Loading one of {len(all_crypt_data)} slices: {times['pkl'] * 1000:.1f} ms from {pkl_mb:.1f} MB .pkl, "
+        + f"{times['store'] * 1000:.1f} ms from {store_mb:.1f} MB contour store ({times['pkl'] / times['store']:.0f}x faster)."
+    )
+    return times
+
+
+def main():
+    """Converts legacy crypt_data.pkl files into contour stores, or benchmarks
+    loading from them.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("command", choices=["convert", "benchmark"])
+    parser.add_argument("crypt_data_fps", nargs="+", type=Path, help="crypt_data.pkl files.")
+    args = parser.parse_args()
+    setup_logger(LOG_FP)
+    for crypt_data_fp in args.crypt_data_fps:
+        if args.command == "convert":
+            convert_pkl_to_store(crypt_data_fp)
+        elif args.command == "benchmark":
+            benchmark_store_loading(crypt_data_fp)
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import cv2
 from matplotlib import pyplot as plt
 from pathlib import Path
 import logging
+import time
 
 import src.parameters
 from src.image_segmentation.utils import plot_labelmap
@@ -11,10 +12,10 @@ from src.image_segmentation.line_utils import (
     dist,
     slope,
     line_eqn,
-    point_line_dist,
     inter_slope_angle,
     angle_between_vectors,
-    line_segments_intersect,
+    angles_between_vectors,
+    line_segment_intersects_segments,
 )
 
 logger = logging.getLogger(__name__)
@@ -22,12 +23,127 @@ logger = logging.getLogger(__name__)
 
 MIN_CRYPT_SIZE = src.parameters.MIN_CRYPT_SIZE
 DEFECT_THRESHOLD = src.parameters.DEFECT_THRESHOLD
+CONVEX_SOLIDITY = src.parameters.CONVEX_SOLIDITY
+SPLIT_BUDGET = src.parameters.SPLIT_BUDGET
+
+# Rounding error allowed between score_parralelity and score_parralelity_matrix
+SCORE_TOLERANCE = 1e-9
 
 logger.debug(
     f"Module loaded with MIN_CRYPT_SIZE={MIN_CRYPT_SIZE}, DEFECT_THRESHOLD={DEFECT_THRESHOLD}"
 )
 
 
+class ContourFeatures:
+
+    __slots__ = (
+        "contour",
+        "area",
+        "_bbox",
+        "_hull",
+        "_hull_points",
+        "_hull_area",
+        "_all_defects",
+        "_fit_line",
+        "_min_area_rect",
+    )
+
+    def __init__(self, cv2_contour):
+        """Compact record of the geometric features of a cv2 contour used to
+        separate crypts. The area is computed right away, all other features
+        when first needed and then only once.
+        """
+        self.contour = cv2_contour
+        self.area = cv2.contourArea(cv2_contour)
+        self._bbox = self._hull = self._hull_points = self._hull_area = None
+        self._all_defects = self._fit_line = self._min_area_rect = None
+
+    @property
+    def bbox(self):
+        """Returns the (x, y, width, height) bounding rectangle."""
+        if self._bbox is None:
+            self._bbox = cv2.boundingRect(self.contour)
+        return self._bbox
+
+    @property
+    def hull(self):
+        """Returns the indices of the convex hull points in the contour."""
+        if self._hull is None:
+            self._hull = cv2.convexHull(self.contour, returnPoints=False)
+        return self._hull
+
+    @property
+    def hull_points(self):
+        """Returns the convex hull points."""
+        if self._hull_points is None:
+            self._hull_points = self.contour[self.hull[:, 0]]
+        return self._hull_points
+
+    @property
+    def solidity(self):
+        """Returns the ratio of the contour area to its convex hull area."""
+        if self._hull_area is None:
+            self._hull_area = cv2.contourArea(self.hull_points)
+        return self.area / self._hull_area if self._hull_area else 1.0
+
+    @property
+    def all_defects(self):
+        """Returns all convexity defects (start, end, far, depth) of any depth,
+        or an empty array if there are none. Returns None if they could not be
+        found (usually due to self-intersecting contour).
+        """
+        if self._all_defects is None:
+            try:
+                defects = cv2.convexityDefects(self.contour, self.hull)
+            except Exception as e:
+                x, y = self.contour[0][0]
+                logger.warning(
+                    f"Error finding defects on contour of {len(self.contour)} points at ({x}, {y}): {e}"
+                )
+                # Remember the failure so that it is only tried and logged once
+                defects = False
+            self._all_defects = (
+                defects if defects is not None else np.empty((0, 1, 4), np.int32)
+            )
+        if self._all_defects is False:
+            return
+        return self._all_defects
+
+    @property
+    def defects_found(self):
+        """Returns whether all_defects have been found, so that they can be
+        counted without finding them for contours that did not need them.
+        """
+        return self._all_defects is not None and self._all_defects is not False
+
+    def defects(self, defect_threshold):
+        """Returns the defects deeper than defect_threshold, or None if none."""
+        defects = self.all_defects
+        # Return if there are no defects
+        if defects is None or len(defects) == 0:
+            return
+        # Filter above depth threshold
+        defects = defects[defects[:, :, 3] > 256 * defect_threshold]
+        # Return if there are no defects
+        if len(defects) == 0:
+            return
+        return defects
+
+    @property
+    def fit_line(self):
+        """Returns the cv2.fitLine (vx, vy, x, y) through the contour."""
+        if self._fit_line is None:
+            self._fit_line = cv2.fitLine(self.contour, cv2.DIST_L2, 0, 0.01, 0.01)
+        return self._fit_line
+
+    @property
+    def min_area_rect(self):
+        """Returns the minimum area rectangle bounding the convex hull."""
+        if self._min_area_rect is None:
+            self._min_area_rect = cv2.minAreaRect(self.hull_points)
+        return self._min_area_rect
+
+
 class CryptContour:
 
     def __init__(
@@ -35,11 +151,23 @@ class CryptContour:
         cv2_contour,
         defect_thresh=DEFECT_THRESHOLD,
         min_crypt_size=MIN_CRYPT_SIZE,
+        features=None,
+        split_budget=SPLIT_BUDGET,
     ):
-        """Class to analyze a cv2 contour object of a crypt."""
+        """Class to analyze a cv2 contour object of a crypt. Its geometric
+        features are computed once in a ContourFeatures record (or the given
+        one) and reused when splitting. Contours whose search for the best pair
+        of defects would exceed split_budget (see best_defect_pair) only pair
+        their deepest defects.
+        """
         self.defect_threshold = defect_thresh
+        self.min_crypt_size = min_crypt_size
+        self.split_budget = split_budget
+        # Whether the split of this contour only paired its deepest defects
+        self.over_budget = False
         self.contour = cv2_contour
-        self.large_enough = cv2.contourArea(cv2_contour) >= min_crypt_size
+        self.features = features if features is not None else ContourFeatures(cv2_contour)
+        self.large_enough = self.features.area >= min_crypt_size
 
     def defect_Coords(self, defect):
         """Returns a tuple of the (start, end, far) coords of the defect."""
@@ -72,7 +200,7 @@ class CryptContour:
 
     def linear_Fit(self):
         """Returns the m, b of an y=mx+b fit through interior mass of contour."""
-        vx, vy, x, y = cv2.fitLine(self.contour, cv2.DIST_L2, 0, 0.01, 0.01)
+        vx, vy, x, y = self.features.fit_line
         m = vy / vx
         b = y - m * x
         return m[0], b[0]
@@ -80,7 +208,7 @@ class CryptContour:
     def intercepts_from_line_eqn(self, m, b):
         """Returns the intercepts of the line y=mx+b going through the contour."""
         # Get the bounding box
-        x, y, width, height = cv2.boundingRect(self.contour)
+        x, y, width, height = self.features.bbox
         # Get the coords of the line going through that bounding box
         # Handle vertical lines
         if m >= 999:
@@ -95,74 +223,70 @@ class CryptContour:
     @property
     def hull(self):
         """Returns the convex hull."""
-        if hasattr(self, "_hull"):
-            return self._hull
-        hull = cv2.convexHull(self.contour, returnPoints=False)
-        self._hull = hull
-        return hull
+        return self.features.hull
 
     @property
     def hull_points(self):
         """Returns the convex hull points."""
-        if hasattr(self, "_hull_points"):
-            return self._hull
-        hull_points = cv2.convexHull(self.contour, returnPoints=True)
-        self._hull_points = hull_points
-        return hull_points
+        return self.features.hull_points
 
     @property
     def separated_contours(self):
         """Returns a list of separated contours using defect_threshold, each
-        greater in size than min_crypt_size. Returns empty list if none.
+        greater in size than min_crypt_size. Returns empty list if none. How
+        hard the contour was to split is recorded in split_trace.
         """
         # Return attribute if already has been retrieved.
         if hasattr(self, "_separated_contours"):
             return self._separated_contours
-        # At first, contours just contains self's contours
-        contours = [self.contour]
+        start_time = time.perf_counter()
+        # At first, crypt_contours just contains self, at a recursion depth of 0
+        crypt_contours = [self]
+        depths = [0]
         fully_split_contours = []
         # Loop through and split each contour recursively
-        for contour in contours:
-            split_contours = CryptContour(contour).split()
-            # If it can be split, extend contours with the split contours.
-            if split_contours:
-                contours.extend(split_contours)
+        for crypt_contour, depth in zip(crypt_contours, depths):
+            split_crypt_contours = crypt_contour.split_crypt_contours()
+            # If it can be split, extend crypt_contours with the split contours.
+            if split_crypt_contours:
+                crypt_contours.extend(split_crypt_contours)
+                depths.extend([depth + 1] * len(split_crypt_contours))
             # Otherwise, add this contour to fully_split_contours if large enough.
             else:
-                if CryptContour(contour).large_enough:
-                    fully_split_contours.append(contour)
+                if crypt_contour.large_enough:
+                    fully_split_contours.append(crypt_contour.contour)
         # Set as attribute so it doesn't have to be retrieved again
         self._separated_contours = fully_split_contours
+        # Only count the defects if splitting needed them (not for convex blobs)
+        defects = self.defects if self.features.defects_found else None
+        self.split_trace = {
+            "points": len(self.contour),
+            "defects": 0 if defects is None else len(defects),
+            "depth": max(depths),
+            "splits": len(crypt_contours) // 2,
+            "over_budget": sum(c.over_budget for c in crypt_contours),
+            "time": time.perf_counter() - start_time,
+        }
         return fully_split_contours
 
     @property
     def defects(self):
         """Returns defects above the depth threshold."""
-        # Return attribute if already has been retrieved.
-        if hasattr(self, "_defects"):
-            return self._defects
-        # Get defects -- if it fails (usually due to self-intersecting contour)
-        #  return None
-        try:
-            defects = cv2.convexityDefects(self.contour, self.hull)
-        except Exception as e:
-            print(f"\nError finding defects on contour: {e}\n")
-            return
-        # Return if there are no defects
-        if defects is None:
-            return
-        # Filter above depth threshold
-        defects = defects[defects[:, :, 3] > 256 * self.defect_threshold]
-        # Return if there are no defects
-        if len(defects) == 0:
-            return
-        # Set as attribute so it doesn't have to be retrieved again
-        self._defects = defects
-        return defects
+        return self.features.defects(self.defect_threshold)
 
     def split(self):
         """Returns a list of the current contour split into 2. Returns None
-         if unable to split.
+         if unable to split. See split_crypt_contours.
+        """
+        split_crypt_contours = self.split_crypt_contours()
+        if split_crypt_contours:
+            return [c.contour for c in split_crypt_contours]
+
+    def split_crypt_contours(self):
+        """Returns a list of the CryptContours of the current contour split into
+         2. Returns None if unable to split.
+
+        If CONVEX_SOLIDITY is set, blobs at least that solid are not split.
 
         If there is only 1 defect, separates the contour by the line that
          connects that defect to the convex hull, but only if that line happens
@@ -172,8 +296,12 @@ class CryptContour:
         If there are 2 or more defects, separates along the pair of defects
         that has the most parallel hull-defect and defect-defect lines.
         """
-        # If self is not large enough or there are no defects, return.
-        if not self.large_enough or self.defects is None:
+        # If self is not large enough, clearly convex or there are no defects, return.
+        if not self.large_enough:
+            return
+        if CONVEX_SOLIDITY is not None and self.features.solidity >= CONVEX_SOLIDITY:
+            return
+        if self.defects is None:
             return
 
         # If there is only 1 defect, separate by the hull line
@@ -199,7 +327,7 @@ class CryptContour:
             if inter_slope_angle(m, m_fit) >= 45:
                 # If so, see if the crypt is very oblong
                 # Find the minimum area rectangle that bounds the convex hull
-                rect = cv2.minAreaRect(self.hull_points)
+                rect = self.features.min_area_rect
                 length, width = rect[1][1], rect[1][0]
                 # Do not split if it is indeed oblong
                 if length > 2 * width:
@@ -207,35 +335,8 @@ class CryptContour:
 
         # Separate if there are 3 or more
         elif len(self.defects) >= 3:
-            # Start with no separation coords and a large (bad) best score
-            sep_coords = None
-            best_score = np.inf
-            for defect in self.defects:
-                # Get defect's hull line intersection coords and far coords
-                hull_int = self.hull_Intersection(defect)
-                far = self.defect_Coords(defect)[2]
-                # Loop through every other defect
-                for other_defect in self.defects:
-                    # Except skip if other defect is the same defect
-                    if np.array_equal(defect, other_defect):
-                        continue
-                    # Get other_defect's hull line intersection coords and far coords
-                    other_hull_int = self.hull_Intersection(other_defect)
-                    other_far = self.defect_Coords(other_defect)[2]
-                    # Use parallelity measure to get score
-                    score = score_parralelity(hull_int, far, other_hull_int, other_far)
-                    # Quick check -- if the distance between both defects is
-                    #  less than 3 (pinched connection), they belong together, use them
-                    if dist(far, other_far) < 3:
-                        score = 0
-                    # Last check, if split line would intersect contour, don't use it
-                    elif len(line_contour_intersects(far, other_far, self.contour)) > 2:
-                        score = np.inf
-                    # Replace if it's better than the last
-                    if score < best_score:
-                        best_score = score
-                        sep_coords = (far, other_far)
-            # If after all this no sep_coords were found, no split so return.
+            sep_coords = self.best_defect_pair()
+            # If no sep_coords were found, no split so return.
             if sep_coords is None:
                 return
 
@@ -243,35 +344,102 @@ class CryptContour:
         if not len(sep_coords) == 2:
             return
         # Split the contour at the found separation coords
-        split_contours = split_contour(self.contour, sep_coords)
+        split_crypt_contours = [
+            CryptContour(
+                c, self.defect_threshold, self.min_crypt_size, split_budget=self.split_budget
+            )
+            for c in split_contour(self.contour, sep_coords)
+        ]
         # Only return if both split contours are large enough
-        if all([CryptContour(c).large_enough for c in split_contours]):
-            return split_contours
+        if all([c.large_enough for c in split_crypt_contours]):
+            return split_crypt_contours
         else:
             return
 
+    def best_defect_pair(self):
+        """Returns the far coords of the pair of defects with the most parallel
+        hull-defect and defect-defect lines whose connecting line does not
+        intersect the contour elsewhere, or None if there is no such pair.
+
+        Pairs of defects less than 3 apart (pinched connection) always score 0.
+        The scores of all pairs are first estimated at once, and the contour
+        intersection test is only run on pairs in order of their estimate. The
+        pairs that pass with an estimate within rounding error of the best are
+        then scored exactly, breaking ties by the order of the defects.
+
+        Each intersection test costs up to the number of contour points, so
+        if the pairs of defects times the points exceed split_budget, only
+        the deepest defects within the budget (at least 2) are paired.
+        """
+        defects = self.defects
+        n_points = len(self.contour)
+        if len(defects) * (len(defects) - 1) / 2 * n_points > self.split_budget:
+            self.over_budget = True
+            # The most defects k with k * (k - 1) / 2 pairs within the budget
+            max_defects = max(int(0.5 + np.sqrt(0.25 + 2 * self.split_budget / n_points)), 2)
+            # Keep the deepest, in their order along the contour
+            deepest = np.argsort(-defects[:, 3], kind="stable")[:max_defects]
+            defects = defects[np.sort(deepest)]
+        hull_ints = [self.hull_Intersection(defect) for defect in defects]
+        fars = [self.defect_Coords(defect)[2] for defect in defects]
+        far_arr = np.array(fars)
+        estimates = score_parralelity_matrix(
+            np.array(hull_ints), far_arr.astype(np.float64)
+        )
+        # Pinched connections belong together, use them
+        diffs = far_arr[None, :, :] - far_arr[:, None, :]
+        pinched = np.sum(diffs**2, axis=-1) < 3**2
+        estimates[pinched] = 0
+        # Never pair a defect with itself, nor use pairs without a score
+        np.fill_diagonal(estimates, np.inf)
+        estimates[np.isnan(estimates)] = np.inf
+        best_score, best_index, best_estimate = np.inf, None, None
+        for index in np.argsort(estimates, axis=None, kind="stable"):
+            estimate = estimates.flat[index]
+            if estimate == np.inf:
+                break
+            if best_estimate is not None and estimate > best_estimate + SCORE_TOLERANCE:
+                break
+            i, j = divmod(int(index), len(defects))
+            if pinched[i, j]:
+                score = 0
+            # Last check, if split line would intersect contour, don't use it
+            elif len(line_contour_intersects(fars[i], fars[j], self.contour)) > 2:
+                continue
+            else:
+                score = score_parralelity(hull_ints[i], fars[i], hull_ints[j], fars[j])
+            # Replace if it's better, or as good but first in order
+            if score < best_score or (
+                score == best_score and best_index is not None and index < best_index
+            ):
+                best_score, best_index = score, index
+                if best_estimate is None:
+                    best_estimate = estimate
+        if best_index is None:
+            return None
+        i, j = divmod(int(best_index), len(defects))
+        return fars[i], fars[j]
+
     def plot(self, show_all=False, img_fp=None, pad=10):
         """Plots the contour with or without its defects, separated contours,
         and corresponding image (fp must be given).
         """
-        # Have to work with a copy to avoid the original being modified
-        contour = self.contour.copy()
-        x, y, width, height = cv2.boundingRect(contour)
-        # Translate contour so it starts at (0,0)
-        contour[:, :, 0] -= x
-        contour[:, :, 1] -= y
+        # Draw in bbox-local coordinates, offsetting the contour to start at (0,0)
+        x, y, width, height = self.features.bbox
+        offset = (-x, -y)
         # Make array of contour
         contour_arr = np.zeros(shape=(height, width))
-        contour_arr = cv2.drawContours(contour_arr, [contour], -1, 1, 1)
+        contour_arr = cv2.drawContours(
+            contour_arr, [self.contour], -1, 1, 1, offset=offset
+        )
         # Plot just the contour if desired
         if not show_all:
             plot_labelmap(np.pad(contour_arr, 10), title="Contour")
             return
         # Add the translated hull (val=2) to contour_arr
-        hull = self.hull_points.copy()
-        hull[:, :, 0] -= x
-        hull[:, :, 1] -= y
-        contour_arr = cv2.drawContours(contour_arr, [hull], -1, 2, 1)
+        contour_arr = cv2.drawContours(
+            contour_arr, [self.hull_points], -1, 2, 1, offset=offset
+        )
         # Add the defects (val=3) to contour_arr
         defects = self.defects if self.defects is not None else []
         for defect in defects:
@@ -283,10 +451,9 @@ class CryptContour:
         # Get the separated contours array
         sep_cont_arr = np.zeros(shape=(height, width))
         for i, cont in enumerate(self.separated_contours):
-            cont = cont.copy()
-            cont[:, :, 0] -= x
-            cont[:, :, 1] -= y
-            sep_cont_arr = cv2.drawContours(sep_cont_arr, [cont], -1, i + 1, 1)
+            sep_cont_arr = cv2.drawContours(
+                sep_cont_arr, [cont], -1, i + 1, 1, offset=offset
+            )
         # Plot with or without img
         if img_fp:
             fig, axes = plt.subplots(ncols=3, dpi=200)
@@ -335,6 +502,34 @@ def score_parralelity(hull_int, far, other_hull_int, other_far):
     return score
 
 
+def score_parralelity_matrix(hull_ints, fars):
+    """Given the (d, 2) arrays of the hull intersections and points of d defects,
+    returns the d x d matrix of the score_parralelity of each pair of defects.
+    """
+    hull_vectors = fars - hull_ints  # hull line of each defect
+    dd_vectors = fars[None, :, :] - fars[:, None, :]  # line from each defect to another
+    # Get the angles between the hull-lines, and between each
+    #  hull line and the defect-defect-line.
+    hulls_angle = angles_between_vectors(hull_vectors[:, None], hull_vectors[None, :])
+    hull_dd_angle = angles_between_vectors(hull_vectors[:, None], dd_vectors)
+    other_hull_dd_angle = angles_between_vectors(hull_vectors[None, :], dd_vectors)
+    # Get the deviations of these angles from what they should be
+    #  (180 for the hulls_angle, either 0 or 180 for the other 2)
+    hulls_dev = 180 - np.abs(hulls_angle)
+    hull_dd_dev = np.minimum(180 - np.abs(hull_dd_angle), np.abs(hull_dd_angle))
+    other_hull_dd_dev = np.minimum(
+        180 - np.abs(other_hull_dd_angle), np.abs(other_hull_dd_angle)
+    )
+    # If any of these are clearly too perpendicular, give them infinitely bad
+    #  score (borderline ones are left to score_parralelity)
+    max_dev = 90 + SCORE_TOLERANCE
+    too_perpendicular = (
+        (hulls_dev > max_dev) | (hull_dd_dev > max_dev) | (other_hull_dd_dev > max_dev)
+    )
+    score = hulls_dev + hull_dd_dev + other_hull_dd_dev
+    return np.where(too_perpendicular, np.inf, score)
+
+
 def closest_coord(coord, contour):
     """Given an (x,y) coord and a cv2 contour, returns the closest contour
     point to that coord.
@@ -353,23 +548,30 @@ def line_contour_intersects(p1, p2, contour):
     """Returns all the intersects of the line segment defined by p1 and p2 with contour."""
     # Collect unique (not neighbouring and not extreme line points) intersection points
     contour_coords = contour[:, 0, :]  # transform into simple array of coordinates
+    # Test the line segment against the segments between all consecutive contour points
+    c1s, c2s = contour_coords[:-1], contour_coords[1:]
+    hits = np.flatnonzero(line_segment_intersects_segments(p1, p2, c1s, c2s))
+    if not len(hits):
+        return []
+    # For each hit, get the closest contour point of the two to the line
+    m, b = line_eqn(p1, p2)
+    # Handle vertical line (compare x displacement)
+    if m == np.inf:
+        c1_dists = np.abs(p1[0] - c1s[hits, 0])
+        c2_dists = np.abs(p1[0] - c2s[hits, 0])
+    # Otherwise compare the (signed) point-line distances like point_line_dist
+    else:
+        denominator = (1 + m**2) ** 0.5
+        c1_dists = (b + (m * c1s[hits, 0]) - c1s[hits, 1]) / denominator
+        c2_dists = (b + (m * c2s[hits, 0]) - c2s[hits, 1]) / denominator
+    closest = np.where(c1_dists <= c2_dists, hits, hits + 1)
     intersection_coords = []
-    for i in range(len(contour_coords) - 1):
-        # Get each pair of contour points
-        c1, c2 = contour_coords[i], contour_coords[i + 1]
-        # If the line segment intersects the line segment between these contour points,
-        if line_segments_intersect(p1, p2, c1, c2):
-            # get the closest coordinate to the intersection
-            if point_line_dist(*c1, p1, p2) <= point_line_dist(*c2, p1, p2):
-                coord = c1
-            else:
-                coord = c2
-            # Break if this intersection point is a neighbour of the last
-            if intersection_coords and dist(intersection_coords[-1], coord) <= 2:
-                continue
-            # Otherwise, append coord to intersection_coords
-            else:
-                intersection_coords.append(coord)
+    for i in closest:
+        coord = contour_coords[i]
+        # Skip if this intersection point is a neighbour of the last
+        if intersection_coords and dist(intersection_coords[-1], coord) <= 2:
+            continue
+        intersection_coords.append(coord)
     return intersection_coords
 
 
@@ -390,14 +592,18 @@ def split_contour(contour, separation_coords):
         contour1 = contour[idx2 : idx1 + 1]
         contour2 = np.concatenate((contour[idx1:], contour[: idx2 + 1]))
     # Now that both separate contours have been attained, take the contour
-    #  of the filled contour to ensure no self-intersection.
+    #  of the filled contour to ensure no self-intersection. Rasterize in
+    #  bbox-local coordinates (with a 1 pixel border) so that the array size
+    #  depends on the size of the contour, not its position.
     contours = []
     for contour in [contour1, contour2]:
         x, y, width, height = cv2.boundingRect(contour)
-        arr = np.zeros(shape=(y + height, x + width), dtype=np.uint8)
-        arr = cv2.drawContours(arr, [contour], -1, 1, cv2.FILLED)
+        arr = np.zeros(shape=(height + 2, width + 2), dtype=np.uint8)
+        arr = cv2.drawContours(arr, [contour], -1, 1, cv2.FILLED, offset=(1 - x, 1 - y))
         contours.append(
-            cv2.findContours(arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0][0]
+            cv2.findContours(
+                arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x - 1, y - 1)
+            )[0][0]
         )
     return contours
 
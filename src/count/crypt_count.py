@@ -1,36 +1,86 @@
 from natsort import natsorted
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import json
 import logging
+import os
 import numpy as np
-from PIL import Image
+import pandas as pd
 import cv2
-import pickle
 import time
 
-from src.count.crypt_contour import CryptContour
+import src.parameters
+from src.count.split_engines import SPLIT_ENGINES
+from src.count.mask_rle import read_contours, segmentation_fps
+from src.count.morphometrics import MORPHOMETRICS_FN, crypt_morphometrics, save_morphometrics
+from src.count.contour_store import (
+    ContourStore,
+    INDEX_FN,
+    save_contour_store,
+    load_all_crypt_data,
+)
 from src.count.excel import Excel
 from src.logger import time_since
+from src.utils import file_hash
 
 logger = logging.getLogger(__name__)
 
+COUNT_WORKERS = src.parameters.COUNT_WORKERS
+COUNT_CHUNK_SIZE = src.parameters.COUNT_CHUNK_SIZE
+COUNT_PROGRESS_INTERVAL = src.parameters.COUNT_PROGRESS_INTERVAL
+COUNT_CACHE = src.parameters.COUNT_CACHE
+LOD_TOLERANCES = src.parameters.LOD_TOLERANCES
+SPLIT_ENGINE = src.parameters.SPLIT_ENGINE
+SPLIT_REPORT_SIZE = src.parameters.SPLIT_REPORT_SIZE
 
-def get_crypt_data(seg_fp):
-    """Given the filepath to the segmentation .png file, returns a dict,
-    crypt_data, with the img size and the cv2 contours of all contiguous areas
-    (crypts) larger than MIN_CRYPT_SIZE. Separates them based on convex defects.
-    Returns None instead of crypt data if there are no crypts.
+# Bump whenever a change to the code changes the crypt data of a segmentation,
+# so that segmentations counted before are recounted rather than cached
+COUNT_VERSION = 2
+
+
+def get_crypt_data(seg, split_engine=SPLIT_ENGINE):
+    """Given the segmentation, either the filepath to its segmentation file or
+    the segmentation array itself, returns a dict, crypt_data, of the crypts
+    larger than MIN_CRYPT_SIZE, separated with split_engine (see SPLIT_ENGINES
+    in split_engines.py). Files are read as by read_contours, in strips if they
+    are large. The keys are:
+        - 'shape', the shape of the segmentation,
+        - 'contours', the exact cv2 contours of the crypts, topmost first,
+        - 'size_total', 'size_av' and 'size_std', the total, mean and standard
+          deviation of the areas of the exact contours,
+        - 'lod_contours', the contours simplified for display at each of the
+          LOD_TOLERANCES (see simplify_contours),
+        - 'morphometrics', the morphometrics of each crypt (see
+          crypt_morphometrics),
+        - 'split_traces', the traces of the SPLIT_REPORT_SIZE slowest blobs to
+          split (see log_slowest_contours).
     """
-    # Get segmentation array
-    seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
     # Get contours (no chain approx because we need to have all the points stored to split contours)
-    unseparated_contours, _ = cv2.findContours(
-        seg_arr.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
-    )
+    if isinstance(seg, np.ndarray):
+        seg_arr = seg.astype(np.uint8, copy=False)
+        shape = seg_arr.shape
+        unseparated_contours, _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+    else:
+        # Large segmentation files are decoded in strips
+        shape, unseparated_contours = read_contours(seg)
     # Get all separated contours
+    separated_contours = SPLIT_ENGINES[split_engine]
     contours = []
-    for c in unseparated_contours:
-        crypt_contour = CryptContour(c)
-        contours.extend(crypt_contour.separated_contours)
+    split_traces = []
+    for i, c in enumerate(unseparated_contours):
+        # Trace how hard each blob was to split
+        trace = {"blob": i, "x": int(c[0][0][0]), "y": int(c[0][0][1]), "points": len(c)}
+        start_time = time.perf_counter()
+        blob_contours = separated_contours(c, trace=trace)
+        trace["time"] = time.perf_counter() - start_time
+        trace["crypts"] = len(blob_contours)
+        split_traces.append(trace)
+        contours.extend(blob_contours)
+    split_traces = sorted(split_traces, key=lambda trace: -trace["time"])[:SPLIT_REPORT_SIZE]
     # Now sort the contours by their y-coords so the topmost one is first
     contours = sorted(contours, key=lambda contour: contour[0][0][1])
     # Get the total average and variance size of all the crypts
@@ -43,49 +93,263 @@ def get_crypt_data(seg_fp):
         size_total = size_av = size_std = 0
     # Put together the crypt data
     crypt_data = {
-        "shape": seg_arr.shape,
+        "shape": shape,
         "contours": contours,
         "size_total": size_total,
         "size_av": size_av,
         "size_std": size_std,
+        "lod_contours": simplify_contours(contours),
+        "morphometrics": crypt_morphometrics(contours),
+        "split_traces": split_traces,
     }
     return crypt_data
 
 
-def process_segmentations(seg_dir):
-    """Loads crypt data for all segmentations in seg_dir into crypt_data.pkl"""
+def log_slowest_contours(all_crypt_data, n=SPLIT_REPORT_SIZE):
+    """Logs the n slowest blobs to split of all_crypt_data (dict of crypt data by
+    filename) with the complexity recorded in their split traces: their points,
+    defects, recursion depth and splits, and how many of their contours were
+    over the SPLIT_BUDGET and so only paired their deepest defects. Crypt data
+    loaded from a contour store has no split traces.
+    """
+    traces = [
+        (fn, trace)
+        for fn, crypt_data in all_crypt_data.items()
+        if type(crypt_data) != str
+        for trace in crypt_data.get("split_traces", [])
+    ]
+    if not traces:
+        return
+    traces = sorted(traces, key=lambda fn_trace: -fn_trace[1]["time"])[:n]
+    over_budget = sum(trace.get("over_budget", 0) for _, trace in traces)
+    lines = [
+        f"  {fn} blob {trace['blob']} at ({trace['x']}, {trace['y']}): {trace['time'] * 1000:.1f} ms, "
+        + f"{trace['points']} points, {trace.get('defects', '-')} defects, depth {trace.get('depth', '-')}, "
+        + f"{trace['crypts']} crypts"
+        + (f", {trace['over_budget']} over split budget" if trace.get("over_budget") else "")
+        for fn, trace in traces
+    ]
+    logger.info(
+        f"Slowest {len(traces)} blobs to split ({over_budget} contours over split budget):\n"
+        + "\n".join(lines)
+    )
+
+
+def simplify_contours(contours, tolerances=LOD_TOLERANCES):
+    """Returns a dict of the contours simplified with cv2.approxPolyDP by each
+    tolerance in tolerances (max distance in pixels from the exact contour).
+    """
+    return {
+        tolerance: [cv2.approxPolyDP(c, tolerance, True) for c in contours]
+        for tolerance in tolerances
+    }
+
+
+def load_crypt_data(seg, name):
+    """Returns the crypt data of the segmentation (filepath or array) with the
+    given name. If an error occurs, logs it and returns the error as a string.
+    """
+    try:
+        return get_crypt_data(seg)
+    except Exception as e:
+        # If error occurs, save crypt_data as that error.
+        logger.exception(f"Error loading crypt data for {name}. Skipping and moving on.")
+        return str(e)
+
+
+def load_crypt_data_chunk(seg_fps):
+    """Returns the crypt data of each segmentation filepath in seg_fps."""
+    return [load_crypt_data(seg_fp, seg_fp) for seg_fp in seg_fps]
+
+
+def count_segmentations(
+    seg_fps,
+    workers=COUNT_WORKERS,
+    chunk_size=COUNT_CHUNK_SIZE,
+    on_counted=None,
+):
+    """Returns a dict of the crypt data of each segmentation filepath in seg_fps
+    by filename, in natsorted order. With more than 1 worker (and core), the
+    segmentations are counted in a pool of processes, chunk_size at a time.
+    Errors are stored as strings, as by load_crypt_data. Progress is logged at
+    most every COUNT_PROGRESS_INTERVAL seconds, and on_counted(i, n, seg_fp) is
+    called after each of the n segmentations is counted.
+    """
+    seg_fps = natsorted(Path(fp) for fp in seg_fps)
+    n = len(seg_fps)
     all_crypt_data = {}
+    start_time = last_log_time = time.time()
+
+    def counted(seg_fp, crypt_data):
+        nonlocal last_log_time
+        all_crypt_data[seg_fp.stem] = crypt_data
+        i = len(all_crypt_data)
+        if on_counted is not None:
+            on_counted(i, n, seg_fp)
+        if i < n and time.time() - last_log_time >= COUNT_PROGRESS_INTERVAL:
+            last_log_time = time.time()
+            logger.info(f"Counted {i}/{n} segmentations in {time_since(start_time)}.")
+
+    # More processes than cores only adds start-up time
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1 or n <= 1:
+        for seg_fp in seg_fps:
+            counted(seg_fp, load_crypt_data(seg_fp, seg_fp))
+        return all_crypt_data
+    chunks = [seg_fps[i : i + chunk_size] for i in range(0, n, chunk_size)]
+    # Spawn processes so that they do not inherit the state of this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(min(workers, len(chunks)), mp_context=context) as pool:
+        futures = [pool.submit(load_crypt_data_chunk, chunk) for chunk in chunks]
+        # Collect in submission order so that the output order is deterministic
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunk_crypt_data = future.result()
+            except Exception as e:
+                logger.error(f"Error counting {[fp.name for fp in chunk]}: {e}")
+                chunk_crypt_data = [str(e)] * len(chunk)
+            else:
+                # Errors were logged in the counting process, log them here too
+                for seg_fp, crypt_data in zip(chunk, chunk_crypt_data):
+                    if type(crypt_data) == str:
+                        logger.error(f"Error loading crypt data for {seg_fp}: {crypt_data}")
+            for seg_fp, crypt_data in zip(chunk, chunk_crypt_data):
+                counted(seg_fp, crypt_data)
+    return all_crypt_data
+
+
+def count_key(seg_fp):
+    """Returns the key identifying the crypt data of the segmentation at seg_fp:
+    the hash of its contents, the counting parameters and the COUNT_VERSION of
+    the counting code.
+    """
+    identity = [
+        file_hash(seg_fp),
+        src.parameters.MIN_CRYPT_SIZE,
+        src.parameters.DEFECT_THRESHOLD,
+        src.parameters.CONVEX_SOLIDITY,
+        src.parameters.SPLIT_BUDGET,
+        src.parameters.LOD_TOLERANCES,
+        src.parameters.SPLIT_ENGINE,
+        src.parameters.WATERSHED_PEAK_FRACTION,
+        COUNT_VERSION,
+    ]
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+
+
+def load_cached_store(seg_dir):
+    """Returns the ContourStore of crypt data in seg_dir, or None if it is
+    missing or unreadable.
+    """
+    try:
+        return ContourStore(Path(seg_dir, INDEX_FN))
+    except Exception:
+        return None
+
+
+def save_crypt_data(all_crypt_data, seg_dir, keys=None):
+    """Saves all_crypt_data, sorted by filename, as a contour store (see
+    save_contour_store) with its crypt_data.json index in seg_dir. If given, the
+    count keys of the filenames are saved in the index so that unchanged
+    segmentations need not be recounted. The morphometrics of all crypts are
+    saved alongside as a table (see save_morphometrics).
+    """
+    all_crypt_data = {fn: all_crypt_data[fn] for fn in natsorted(all_crypt_data)}
+    crypt_data_fp = Path(seg_dir, INDEX_FN)
+    logger.info(f"Saving crypt data to contour store: {crypt_data_fp}.")
+    save_contour_store(all_crypt_data, crypt_data_fp, keys)
+    logger.info("Successfuly saved crypt data to contour store.")
+    save_morphometrics(all_crypt_data, Path(seg_dir, MORPHOMETRICS_FN))
+    logger.info(f"Saved crypt morphometrics to {MORPHOMETRICS_FN}.")
+
+
+def process_segmentations(seg_dir, workers=COUNT_WORKERS, cache=COUNT_CACHE):
+    """Loads crypt data for all segmentations in seg_dir into its contour store,
+    counting them in workers processes (see count_segmentations). If cache is
+    set, only the segmentations whose count key changed since the last count
+    are recounted.
+    """
     start_time = time.time()
+    seg_fps = segmentation_fps(seg_dir)
+    keys = {seg_fp.stem: count_key(seg_fp) for seg_fp in seg_fps} if cache else {}
+    store = load_cached_store(seg_dir) if cache else None
+    stale_fps = [
+        seg_fp
+        for seg_fp in seg_fps
+        if store is None or store.key(seg_fp.stem) != keys[seg_fp.stem]
+    ]
+    if cache:
+        logger.info(
+            f"Count cache: {len(seg_fps) - len(stale_fps)}/{len(seg_fps)} hits, {len(stale_fps)} misses."
+        )
     # Go through and process each segmentation
-    logger.info(f"Processing crypt data of segmentations in {seg_dir}.")
-    for seg_fp in natsorted(seg_dir.glob("*.png")):
-        # Save crypt data to all_crypt_data
-        try:
-            crypt_data = get_crypt_data(seg_fp)
-        except Exception as e:
-            # If error occurs, save crypt_data as that error.
-            logger.exception(
-                f"Error loading crypt data for {seg_fp}. Skipping and moving on."
-            )
-            crypt_data = str(e)
-        all_crypt_data[seg_fp.stem] = crypt_data
+    logger.info(
+        f"Processing crypt data of {len(stale_fps)} segmentations in {seg_dir} with {workers} workers."
+    )
+    all_crypt_data = count_segmentations(stale_fps, workers)
+    # Reuse the crypt data of the others from the store
+    if len(all_crypt_data) < len(seg_fps):
+        all_crypt_data.update(
+            (fn, crypt_data)
+            for fn, crypt_data in store.items()
+            if fn in keys and fn not in all_crypt_data
+        )
     logger.info(f"Finished processing segmentations in {time_since(start_time)}.")
-    # Save dictionary as crypt_data.pkl in seg_dir
-    crypt_data_fp = Path(seg_dir, "crypt_data.pkl")
-    logger.info(f"Saving crypt data to .pkl file: {crypt_data_fp}.")
-    with open(crypt_data_fp, "wb") as file:
-        pickle.dump(all_crypt_data, file, protocol=-1)
-    logger.info("Successfuly saved crypt data to .pkl file.")
+    log_slowest_contours(all_crypt_data)
+    # Errors are not cached, so that they are retried next time
+    keys = {fn: key for fn, key in keys.items() if type(all_crypt_data[fn]) != str}
+    # Save dictionary as contour store in seg_dir
+    save_crypt_data(all_crypt_data, seg_dir, keys)
 
 
-def crypt_data_to_excel(crypt_data_fp, excel_dir):
-    """Save pickled crypt data at crypt_data_fp to excel file in excel_dir."""
-    logger.info(f"Saving crypt data to crypt_counts.xlsx Excel file in {excel_dir}.")
-    # Retrieve all_crypt_data
-    with open(crypt_data_fp, "rb") as file:
-        all_crypt_data = pickle.load(file)
-    # Create excel
-    excel = Excel(excel_dir, f"Pre-Load (Automated)")
+def process_predictions(slice_images_dirpath, seg_dir):
+    """Runs AI predictions on the slice images in slice_images_dirpath and loads
+    the crypt data of their segmentations into the contour store in seg_dir. With
+    in-process predictions, each segmentation is counted straight from memory as
+    soon as it is predicted, while its .png file is written and its count key
+    computed in the background. Otherwise, the saved segmentations are processed
+    after all predictions.
+    """
+    from src.predict.predict import run_predictions, NNUNET_PREDICTOR
+
+    if NNUNET_PREDICTOR != "in-process":
+        run_predictions(slice_images_dirpath, seg_dir)
+        process_segmentations(seg_dir)
+        return
+    all_crypt_data, keys = {}, {}
+
+    def count_segmentation(seg_fp, seg_arr):
+        all_crypt_data[seg_fp.stem] = load_crypt_data(seg_arr, seg_fp)
+
+    def key_segmentation(seg_fp):
+        keys[seg_fp.stem] = count_key(seg_fp)
+
+    start_time = time.time()
+    logger.info(f"Processing crypt data of segmentations as they are predicted.")
+    run_predictions(
+        slice_images_dirpath,
+        seg_dir,
+        on_segmentation=count_segmentation,
+        on_saved=key_segmentation,
+    )
+    logger.info(
+        f"Finished predicting and processing segmentations in {time_since(start_time)}."
+    )
+    log_slowest_contours(all_crypt_data)
+    # Errors and unsaved segmentations are not cached, so that they are recounted
+    keys = {
+        fn: key
+        for fn, key in keys.items()
+        if fn in all_crypt_data and type(all_crypt_data[fn]) != str
+    }
+    save_crypt_data(all_crypt_data, seg_dir, keys)
+
+
+def crypt_data_table(all_crypt_data):
+    """Returns a DataFrame of the model count, shape and sizes of each filename
+    of all_crypt_data, one row per filename, as saved to Excel.
+    """
+    rows = []
     for fn in all_crypt_data:
         # Get data and save to Excel
         fn_crypt_data = all_crypt_data[fn]
@@ -106,5 +370,19 @@ def crypt_data_to_excel(crypt_data_fp, excel_dir):
             "Size Average": sa,
             "Size Stdev": ss,
         }
-        excel.append(data)
+        rows.append(data)
+    return pd.DataFrame(
+        rows,
+        columns=["Filename", "Model Count", "Shape", "Size Total", "Size Average", "Size Stdev"],
+    )
+
+
+def crypt_data_to_excel(crypt_data_fp, excel_dir):
+    """Save crypt data at crypt_data_fp (contour store index or legacy .pkl) to
+    excel file in excel_dir, writing the whole sheet at once."""
+    logger.info(f"Saving crypt data to crypt_counts.xlsx Excel file in {excel_dir}.")
+    # Retrieve all_crypt_data
+    all_crypt_data = load_all_crypt_data(crypt_data_fp)
+    # Create excel with the sheet of all filenames
+    Excel(excel_dir, f"Pre-Load (Automated)", crypt_data_table(all_crypt_data))
     logger.info("Successfuly saved crypt data to Excel file.")
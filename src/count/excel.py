@@ -13,10 +13,12 @@ VERSION = src.parameters.VERSION
 
 class Excel:
 
-    def __init__(self, directory, counter):
+    def __init__(self, directory, counter, table=None):
         """Creates Excel file 'crypt_counts.xlsx' at given directory. If this
         excel file already exists, new saved data will be appended to a new
-        sheet in the existing file. Sheet named by counter at creation.
+        sheet in the existing file. Sheet named by counter at creation. If
+        given, the rows of the DataFrame table are written to the sheet in the
+        same open and save (see append_table).
         """
         self.time = str(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
         self.filepath = os.path.join(directory, "crypt_counts.xlsx")
@@ -25,7 +27,7 @@ class Excel:
         # If Excel does not exist, create it
         if not os.path.exists(self.filepath):
             logger.info(f"Creating new Excel file at {self.filepath}.")
-            self.__create_Excel__()
+            self.__create_Excel__(table)
             return
         # Otherwise open it, open a new sheet
         wb = openpyxl.load_workbook(self.filepath)
@@ -35,64 +37,56 @@ class Excel:
         else:
             logger.info("New counter - creating new sheet.")
             wb.create_sheet(self.counter)
-        wb.save(self.filepath)
         # Write new counter info to version sheet.
-        with pd.ExcelWriter(
-            self.filepath, engine="openpyxl", mode="a", if_sheet_exists="overlay"
-        ) as writer:
-            startrow = writer.sheets["version"].max_row
-            data = pd.DataFrame(
-                {"Counter": [self.counter], "Timestamp": [self.time]}, index=[0]
-            )
-            data.to_excel(
-                writer,
-                sheet_name="version",
-                index=False,
-                header=False,
-                startrow=startrow,
-            )
+        wb["version"].append([self.counter, self.time])
+        if table is not None:
+            self.__write_table__(wb[self.counter], table)
+        wb.save(self.filepath)
 
-    def __create_Excel__(self):
-        """Creates an Excel file with the counter sheet and a version sheet."""
-        # Open new workbook (xlsx file)
-        wb = openpyxl.Workbook()
-        # Change name of active sheet to current counter
-        wb.active.title = self.counter
-        # Create new sheet with name 'version'
-        wb.create_sheet("version")
+    def __create_Excel__(self, table=None):
+        """Creates an Excel file with the counter sheet (holding table, if
+        given) and a version sheet. As nothing is read back, the workbook is
+        written in openpyxl write-only mode, row by row.
+        """
+        # Open new workbook (xlsx file), with the current counter sheet first
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(self.counter)
+        if table is not None:
+            self.__write_table__(ws, table)
+        # Write header with version info and counter info to version sheet.
+        version = wb.create_sheet("version")
+        version.append([f"Crypt GUI v{VERSION}"])
+        version.append([" "])
+        version.append(["Counter", "Timestamp"])
+        version.append([self.counter, self.time])
         # Save workbook to the same directory as the calibration film.
         wb.save(self.filepath)
-        # Write header with version info and counter info to version sheet.
-        with pd.ExcelWriter(
-            self.filepath, engine="openpyxl", mode="a", if_sheet_exists="overlay"
-        ) as writer:
-            text = pd.DataFrame({f"Crypt GUI v{VERSION}": [" "]}, index=[0])
-            text.to_excel(writer, sheet_name="version", index=False)
-            data = pd.DataFrame(
-                {"Counter": [self.counter], "Timestamp": [self.time]}, index=[0]
-            )
-            data.to_excel(
-                writer,
-                sheet_name="version",
-                index=False,
-                startrow=writer.sheets["version"].max_row,
-            )
+
+    def __write_table__(self, ws, table):
+        """Appends the rows of the DataFrame table to the worksheet ws, after a
+        header of its columns if the sheet is empty. Missing values are left
+        blank. Nothing is written if the table has no rows.
+        """
+        if len(table) == 0:
+            return
+        if self.empty:
+            ws.append([str(column) for column in table.columns])
+        for row in table.astype(object).itertuples(index=False):
+            ws.append([None if pd.isna(value) else value for value in row])
+        self.empty = False  # From here on out, self.empty=False
+
+    def append_table(self, table):
+        """Appends the rows of the DataFrame table to the counter sheet of the
+        xlsx file in a single open and save. If current excel is empty, creates
+        a header of its columns first.
+        """
+        wb = openpyxl.load_workbook(self.filepath)
+        self.__write_table__(wb[self.counter], table)
+        wb.save(self.filepath)
 
     def append(self, data):
         """Appends given data dictionary to xlsx file. If current excel is
         empty, creates a header first. If excel has a sheet with current
         counter, appends to that sheet.
         """
-        with pd.ExcelWriter(
-            self.filepath, engine="openpyxl", mode="a", if_sheet_exists="overlay"
-        ) as writer:
-            data = pd.DataFrame(data, index=[0])
-            startrow = 0 if self.empty else writer.sheets[self.counter].max_row
-            data.to_excel(
-                writer,
-                header=self.empty,
-                startrow=startrow,
-                index=False,
-                sheet_name=self.counter,
-            )
-        self.empty = False  # From here on out, self.empty=False
+        self.append_table(pd.DataFrame(data, index=[0]))
@@ -0,0 +1,278 @@
+import argparse
+import functools
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from natsort import natsorted
+import numpy as np
+from PIL import Image
+import cv2
+
+import src.parameters
+from src.logger import setup_logger, summarize_warnings, log_complete
+from src.count.strip_extraction import (
+    STRIP_HEIGHT,
+    STRIP_MIN_AREA,
+    band_contours,
+    iter_png_bands,
+    png_contours,
+    png_shape,
+)
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+
+RLE_VERSION = 1
+RLE_SUFFIX = ".rle"
+SEG_SUFFIXES = (RLE_SUFFIX, ".png")
+
+
+def encode_rle_rows(seg_arr):
+    """Returns the number of foreground runs in each row of the 2D segmentation
+    array seg_arr and the (N, 2) [start, stop) columns of all runs in row-major
+    order. Foreground is any nonzero pixel.
+    """
+    height, width = seg_arr.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = seg_arr > 0
+    # Runs start where a row steps up from background and stop where it steps down
+    rows, columns = np.nonzero(np.diff(padded, axis=1))
+    runs = columns.astype(np.int32).reshape(-1, 2)
+    row_counts = np.bincount(rows[::2], minlength=height)
+    return row_counts, runs
+
+
+def save_rle_mask(seg, rle_fp, band_height=STRIP_HEIGHT):
+    """Saves the binary segmentation (a filepath to its .png file or the array
+    itself) as a run-length encoded mask at rle_fp: a compressed .npz of the
+    [start, stop) columns of the foreground runs of all rows, the offsets of
+    each row's runs, and the shape and foreground value. A .png file is encoded band_height rows at a
+    time (see iter_png_bands). Raises ValueError if the segmentation has more
+    than one foreground value, which a binary mask cannot store.
+    """
+    if isinstance(seg, np.ndarray):
+        shape, bands = seg.shape, [(0, seg)]
+    else:
+        shape, bands = png_shape(seg), iter_png_bands(seg, band_height)
+    all_row_counts, all_runs, values = [], [], set()
+    for _, band in bands:
+        values.update(np.unique(band[band > 0]).tolist())
+        if len(values) > 1:
+            raise ValueError(f"Segmentation has foreground values {values}, not binary.")
+        row_counts, runs = encode_rle_rows(band)
+        all_row_counts.append(row_counts)
+        all_runs.append(runs)
+    offsets = np.zeros(shape[0] + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.concatenate(all_row_counts))
+    # Write to a temporary file first so that readers never see a partial file
+    tmp_fp = Path(rle_fp).with_name(Path(rle_fp).name + f".{uuid.uuid4().hex}.tmp")
+    with open(tmp_fp, "wb") as file:
+        np.savez_compressed(
+            file,
+            version=RLE_VERSION,
+            shape=np.array(shape, dtype=np.int64),
+            value=values.pop() if values else 1,
+            offsets=offsets,
+            runs=np.concatenate(all_runs),
+        )
+    os.replace(tmp_fp, rle_fp)
+
+
+class RLEMask:
+
+    def __init__(self, rle_fp):
+        """Read access to the run-length encoded mask at rle_fp (see
+        save_rle_mask). The runs are read whole, as they are much smaller than
+        the mask, and only the rows and columns asked for are decoded.
+        """
+        self.rle_fp = Path(rle_fp)
+        with np.load(self.rle_fp) as rle:
+            if int(rle["version"]) != RLE_VERSION:
+                raise ValueError(f"Unsupported run-length encoded mask version in {self.rle_fp}.")
+            self.shape = tuple(int(x) for x in rle["shape"])
+            self.value = int(rle["value"])
+            self.offsets = rle["offsets"]
+            self.runs = rle["runs"]
+
+    @property
+    def area(self):
+        """Returns the number of pixels of the mask."""
+        return self.shape[0] * self.shape[1]
+
+    def decode(self, y0=0, y1=None, x0=0, x1=None):
+        """Returns the uint8 array of rows y0 to y1 and columns x0 to x1 of the
+        mask (by default all of it), with the foreground value where it has
+        runs and 0 elsewhere.
+        """
+        y1 = self.shape[0] if y1 is None else y1
+        x1 = self.shape[1] if x1 is None else x1
+        runs = self.runs[self.offsets[y0] : self.offsets[y1]]
+        rows = np.repeat(np.arange(y1 - y0), np.diff(self.offsets[y0 : y1 + 1]))
+        starts, stops = np.clip(runs[:, 0], x0, x1) - x0, np.clip(runs[:, 1], x0, x1) - x0
+        inside = starts < stops
+        rows, starts, stops = rows[inside], starts[inside], stops[inside]
+        # Mark the starts and stops of runs and fill between them by a cumulative sum
+        steps = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int8)
+        steps[rows, starts] = 1
+        steps[rows, stops] = -1
+        seg_arr = np.cumsum(steps[:, :-1], axis=1, dtype=np.int8).view(np.uint8)
+        return seg_arr * np.uint8(self.value) if self.value != 1 else seg_arr
+
+    def iter_bands(self, band_height=STRIP_HEIGHT):
+        """Yields the first row and the array of each band of band_height rows
+        of the mask, top to bottom, as by iter_png_bands.
+        """
+        for y in range(0, self.shape[0], band_height):
+            yield y, self.decode(y, min(y + band_height, self.shape[0]))
+
+
+def read_segmentation(seg_fp):
+    """Returns the uint8 array of the segmentation file (.rle or .png) at
+    seg_fp, as by np.array(Image.open(seg_fp).convert("L")).
+    """
+    if Path(seg_fp).suffix == RLE_SUFFIX:
+        return RLEMask(seg_fp).decode()
+    return np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+
+
+def read_contours(seg_fp, band_height=STRIP_HEIGHT, min_area=STRIP_MIN_AREA):
+    """Returns the shape of the segmentation file (.rle or .png) at seg_fp and
+    the external cv2 contours of its crypts. Segmentations of at least min_area
+    pixels are decoded band_height rows at a time (see band_contours), others
+    whole.
+    """
+    if Path(seg_fp).suffix != RLE_SUFFIX:
+        return png_contours(seg_fp, band_height, min_area)
+    rle_mask = RLEMask(seg_fp)
+    if rle_mask.area >= min_area:
+        return rle_mask.shape, band_contours(rle_mask.iter_bands(band_height))
+    seg_arr = rle_mask.decode()
+    contours, _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    return seg_arr.shape, contours
+
+
+def newer_segmentation_fp(seg_fp, other_fp):
+    """Returns the segmentation filepath of seg_fp and other_fp that was last
+    modified, or seg_fp if they were modified at the same time. That way a
+    .png file predicted again after it was converted is not shadowed by its
+    stale .rle mask.
+    """
+    if other_fp.stat().st_mtime_ns > seg_fp.stat().st_mtime_ns:
+        return other_fp
+    return seg_fp
+
+
+def segmentation_fp(seg_dir, fn):
+    """Returns the filepath of the segmentation of filename fn in seg_dir: its
+    .rle mask or .png file, whichever is newer (see newer_segmentation_fp), or
+    the .png filepath if it has neither.
+    """
+    seg_fps = [Path(seg_dir, fn + suffix) for suffix in SEG_SUFFIXES]
+    seg_fps = [fp for fp in seg_fps if fp.exists()]
+    if not seg_fps:
+        return Path(seg_dir, fn + ".png")
+    return functools.reduce(newer_segmentation_fp, seg_fps)
+
+
+def segmentation_fps(seg_dir):
+    """Returns the natsorted filepaths of the segmentations in seg_dir, one per
+    filename, preferring .rle masks to .png files of the same name unless the
+    .png file is newer (see newer_segmentation_fp).
+    """
+    seg_fps = {}
+    for suffix in SEG_SUFFIXES:
+        for fp in Path(seg_dir).glob(f"*{suffix}"):
+            other_fp = seg_fps.get(fp.stem)
+            seg_fps[fp.stem] = fp if other_fp is None else newer_segmentation_fp(other_fp, fp)
+    return natsorted(seg_fps.values())
+
+
+def convert_segmentations(seg_dir, delete=False):
+    """Saves a run-length encoded mask next to each .png segmentation in seg_dir
+    that has none yet, or only one older than the .png file, deleting the .png
+    file if delete is set. Returns the filepaths of the masks.
+    """
+    rle_fps = []
+    png_fps = natsorted(Path(seg_dir).glob("*.png"))
+    logger.info(f"Converting {len(png_fps)} segmentations in {seg_dir} to run-length encoded masks.")
+    for png_fp in png_fps:
+        rle_fp = png_fp.with_suffix(RLE_SUFFIX)
+        try:
+            if not rle_fp.exists() or newer_segmentation_fp(rle_fp, png_fp) == png_fp:
+                save_rle_mask(png_fp, rle_fp)
+            if delete:
+                png_fp.unlink()
+            rle_fps.append(rle_fp)
+        except Exception:
+            logger.exception(f"Error converting {png_fp.name}. Skipping and moving on.")
+    return rle_fps
+
+
+def benchmark_rle_masks(seg_dir, region_size=512):
+    """Logs the total file size and the time of decoding the .png segmentations
+    in seg_dir whole, decoding a region_size square region of each, and finding
+    the contours of their crypts, from the .png files and from run-length
+    encoded masks converted from them. Checks that the decoded masks are the
+    same.
+    """
+    png_fps = natsorted(Path(seg_dir).glob("*.png"))
+    rle_fps = convert_segmentations(seg_dir)
+    sizes = {
+        "png": sum(fp.stat().st_size for fp in png_fps),
+        "rle": sum(fp.stat().st_size for fp in rle_fps),
+    }
+    times = {}
+    for name, fps in [("png", png_fps), ("rle", rle_fps)]:
+        start_time = time.time()
+        seg_arrs = [read_segmentation(fp) for fp in fps]
+        times[name, "decode"] = time.time() - start_time
+        start_time = time.time()
+        for fp, seg_arr in zip(fps, seg_arrs):
+            y, x = seg_arr.shape[0] // 2, seg_arr.shape[1] // 2
+            if name == "png":
+                read_segmentation(fp)[y : y + region_size, x : x + region_size]
+            else:
+                region = RLEMask(fp).decode(y, y + region_size, x, x + region_size)
+                assert np.array_equal(region, seg_arr[y : y + region_size, x : x + region_size])
+        times[name, "region"] = time.time() - start_time
+        start_time = time.time()
+        for fp in fps:
+            read_contours(fp)
+        times[name, "contours"] = time.time() - start_time
+        if name == "png":
+            png_seg_arrs = seg_arrs
+    assert all(np.array_equal(a, b) for a, b in zip(png_seg_arrs, seg_arrs))
+    for name in ["png", "rle"]:
+        logger.info(
+            f"{len(png_fps)} {name} segmentations: {sizes[name] / 2**20:.2f} MB, decoded in {times[name, 'decode']:.2f} s, "
+            + f"{region_size}x{region_size} regions in {times[name, 'region']:.2f} s, contours in {times[name, 'contours']:.2f} s."
+        )
+    return sizes, times
+
+
+def main():
+    """Converts the .png segmentations of a folder into run-length encoded
+    masks, or benchmarks decoding them.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("command", choices=["convert", "benchmark"])
+    parser.add_argument("seg_dirs", nargs="+", type=Path, help="Slice Segmentations folders.")
+    parser.add_argument(
+        "--delete", action="store_true", help="Delete the .png files once converted."
+    )
+    args = parser.parse_args()
+    setup_logger(LOG_FP)
+    for seg_dir in args.seg_dirs:
+        if args.command == "convert":
+            convert_segmentations(seg_dir, args.delete)
+        elif args.command == "benchmark":
+            benchmark_rle_masks(seg_dir)
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
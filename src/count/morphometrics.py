@@ -0,0 +1,201 @@
+import argparse
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import cv2
+
+import src.parameters
+from src.logger import setup_logger, summarize_warnings, log_complete
+from src.logger import time_since
+from src.count.contour_store import INDEX_FN, ContourStore
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+
+MORPHOMETRICS_FN = "crypt_morphometrics.npz"
+MORPHOMETRICS_COLUMNS = (
+    "area",
+    "perimeter",
+    "centroid_x",
+    "centroid_y",
+    "equivalent_diameter",
+    "eccentricity",
+    "solidity",
+    "bbox_x",
+    "bbox_y",
+    "bbox_width",
+    "bbox_height",
+)
+
+
+def contour_morphometrics(points, offsets):
+    """Returns a dict of the MORPHOMETRICS_COLUMNS arrays of the contours whose
+    (P, 2) points are concatenated in points, with the (C + 1,) offsets of each
+    contour in them, as in the contour store. The moments, perimeter, bounding
+    box and convex hull of each contour are found by cv2 on just its corners,
+    and the columns derived from them at once with NumPy.
+    """
+    if len(offsets) == 1:
+        return {column: np.zeros(0) for column in MORPHOMETRICS_COLUMNS}
+    points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # Points in the middle of straight runs change neither the polygon nor its
+    # hull, so only the corners and the ends of each contour are kept
+    corners = np.ones(len(points), dtype=bool)
+    steps = np.diff(points, axis=0)
+    corners[1:-1] = np.any(steps[1:] != steps[:-1], axis=1)
+    corners[offsets[:-1]] = corners[offsets[1:] - 1] = True
+    contour_ends = np.cumsum(np.add.reduceat(corners, offsets[:-1]))
+    contours = np.split(points[corners], contour_ends[:-1])
+    moments = [cv2.moments(c) for c in contours]
+    m00, m10, m01, mu20, mu02, mu11 = (
+        np.array([m[key] for m in moments])
+        for key in ["m00", "m10", "m01", "mu20", "mu02", "mu11"]
+    )
+    bbox_x, bbox_y, bbox_width, bbox_height = np.array(
+        [cv2.boundingRect(c) for c in contours], dtype=np.int32
+    ).T
+    area = np.abs(m00)
+    hull_area = np.array([cv2.contourArea(cv2.convexHull(c)) for c in contours])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Contours without area (lines of pixels) are centred on their bounding box
+        centroid_x = np.where(m00 != 0, m10 / m00, bbox_x + (bbox_width - 1) / 2)
+        centroid_y = np.where(m00 != 0, m01 / m00, bbox_y + (bbox_height - 1) / 2)
+        # Eigenvalues of the central second moments, as of the equivalent ellipse
+        root = np.sqrt(4 * mu11**2 + (mu20 - mu02) ** 2)
+        major, minor = mu20 + mu02 + root, mu20 + mu02 - root
+        eccentricity = np.nan_to_num(np.sqrt(np.clip(1 - minor / major, 0, 1)))
+        solidity = np.where(hull_area > 0, area / hull_area, 1.0)
+    return {
+        "area": area,
+        "perimeter": np.array([cv2.arcLength(c, True) for c in contours]),
+        "centroid_x": centroid_x,
+        "centroid_y": centroid_y,
+        "equivalent_diameter": np.sqrt(4 * area / np.pi),
+        "eccentricity": eccentricity,
+        "solidity": solidity,
+        "bbox_x": bbox_x,
+        "bbox_y": bbox_y,
+        "bbox_width": bbox_width,
+        "bbox_height": bbox_height,
+    }
+
+
+def crypt_morphometrics(contours):
+    """Returns a dict of the MORPHOMETRICS_COLUMNS arrays of the list of cv2
+    contours (see contour_morphometrics).
+    """
+    offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in contours])
+    if not contours:
+        return contour_morphometrics(np.zeros((0, 2), dtype=np.int32), offsets)
+    return contour_morphometrics(np.concatenate([c.reshape(-1, 2) for c in contours]), offsets)
+
+
+def save_morphometrics(all_crypt_data, morphometrics_fp):
+    """Saves the morphometrics of the crypts of all_crypt_data (dict of crypt
+    data by filename, see get_crypt_data) to a compressed .npz file at
+    morphometrics_fp, with one array per column over the crypts of all
+    filenames, the 'slice' index of each crypt in the 'slices' array of
+    filenames and its 'crypt' index in its slice's contours. The morphometrics
+    are computed from the contours of crypt data that has none. Filenames whose
+    crypt data is an error have no crypts.
+    """
+    slices, columns = [], {column: [] for column in MORPHOMETRICS_COLUMNS}
+    slice_indices, crypt_indices = [], []
+    for fn, crypt_data in all_crypt_data.items():
+        slices.append(fn)
+        if type(crypt_data) == str:
+            continue
+        morphometrics = crypt_data.get("morphometrics")
+        if morphometrics is None:
+            morphometrics = crypt_morphometrics(crypt_data["contours"])
+        for column in MORPHOMETRICS_COLUMNS:
+            columns[column].append(morphometrics[column])
+        n = len(morphometrics["area"])
+        slice_indices.append(np.full(n, len(slices) - 1, dtype=np.int32))
+        crypt_indices.append(np.arange(n, dtype=np.int32))
+    arrays = {
+        column: np.concatenate(values) if values else np.zeros(0)
+        for column, values in columns.items()
+    }
+    arrays["slice"] = np.concatenate(slice_indices) if slice_indices else np.zeros(0, dtype=np.int32)
+    arrays["crypt"] = np.concatenate(crypt_indices) if crypt_indices else np.zeros(0, dtype=np.int32)
+    # Write to a temporary file first so that readers never see a partial file
+    morphometrics_fp = Path(morphometrics_fp)
+    tmp_fp = morphometrics_fp.with_name(morphometrics_fp.name + f".{uuid.uuid4().hex}.tmp")
+    with open(tmp_fp, "wb") as file:
+        np.savez_compressed(file, slices=np.array(slices, dtype=str), **arrays)
+    os.replace(tmp_fp, morphometrics_fp)
+
+
+def load_morphometrics(morphometrics_fp):
+    """Returns a DataFrame of the crypt morphometrics saved at morphometrics_fp
+    (see save_morphometrics), with one row per crypt, its slice filename in
+    the 'slice' column and its index in the slice's contours in 'crypt'.
+    """
+    with np.load(morphometrics_fp) as morphometrics:
+        table = pd.DataFrame({column: morphometrics[column] for column in MORPHOMETRICS_COLUMNS})
+        table.insert(0, "crypt", morphometrics["crypt"])
+        table.insert(0, "slice", pd.Categorical.from_codes(morphometrics["slice"], morphometrics["slices"]))
+    return table
+
+
+def store_morphometrics(seg_dir):
+    """Computes the crypt morphometrics of the contour store in seg_dir, e.g. of
+    folders counted before they were saved by the count step, and saves them to
+    MORPHOMETRICS_FN in seg_dir. The morphometrics of the exact contours of all
+    slices are computed at once. Returns the filepath.
+    """
+    start_time = time.time()
+    store = ContourStore(Path(seg_dir, INDEX_FN))
+    points, offsets = np.array(store.points), np.array(store.offsets)
+    # Gather the points of each slice's exact contours, not its simplified ones
+    ranges = [entry["contours"] for entry in store.slices.values() if "error" not in entry]
+    contour_indices = np.concatenate([np.arange(*r) for r in ranges] or [np.zeros(0, dtype=np.int64)])
+    lengths = np.diff(offsets)[contour_indices]
+    exact_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    exact_offsets[1:] = np.cumsum(lengths)
+    point_indices = np.arange(exact_offsets[-1]) + np.repeat(
+        offsets[contour_indices] - exact_offsets[:-1], lengths
+    )
+    morphometrics = contour_morphometrics(points[point_indices], exact_offsets)
+    all_crypt_data = {}
+    start = 0
+    for fn, entry in store.slices.items():
+        if "error" in entry:
+            all_crypt_data[fn] = entry["error"]
+            continue
+        stop = start + entry["contours"][1] - entry["contours"][0]
+        all_crypt_data[fn] = {
+            "morphometrics": {column: values[start:stop] for column, values in morphometrics.items()}
+        }
+        start = stop
+    morphometrics_fp = Path(seg_dir, MORPHOMETRICS_FN)
+    save_morphometrics(all_crypt_data, morphometrics_fp)
+    logger.info(f"Saved morphometrics of {len(store)} slices to {morphometrics_fp} in {time_since(start_time)}.")
+    return morphometrics_fp
+
+
+def main():
+    """Saves the crypt morphometrics of counted Slice Segmentations folders and
+    logs their summary statistics.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("seg_dirs", nargs="+", type=Path, help="Slice Segmentations folders.")
+    args = parser.parse_args()
+    setup_logger(LOG_FP)
+    for seg_dir in args.seg_dirs:
+        table = load_morphometrics(store_morphometrics(seg_dir))
+        logger.info(f"Crypt morphometrics of {seg_dir}:\n{table.describe().T}")
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
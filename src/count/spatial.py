@@ -0,0 +1,182 @@
+import argparse
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import cv2
+from scipy.spatial import cKDTree
+
+import src.parameters
+from src.logger import setup_logger, add_trial_log, summarize_warnings, log_complete
+from src.logger import time_since
+from src.count.contour_store import INDEX_FN, ContourStore
+from src.count.morphometrics import MORPHOMETRICS_FN, load_morphometrics
+from src.count.excel import Excel
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+SPATIAL_NEIGHBOURS = src.parameters.SPATIAL_NEIGHBOURS
+SPATIAL_DENSITY_RADIUS = src.parameters.SPATIAL_DENSITY_RADIUS
+SPATIAL_GRID_SIZE = src.parameters.SPATIAL_GRID_SIZE
+
+SPATIAL_FN = "crypt_spatial.npz"
+# Densities are in crypts per megapixel
+DENSITY_UNIT = 1e6
+
+
+def slice_spatial_analytics(
+    centroids,
+    shape,
+    k=SPATIAL_NEIGHBOURS,
+    radius=SPATIAL_DENSITY_RADIUS,
+    grid_size=SPATIAL_GRID_SIZE,
+):
+    """Returns the spatial analytics of the (n, 2) crypt centroids of a slice of
+    the given shape, from a KD-tree of the centroids, in O(n log n):
+        - 'knn_distances', the (n, k) distances of each crypt to its k nearest
+          neighbours (inf where there are fewer),
+        - 'local_density', the density of the other crypts within radius of each,
+        - 'density_map', the density of crypts within radius of the points of a
+          grid with grid_size spacing over the slice,
+        - 'summary', a dict of the statistics of the slice.
+    """
+    n = len(centroids)
+    centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+    disc_area = np.pi * radius**2
+    height, width = shape
+    grid_y, grid_x = np.mgrid[
+        grid_size / 2 : height : grid_size, grid_size / 2 : width : grid_size
+    ]
+    grid = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+    if n == 0:
+        knn_distances = np.zeros((0, k))
+        local_density = np.zeros(0)
+        density_map = np.zeros(grid_x.shape)
+    else:
+        tree = cKDTree(centroids)
+        # The nearest point to each crypt is itself
+        knn_distances = tree.query(centroids, k=k + 1)[0][:, 1:]
+        neighbours = tree.query_ball_point(centroids, radius, return_length=True) - 1
+        local_density = DENSITY_UNIT * neighbours / disc_area
+        grid_counts = tree.query_ball_point(grid, radius, return_length=True)
+        density_map = (DENSITY_UNIT * grid_counts / disc_area).reshape(grid_x.shape)
+    nearest = knn_distances[:, 0] if n > 1 else np.zeros(0)
+    # Clark-Evans index: the mean nearest neighbour distance relative to that of
+    # randomly placed crypts over the convex hull of the centroids (<1 clustered,
+    # >1 regular)
+    hull_area = cv2.contourArea(cv2.convexHull(centroids.astype(np.float32))) if n > 2 else 0
+    clark_evans = nearest.mean() / (0.5 * np.sqrt(hull_area / n)) if hull_area > 0 else np.nan
+    summary = {
+        "Crypts": n,
+        "NN Distance Mean": nearest.mean() if n > 1 else np.nan,
+        "NN Distance Median": np.median(nearest) if n > 1 else np.nan,
+        "NN Distance Stdev": nearest.std() if n > 1 else np.nan,
+        f"{k}-NN Distance Mean": knn_distances.mean() if n > k else np.nan,
+        "Local Density Mean": local_density.mean() if n else np.nan,
+        "Local Density Max": local_density.max() if n else np.nan,
+        "Density Map Max": density_map.max(),
+        "Clark-Evans Index": clark_evans,
+    }
+    return {
+        "knn_distances": knn_distances,
+        "local_density": local_density,
+        "density_map": density_map,
+        "summary": summary,
+    }
+
+
+def spatial_analytics(seg_dir, **kwargs):
+    """Returns a dict of the spatial analytics (see slice_spatial_analytics) of
+    each slice counted in seg_dir, from the crypt centroids of its morphometrics
+    table and the slice shapes of its contour store. Slices whose counting
+    failed are skipped.
+    """
+    table = load_morphometrics(Path(seg_dir, MORPHOMETRICS_FN))
+    store = ContourStore(Path(seg_dir, INDEX_FN))
+    centroids = {
+        fn: rows[["centroid_x", "centroid_y"]].to_numpy()
+        for fn, rows in table.groupby("slice", observed=False)
+    }
+    return {
+        fn: slice_spatial_analytics(centroids[fn], entry["shape"], **kwargs)
+        for fn, entry in store.slices.items()
+        if "error" not in entry
+    }
+
+
+def save_spatial_analytics(all_analytics, spatial_fp):
+    """Saves all_analytics (dict of spatial analytics by filename) to a
+    compressed .npz file at spatial_fp: per-crypt columns over all slices, as
+    in the morphometrics table ('slice', 'crypt', 'nn_distance',
+    'knn_distance_mean' and 'local_density'), and the density map of the i-th
+    filename of 'slices' as 'density_map_<i>'.
+    """
+    slices = list(all_analytics)
+    columns = {"slice": [], "crypt": [], "nn_distance": [], "knn_distance_mean": [], "local_density": []}
+    density_maps = {}
+    for i, analytics in enumerate(all_analytics.values()):
+        knn_distances = analytics["knn_distances"]
+        n = len(knn_distances)
+        columns["slice"].append(np.full(n, i, dtype=np.int32))
+        columns["crypt"].append(np.arange(n, dtype=np.int32))
+        columns["nn_distance"].append(knn_distances[:, 0])
+        columns["knn_distance_mean"].append(knn_distances.mean(axis=1))
+        columns["local_density"].append(analytics["local_density"])
+        density_maps[f"density_map_{i}"] = analytics["density_map"]
+    arrays = {column: np.concatenate(values) if values else np.zeros(0) for column, values in columns.items()}
+    # Write to a temporary file first so that readers never see a partial file
+    spatial_fp = Path(spatial_fp)
+    tmp_fp = spatial_fp.with_name(spatial_fp.name + f".{uuid.uuid4().hex}.tmp")
+    with open(tmp_fp, "wb") as file:
+        np.savez_compressed(file, slices=np.array(slices, dtype=str), **arrays, **density_maps)
+    os.replace(tmp_fp, spatial_fp)
+
+
+def spatial_analytics_to_excel(seg_dir, excel_dir):
+    """Computes the spatial analytics of the slices counted in seg_dir, saves
+    them to SPATIAL_FN in seg_dir and their summary statistics to the
+    'Spatial (Automated)' sheet of the crypt_counts.xlsx Excel file in
+    excel_dir.
+    """
+    start_time = time.time()
+    all_analytics = spatial_analytics(seg_dir)
+    save_spatial_analytics(all_analytics, Path(seg_dir, SPATIAL_FN))
+    logger.info(
+        f"Computed spatial analytics of {len(all_analytics)} slices in {time_since(start_time)}."
+    )
+    logger.info(f"Saving spatial analytics to crypt_counts.xlsx Excel file in {excel_dir}.")
+    rows = []
+    for fn, analytics in all_analytics.items():
+        data = {"Filename": fn}
+        data.update(
+            (name, value if type(value) == int else round(float(value), 2))
+            for name, value in analytics["summary"].items()
+        )
+        rows.append(data)
+    # Write the whole sheet at once
+    Excel(excel_dir, "Spatial (Automated)", pd.DataFrame(rows))
+    logger.info("Successfuly saved spatial analytics to Excel file.")
+
+
+def main():
+    """Computes the crypt spatial analytics of a counted trial and saves them
+    to crypt_counts.xlsx in the trial data folder and to crypt_spatial.npz in
+    its Slice Segmentations folder.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("trial_dir", type=Path, help="Trial data folder.")
+    args = parser.parse_args()
+    # Log to both the public and the trial log
+    setup_logger(LOG_FP)
+    add_trial_log(args.trial_dir / "log.log")
+    spatial_analytics_to_excel(args.trial_dir / "Slice Segmentations", args.trial_dir)
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
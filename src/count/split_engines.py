@@ -0,0 +1,173 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+import numpy as np
+import cv2
+from scipy import ndimage
+
+import src.parameters
+from src.logger import setup_logger, summarize_warnings, log_complete
+from src.count.crypt_contour import CryptContour
+from src.count.mask_rle import read_segmentation, segmentation_fps
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+MIN_CRYPT_SIZE = src.parameters.MIN_CRYPT_SIZE
+WATERSHED_PEAK_FRACTION = src.parameters.WATERSHED_PEAK_FRACTION
+
+
+def defects_separated_contours(contour, trace=None):
+    """Returns the separated contours of a blob's cv2 contour by recursively
+    splitting it at its convexity defects (see CryptContour). If given, the
+    trace dict is updated with the split_trace of the blob.
+    """
+    crypt_contour = CryptContour(contour)
+    separated_contours = crypt_contour.separated_contours
+    if trace is not None:
+        trace.update(crypt_contour.split_trace)
+    return separated_contours
+
+
+def watershed_separated_contours(
+    contour,
+    min_crypt_size=MIN_CRYPT_SIZE,
+    peak_fraction=WATERSHED_PEAK_FRACTION,
+    trace=None,
+):
+    """Returns the separated contours of a blob's cv2 contour by a watershed of
+    its distance transform, or an empty list if it is smaller than
+    min_crypt_size. Each crypt is marked by a connected peak of the distance
+    transform, where it is at least peak_fraction of its max and deep enough for
+    a crypt of min_crypt_size. Crypts smaller than min_crypt_size are merged into
+    their neighbours by dropping their marker, and blobs left with one marker are
+    returned as they are. Only the bounding box of the blob is rasterized, and
+    each watershed is linear in its pixels. All small crypts are dropped at
+    once, and the watershed is only rerun if that leaves new small ones. If
+    given, the trace dict is updated with the number of crypt markers found
+    and of watersheds run.
+    """
+    if cv2.contourArea(contour) < min_crypt_size:
+        return []
+    # Fill the blob in bbox-local coordinates with a 1 pixel border
+    x, y, width, height = cv2.boundingRect(contour)
+    mask = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    mask = cv2.drawContours(mask, [contour], -1, 1, cv2.FILLED, offset=(1 - x, 1 - y))
+    dist = cv2.distanceTransform(mask, cv2.DIST_L2, 5)
+    # Peaks must also be deeper than half the radius of the smallest crypt
+    min_depth = max(peak_fraction * dist.max(), 0.5 * np.sqrt(min_crypt_size / np.pi))
+    peaks = (dist >= min_depth).astype(np.uint8)
+    # Each connected peak marks one crypt
+    n_peaks, peak_labels = cv2.connectedComponents(peaks)
+    labels = list(range(1, n_peaks))
+    in_peaks = peaks == 1
+    peak_pixel_labels = peak_labels[in_peaks]
+    if trace is not None:
+        trace["markers"] = len(labels)
+        trace["watersheds"] = 0
+    image = cv2.cvtColor(
+        cv2.normalize(-dist, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8),
+        cv2.COLOR_GRAY2BGR,
+    )
+    while len(labels) > 1:
+        # Label the background 1, the crypt markers 2 and up, the rest 0 (unknown)
+        markers = np.where(mask == 1, 0, 1).astype(np.int32)
+        marker_of_label = np.zeros(n_peaks, dtype=np.int32)
+        marker_of_label[labels] = np.arange(2, len(labels) + 2)
+        markers[in_peaks] = marker_of_label[peak_pixel_labels]
+        markers = cv2.watershed(image, markers)
+        if trace is not None:
+            trace["watersheds"] += 1
+        # Pixels of each crypt's region, the watershed lines are -1
+        sizes = np.bincount(np.maximum(markers, 0).ravel(), minlength=len(labels) + 2)[2:]
+        keep = sizes >= min_crypt_size
+        if keep.all():
+            # Find each crypt's contour within the bounding box of its region only
+            regions = ndimage.find_objects(np.maximum(markers, 0))
+            separated_contours = []
+            for i in range(len(labels)):
+                rows, columns = regions[i + 1]
+                region = np.pad((markers[rows, columns] == i + 2).astype(np.uint8), 1)
+                offset = (x - 2 + columns.start, y - 2 + rows.start)
+                region_contours, _ = cv2.findContours(
+                    region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset
+                )
+                separated_contours.append(max(region_contours, key=cv2.contourArea))
+            sizes = np.array([cv2.contourArea(c) for c in separated_contours])
+            keep = sizes >= min_crypt_size
+            if keep.all():
+                return separated_contours
+        if not keep.any():
+            # Only drop the smallest, as the others may grow large enough
+            keep = np.arange(len(labels)) != np.argmin(sizes)
+        # Merge the small crypts into their neighbours by dropping their markers
+        labels = [label for label, kept in zip(labels, keep) if kept]
+    return [contour]
+
+
+# Splitting engines by name, each returning the separated contours of a blob
+SPLIT_ENGINES = {
+    "defects": defects_separated_contours,
+    "watershed": watershed_separated_contours,
+}
+
+
+def compare_split_engines(seg_dir, engines=tuple(SPLIT_ENGINES)):
+    """Logs the time and the crypt counts of each splitting engine in engines on
+    the segmentations in seg_dir, and the agreement of the counts of the other
+    engines with the first. Returns a dict of the counts of each engine by
+    filename.
+    """
+    seg_fps = segmentation_fps(seg_dir)
+    blobs = {}
+    for seg_fp in seg_fps:
+        seg_arr = read_segmentation(seg_fp)
+        blobs[seg_fp.stem], _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+    counts = {}
+    for engine in engines:
+        separated_contours = SPLIT_ENGINES[engine]
+        start_time = time.time()
+        counts[engine] = {
+            fn: sum(len(separated_contours(c)) for c in contours)
+            for fn, contours in blobs.items()
+        }
+        logger.info(
+            f"Split engine '{engine}': {sum(counts[engine].values())} crypts on {len(seg_fps)} segmentations in {time.time() - start_time:.2f} s."
+        )
+    reference = engines[0]
+    for engine in engines[1:]:
+        diffs = [counts[engine][fn] - counts[reference][fn] for fn in blobs]
+        n_agree = sum(diff == 0 for diff in diffs)
+        logger.info(
+            f"Split engine '{engine}' vs '{reference}': same count on {n_agree}/{len(diffs)} segmentations, "
+            + f"mean absolute count difference {np.mean(np.abs(diffs)):.2f}, max {max(np.abs(diffs), default=0)}."
+        )
+        for fn, diff in zip(blobs, diffs):
+            if diff:
+                logger.info(
+                    f"  {fn}: {counts[reference][fn]} ({reference}) vs {counts[engine][fn]} ({engine})."
+                )
+    return counts
+
+
+def main():
+    """Benchmarks the splitting engines on a folder of segmentations and reports
+    the agreement of their crypt counts.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("seg_dir", type=Path, help="Folder of segmentation files.")
+    parser.add_argument(
+        "-e", "--engines", nargs="+", choices=list(SPLIT_ENGINES), default=list(SPLIT_ENGINES)
+    )
+    args = parser.parse_args()
+    setup_logger(LOG_FP)
+    compare_split_engines(args.seg_dir, tuple(args.engines))
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
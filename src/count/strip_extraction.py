@@ -0,0 +1,302 @@
+import argparse
+import logging
+import struct
+import time
+import tracemalloc
+import zlib
+from pathlib import Path
+import numpy as np
+from PIL import Image
+import cv2
+
+import src.parameters
+from src.logger import setup_logger, summarize_warnings, log_complete
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+STRIP_HEIGHT = src.parameters.STRIP_HEIGHT
+STRIP_MIN_AREA = src.parameters.STRIP_MIN_AREA
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PIL image mode and raw mode of the pixels of each (bit depth, colour type)
+PNG_MODES = {
+    (1, 0): ("1", "1"),
+    (2, 0): ("L", "L;2"),
+    (4, 0): ("L", "L;4"),
+    (8, 0): ("L", "L"),
+    (16, 0): ("I;16", "I;16B"),
+    (8, 2): ("RGB", "RGB"),
+    (1, 3): ("P", "P;1"),
+    (2, 3): ("P", "P;2"),
+    (4, 3): ("P", "P;4"),
+    (8, 3): ("P", "P"),
+    (8, 4): ("LA", "LA"),
+    (8, 6): ("RGBA", "RGBA"),
+}
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# PIL modes whose pixels are the bytes of the PNG filter unit (bytes per pixel),
+# so that PIL's zip decoder can unfilter rows of any of the PNG_MODES as bytes
+FILTER_UNIT_MODES = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+
+class UnsupportedPNGError(ValueError):
+    """Raised for .png files that cannot be decoded in bands, which can still be
+    decoded whole.
+    """
+
+
+def read_png_chunks(file):
+    """Yields the type and data of each chunk of the open .png file, one chunk at
+    a time, up to IEND. Raises ValueError if the file is not a .png file or is
+    truncated.
+    """
+    if file.read(8) != PNG_SIGNATURE:
+        raise ValueError(f"{file.name} is not a .png file.")
+    while True:
+        header = file.read(8)
+        if len(header) < 8:
+            raise ValueError(f"{file.name} is truncated.")
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = file.read(length)
+        if len(data) < length:
+            raise ValueError(f"{file.name} is truncated.")
+        file.read(4)  # CRC
+        yield chunk_type, data
+        if chunk_type == b"IEND":
+            return
+
+
+def png_shape(seg_fp):
+    """Returns the (height, width) of the .png file at seg_fp from its header."""
+    with open(seg_fp, "rb") as file:
+        _, ihdr = next(read_png_chunks(file))
+    width, height = struct.unpack(">II", ihdr[:8])
+    return height, width
+
+
+def iter_png_bands(seg_fp, band_height=STRIP_HEIGHT):
+    """Yields the first row and the "L" pixel array of each band of band_height
+    rows of the .png file at seg_fp, top to bottom, as by
+    np.array(Image.open(seg_fp).convert("L")) but decompressing only one band at
+    a time. Raises UnsupportedPNGError for interlaced .png files and 16 bit
+    colour ones, and ValueError for truncated ones.
+    """
+    with open(seg_fp, "rb") as file:
+        chunks = read_png_chunks(file)
+        palette = None
+        for chunk_type, data in chunks:
+            if chunk_type == b"IHDR":
+                width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+                    ">IIBBBBB", data
+                )
+            elif chunk_type == b"PLTE":
+                palette = data
+            elif chunk_type == b"IDAT":
+                break
+        if interlace or (bit_depth, color_type) not in PNG_MODES:
+            raise UnsupportedPNGError(f"Cannot decode {seg_fp} in bands.")
+        mode, rawmode = PNG_MODES[bit_depth, color_type]
+        filter_unit = max(1, PNG_CHANNELS[color_type] * bit_depth // 8)
+        stride = (width * PNG_CHANNELS[color_type] * bit_depth + 7) // 8
+
+        def compressed_data():
+            yield data
+            for chunk_type, chunk_data in chunks:
+                if chunk_type == b"IDAT":
+                    yield chunk_data
+
+        compressed = compressed_data()
+        decompressor = zlib.decompressobj()
+        pending = b""
+        # Rows are unfiltered relative to the row above, which is 0 for the first
+        previous_row = bytes(stride)
+        for y in range(0, height, band_height):
+            rows = min(band_height, height - y)
+            # Decompress just the filter byte and stride bytes of each row
+            size = rows * (1 + stride)
+            filtered = bytearray()
+            while len(filtered) < size:
+                if not pending:
+                    pending = next(compressed, None)
+                    if pending is None:
+                        filtered += decompressor.flush()
+                        if len(filtered) < size:
+                            raise ValueError(f"{seg_fp} is truncated.")
+                        break
+                filtered += decompressor.decompress(pending, size - len(filtered))
+                pending = decompressor.unconsumed_tail
+            # Unfilter with PIL's zip decoder, below the previous row unfiltered
+            filter_mode = FILTER_UNIT_MODES[filter_unit]
+            unfiltered = Image.frombytes(
+                filter_mode,
+                (stride // filter_unit, rows + 1),
+                zlib.compress(b"\x00" + previous_row + filtered[:size], 0),
+                "zip",
+                filter_mode,
+            ).tobytes()[stride:]
+            previous_row = unfiltered[-stride:]
+            band = Image.frombytes(mode, (width, rows), unfiltered, "raw", rawmode)
+            if palette is not None and mode == "P":
+                band.putpalette(palette)
+            yield y, np.array(band.convert("L"), dtype=np.uint8)
+
+
+def component_contour(pieces):
+    """Returns the external cv2 contour of a connected component, given as a list
+    of (y, x, mask) pieces, by finding it on a crop of just the component.
+    """
+    y0 = min(y for y, _, _ in pieces)
+    x0 = min(x for _, x, _ in pieces)
+    y1 = max(y + mask.shape[0] for y, _, mask in pieces)
+    x1 = max(x + mask.shape[1] for _, x, mask in pieces)
+    # Crop with a 1 pixel border
+    crop = np.zeros((y1 - y0 + 2, x1 - x0 + 2), dtype=np.uint8)
+    for y, x, mask in pieces:
+        crop[y - y0 + 1 : y - y0 + 1 + mask.shape[0], x - x0 + 1 : x - x0 + 1 + mask.shape[1]] |= mask
+    contours, _ = cv2.findContours(
+        crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x0 - 1, y0 - 1)
+    )
+    return contours[0]
+
+
+def external_contours(contours):
+    """Returns the contours that are not within the holes of others, in the order
+    of cv2.findContours with RETR_EXTERNAL, which is the reverse raster order of
+    their first points.
+    """
+    contours = sorted(contours, key=lambda c: (c[0, 0, 1], c[0, 0, 0]), reverse=True)
+    boxes = np.array([cv2.boundingRect(c) for c in contours]).reshape(-1, 4)
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+    kept_contours = []
+    for i, contour in enumerate(contours):
+        # A component in a hole of another is strictly within its bounding box
+        enclosing = np.flatnonzero((x0 < x0[i]) & (y0 < y0[i]) & (x1 > x1[i]) & (y1 > y1[i]))
+        point = tuple(int(v) for v in contour[0, 0])
+        if not any(cv2.pointPolygonTest(contours[j], point, False) > 0 for j in enclosing):
+            kept_contours.append(contour)
+    return kept_contours
+
+
+def band_contours(bands):
+    """Returns the external cv2 contours of the crypts of a segmentation given as
+    its (first row, array) bands from top to bottom, as by cv2.findContours on
+    the whole segmentation with RETR_EXTERNAL and CHAIN_APPROX_NONE. The
+    connected components of each band are found together with the last row of
+    the band above, to merge them across bands. A component's contour is found
+    on a crop of just it once no band extends it, so memory is bounded by the
+    band and the largest crypt rather than the whole segmentation.
+    """
+    parent = {}
+    pieces = {}  # (y, x, mask) pieces of each open component by root id
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[j] = i
+            pieces.setdefault(i, []).extend(pieces.pop(j, []))
+
+    contours = []
+    last_mask = last_ids = None
+    next_id = 1
+    for y, band in bands:
+        mask = (band > 0).astype(np.uint8)
+        # Overlap the last row of the band above to connect components across bands
+        top = y if last_mask is None else y - 1
+        if last_mask is not None:
+            mask = np.vstack([last_mask, mask])
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        ids = np.zeros(n, dtype=np.int64)
+        ids[1:] = np.arange(next_id, next_id + n - 1)
+        next_id += n - 1
+        for label in range(1, n):
+            parent[ids[label]] = ids[label]
+            x, y0, w, h = stats[label, :4]
+            # Pixels of the overlap row are already pieces of the components above
+            if last_mask is not None and y0 == 0:
+                y0, h = 1, h - 1
+            if h > 0:
+                piece = labels[y0 : y0 + h, x : x + w] == label
+                pieces[ids[label]] = [(top + y0, x, piece.astype(np.uint8))]
+        if last_mask is not None:
+            overlap = np.stack([labels[0], last_ids])
+            for label, last_id in np.unique(overlap[:, overlap.min(axis=0) > 0], axis=1).T:
+                union(last_id, ids[label])
+        roots = np.array([0] + [find(i) for i in ids[1:]], dtype=np.int64)
+        last_mask, last_ids = mask[-1:], roots[labels[-1]]
+        # Components not in the last row are complete
+        for root in set(pieces) - set(np.unique(last_ids).tolist()):
+            contours.append(component_contour(pieces.pop(root)))
+    for root in list(pieces):
+        contours.append(component_contour(pieces.pop(root)))
+    return external_contours(contours)
+
+
+def strip_contours(seg_fp, band_height=STRIP_HEIGHT):
+    """Returns the shape of the segmentation .png file at seg_fp and the external
+    cv2 contours of its crypts, decoding it in bands of band_height rows (see
+    iter_png_bands and band_contours).
+    """
+    return png_shape(seg_fp), band_contours(iter_png_bands(seg_fp, band_height))
+
+
+def png_contours(seg_fp, band_height=STRIP_HEIGHT, min_area=STRIP_MIN_AREA):
+    """Returns the shape of the segmentation .png file at seg_fp and the
+    external cv2 contours of its crypts. Segmentations of at least min_area
+    pixels are decoded in strips (see strip_contours), others and those whose
+    format cannot be are decoded whole.
+    """
+    height, width = png_shape(seg_fp)
+    if height * width >= min_area:
+        try:
+            return strip_contours(seg_fp, band_height)
+        except UnsupportedPNGError:
+            logger.debug(f"Cannot decode {seg_fp} in bands, decoding it whole.")
+    seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+    contours, _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    return seg_arr.shape, contours
+
+
+def compare_strip_extraction(seg_fp, band_height=STRIP_HEIGHT):
+    """Logs the time and peak traced memory of finding the contours of the
+    segmentation at seg_fp whole and in strips, and checks that they are the
+    same.
+    """
+    results = {}
+    for name, min_area in [("whole", np.inf), ("strips", 0)]:
+        tracemalloc.start()
+        start_time = time.time()
+        results[name] = png_contours(seg_fp, band_height, min_area)
+        duration = time.time() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info(
+            f"{Path(seg_fp).name} {name}: {len(results[name][1])} contours in {duration:.2f} s, peak memory {peak / 2**20:.1f} MB."
+        )
+    (shape, contours), (strip_shape, strips) = results["whole"], results["strips"]
+    assert tuple(shape) == tuple(strip_shape) and len(contours) == len(strips)
+    assert all(np.array_equal(a, b) for a, b in zip(contours, strips))
+
+
+def main():
+    """Compares finding the contours of segmentations whole and in strips."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("seg_fps", nargs="+", type=Path, help="Segmentation .png files.")
+    parser.add_argument("-b", "--band-height", type=int, default=STRIP_HEIGHT)
+    args = parser.parse_args()
+    setup_logger(LOG_FP)
+    for seg_fp in args.seg_fps:
+        compare_strip_extraction(seg_fp, args.band_height)
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import itertools
+import logging
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import cv2
+
+import src.parameters
+from src.logger import setup_logger, add_trial_log, summarize_warnings, log_complete
+from src.logger import time_since
+from src.count.crypt_contour import CryptContour, ContourFeatures
+from src.count.mask_rle import read_segmentation, segmentation_fps
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+SWEEP_MIN_CRYPT_SIZES = src.parameters.SWEEP_MIN_CRYPT_SIZES
+SWEEP_DEFECT_THRESHOLDS = src.parameters.SWEEP_DEFECT_THRESHOLDS
+
+
+class SweepContour:
+
+    __slots__ = ("features", "depths", "splits")
+
+    def __init__(self, cv2_contour, features=None):
+        """Contour of a blob whose splits are memoized across parameters. Its
+        ContourFeatures (area, hull, convexity defects and their depths, ...) are
+        computed once, and its split is computed once per distinct set of defects
+        deeper than the defect threshold, since that is all the split depends on
+        other than the minimum crypt size.
+        """
+        self.features = features if features is not None else ContourFeatures(cv2_contour)
+        self.depths = None
+        self.splits = {}
+
+    def split(self, defect_threshold):
+        """Returns the two SweepContours the contour is split into with the given
+        defect_threshold, regardless of their size, or None if it is not split.
+        """
+        if self.depths is None:
+            defects = self.features.all_defects
+            self.depths = defects[:, 0, 3] if defects is not None else np.empty(0)
+        key = tuple(np.flatnonzero(self.depths > 256 * defect_threshold))
+        if key not in self.splits:
+            # A min_crypt_size of 0 gives the split before the size checks
+            crypt_contour = CryptContour(
+                self.features.contour, defect_threshold, 0, features=self.features
+            )
+            split_crypt_contours = crypt_contour.split_crypt_contours()
+            self.splits[key] = (
+                [SweepContour(c.contour, c.features) for c in split_crypt_contours]
+                if split_crypt_contours
+                else None
+            )
+        return self.splits[key]
+
+    def count(self, min_crypt_size, defect_threshold):
+        """Returns the number of separated contours, as by
+        CryptContour.separated_contours with the given parameters.
+        """
+        if self.features.area < min_crypt_size:
+            return 0
+        split = self.split(defect_threshold)
+        # Only split if both halves are large enough
+        if split is None or any(c.features.area < min_crypt_size for c in split):
+            return 1
+        return sum(c.count(min_crypt_size, defect_threshold) for c in split)
+
+
+def sweep_segmentation(seg_fp, min_crypt_sizes, defect_thresholds):
+    """Returns a dict of the crypt count of the segmentation at seg_fp for each
+    (min_crypt_size, defect_threshold) pair. The contours are extracted once,
+    and the defects and splits are shared by all pairs.
+    """
+    seg_arr = read_segmentation(seg_fp)
+    unseparated_contours, _ = cv2.findContours(
+        seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+    )
+    sweep_contours = [SweepContour(c) for c in unseparated_contours]
+    return {
+        (min_crypt_size, defect_threshold): sum(
+            c.count(min_crypt_size, defect_threshold) for c in sweep_contours
+        )
+        for min_crypt_size, defect_threshold in itertools.product(
+            min_crypt_sizes, defect_thresholds
+        )
+    }
+
+
+def sweep_parameters(
+    seg_dir,
+    min_crypt_sizes=SWEEP_MIN_CRYPT_SIZES,
+    defect_thresholds=SWEEP_DEFECT_THRESHOLDS,
+):
+    """Returns a DataFrame of the crypt counts of each segmentation in seg_dir
+    (rows) for each MIN_CRYPT_SIZE and DEFECT_THRESHOLD pair (columns), with a
+    'Total' row.
+    """
+    start_time = time.time()
+    seg_fps = segmentation_fps(seg_dir)
+    logger.info(
+        f"Sweeping {len(min_crypt_sizes)} MIN_CRYPT_SIZE by {len(defect_thresholds)} DEFECT_THRESHOLD values on {len(seg_fps)} segmentations in {seg_dir}."
+    )
+    counts = {}
+    for seg_fp in seg_fps:
+        try:
+            counts[seg_fp.stem] = sweep_segmentation(
+                seg_fp, min_crypt_sizes, defect_thresholds
+            )
+        except Exception:
+            logger.exception(f"Error sweeping {seg_fp.name}. Skipping and moving on.")
+    table = pd.DataFrame.from_dict(counts, orient="index")
+    table.columns = pd.MultiIndex.from_tuples(
+        table.columns, names=["MIN_CRYPT_SIZE", "DEFECT_THRESHOLD"]
+    )
+    table.loc["Total"] = table.sum()
+    logger.info(f"Finished sweep in {time_since(start_time)}.")
+    return table
+
+
+def main():
+    """Sweeps MIN_CRYPT_SIZE and DEFECT_THRESHOLD on the segmentations of a trial
+    and saves the crypt counts to count_sweep.csv in the trial data folder.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("trial_dir", type=Path, help="Trial data folder.")
+    parser.add_argument(
+        "-m", "--min-crypt-sizes", nargs="+", type=int, default=SWEEP_MIN_CRYPT_SIZES
+    )
+    parser.add_argument(
+        "-d",
+        "--defect-thresholds",
+        nargs="+",
+        type=int,
+        default=SWEEP_DEFECT_THRESHOLDS,
+    )
+    args = parser.parse_args()
+    # Log to both the public and the trial log
+    setup_logger(LOG_FP)
+    add_trial_log(args.trial_dir / "log.log")
+    table = sweep_parameters(
+        args.trial_dir / "Slice Segmentations",
+        args.min_crypt_sizes,
+        args.defect_thresholds,
+    )
+    table_fp = args.trial_dir / "count_sweep.csv"
+    table.to_csv(table_fp)
+    logger.info(f"Saved crypt counts of sweep to {table_fp}.")
+    logger.info(f"Total crypt counts of sweep:\n{table.loc['Total'].unstack()}")
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
@@ -40,12 +40,40 @@ def count(folder_path, import_only=False):
     """Counts segmentations in 'Slice Segmentations' folder within folder path."""
 
     from src.count.crypt_count import process_segmentations, crypt_data_to_excel
+    from src.count.spatial import spatial_analytics_to_excel
 
     if import_only:
         return
     seg_dir = folder_path / "Slice Segmentations"
     process_segmentations(seg_dir)
-    crypt_data_to_excel(seg_dir / "crypt_data.pkl", folder_path)
+    crypt_data_to_excel(seg_dir / "crypt_data.json", folder_path)
+    spatial_analytics_to_excel(seg_dir, folder_path)
+
+
+def predict_and_count(folder_path, import_only=False):
+    """Runs AI predictions on images in 'Slice Images' folder within folder_path
+    and counts the crypts on each segmentation as soon as it is predicted."""
+
+    from src.count.crypt_count import process_predictions, crypt_data_to_excel
+    from src.count.spatial import spatial_analytics_to_excel
+
+    if import_only:
+        return
+    seg_dir = folder_path / "Slice Segmentations"
+    process_predictions(folder_path / "Slice Images", seg_dir)
+    crypt_data_to_excel(seg_dir / "crypt_data.json", folder_path)
+    spatial_analytics_to_excel(seg_dir, folder_path)
+
+
+def prepare_predict_and_count(folder_path, import_only=False):
+    """Prepares trial data at folder path, predicting and counting each slice as
+    soon as it is ready."""
+
+    from src.pipeline import run_pipeline
+
+    if import_only:
+        return
+    run_pipeline(folder_path)
 
 
 def run_crypt_gui(folder_path, import_only=False):
@@ -84,6 +112,7 @@ def enable_function(func_label):
 
 def correct_folder_structure(folder_path, function_labels):
     """Check that the expected folder structure exists."""
+    from src.count.mask_rle import segmentation_fps
 
     wsi_fp = Path(folder_path, "Whole Slide Images")
     thumbnail_fp = Path(wsi_fp, "Thumbnails")
@@ -92,7 +121,7 @@ def correct_folder_structure(folder_path, function_labels):
     svs_files_exist = len(list(folder_path.glob("*.svs"))) > 0
     wsi_files_exist = len(list(wsi_fp.glob("*.svs"))) > 0
     img_files_exist = len(list(img_fp.glob("*.png"))) > 0
-    seg_files_exist = len(list(seg_fp.glob("*.png"))) > 0
+    seg_files_exist = len(segmentation_fps(seg_fp)) > 0
     thumbnails_exist = len(list(thumbnail_fp.glob("*.png"))) > 0
     slice_csv_data_exists = Path(thumbnail_fp / "slide_crop_data.csv")
 
@@ -189,10 +218,20 @@ class ControlGUI(tk.Frame):
         # Create a new log in the trial directory
         add_trial_log(folder_path / "log.log")
         # Finally, run the functions.
-        for func_label in selected:
+        functions = [FUNC_MAP[func_label] for func_label in selected]
+        # If both predicting and counting, count the predictions as they are made.
+        if predict in functions and count in functions:
+            functions.remove(count)
+            functions[functions.index(predict)] = predict_and_count
+            # If also preparing, overlap all three in a pipeline.
+            if prepare in functions:
+                functions.remove(predict_and_count)
+                functions[functions.index(prepare)] = prepare_predict_and_count
+        for function in functions:
+            func_label = FUNC_MAP_R.get(function, function.__name__)
             logger.info(f"Running function: '{func_label}'.")
             try:
-                FUNC_MAP[func_label](folder_path)
+                function(folder_path)
             except Exception:
                 logger.exception(f"Error running function '{func_label}'.")
                 break
@@ -1,7 +1,6 @@
 import numpy as np
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
-import pickle
 import time
 import pandas as pd
 import ast
@@ -12,7 +11,14 @@ import random
 
 import src.parameters
 from src.count.excel import Excel
-from src.count.crypt_count import get_crypt_data
+from src.count.crypt_count import (
+    get_crypt_data,
+    count_segmentations,
+    save_crypt_data,
+    crypt_data_table,
+)
+from src.count.contour_store import ContourStore, convert_pkl_to_store
+from src.count.mask_rle import segmentation_fp, segmentation_fps
 from src.gui.image_canvas import ImageCanvas
 
 logger = logging.getLogger(__name__)
@@ -255,16 +261,24 @@ class CryptGUI(tk.Frame):
 
     @property
     def seg_filepath(self):
-        """Returns the filepath to the corresponding .png segmentation of the
-        current slice image.
+        """Returns the filepath to the corresponding segmentation of the
+        current slice image, its run-length encoded mask or .png file, whichever
+        is newer (see segmentation_fp).
         """
-        return self.seg_dir / (self.filename + ".png")
+        return segmentation_fp(self.seg_dir, self.filename)
 
     @property
     def pkl_path(self):
-        """Returns the filepath to the crypt_data.pkl file in seg_dir."""
+        """Returns the filepath to the legacy crypt_data.pkl file in seg_dir."""
         return self.seg_dir / "crypt_data.pkl"
 
+    @property
+    def store_path(self):
+        """Returns the filepath to the crypt_data.json contour store index in
+        seg_dir.
+        """
+        return self.seg_dir / "crypt_data.json"
+
     @property
     def filenames_in_dir(self):
         """Returns filename stems of all .png files in current directory sorted
@@ -384,7 +398,7 @@ class CryptGUI(tk.Frame):
             fp.name.replace("_0000", "")
             for fp in natsorted(self.directory.glob("*.png"))
         ]
-        segs = [fp.name for fp in natsorted(self.seg_dir.glob("*.png"))]
+        segs = [fp.stem + ".png" for fp in segmentation_fps(self.seg_dir)]
         diffs = [x for x in pngs if x not in segs]
         if diffs:
             logger.warning(
@@ -567,19 +581,18 @@ class CryptGUI(tk.Frame):
 
     def upload_seg(self):
         """Gets the segmentation data from current filepath."""
-        # First try loading from pkl
+        # First try loading from the contour store (reads only this slice)
         try:
-            with open(self.pkl_path, "rb") as file:
-                self.crypt_data = pickle.load(file)[self.filename]
-                # If the loaded crypt data was an error message, raise error
-                if type(self.crypt_data) == str:
-                    raise ValueError(
-                        "Loaded crypt_data was an error message: {self.crypt_data}"
-                    )
+            self.crypt_data = ContourStore(self.store_path)[self.filename]
+            # If the loaded crypt data was an error message, raise error
+            if type(self.crypt_data) == str:
+                raise ValueError(
+                    "Loaded crypt_data was an error message: {self.crypt_data}"
+                )
         # If that doesn't work, load directly from segmentation file.
         except Exception:
             logger.exception(
-                f"Could not load {self.filename} from crypt_data.pkl file. Loading directly from Slice Segmentations instead."
+                f"Could not load {self.filename} from crypt_data.json contour store. Loading directly from Slice Segmentations instead."
             )
             self.crypt_data = get_crypt_data(self.seg_filepath)
 
@@ -610,63 +623,47 @@ class CryptGUI(tk.Frame):
         self.image_canvas.draw_outlines()
 
     def preload_crypt_data(self):
-        """Preloads data into crypt_data.pkl if it doesn't already exist. Also
-        adds all this data to Excel file.
+        """Preloads data into the crypt_data.json contour store if it doesn't
+        already exist. Also adds all this data to Excel file.
         """
-        # If crypt_data.pkl already exists, exit.
-        if self.pkl_path.exists():
+        # If the contour store already exists, exit.
+        if self.store_path.exists():
             return
-        all_crypt_data = {}
-        # Go through all segmentations
-        filenames = [x for x in natsorted(self.seg_dir.glob("*.png"))]
-        length = len(filenames)
-        for i, fn in enumerate(filenames):
-            # Display which file is being preloaded in the filename box.
-            self.filename_str.set(f"Preloading {fn.stem} ({i + 1}/{length})...")
-            self.master.update()
-            # Save crypt data to all_crypt_data
+        # If a legacy crypt_data.pkl exists, convert it and exit.
+        if self.pkl_path.exists():
             try:
-                crypt_data = get_crypt_data(self.seg_dir / fn)
-            except Exception as e:
-                # If error occurs, save crypt_data as that error.
-                logger.exception(f"Error encountered while preloading {fn}.")
-                crypt_data = str(e)
-            all_crypt_data[fn.stem] = crypt_data
-        # Save dictionary as crypt_data.pkl
-        with open(self.pkl_path, "wb") as file:
-            pickle.dump(all_crypt_data, file, protocol=-1)
+                convert_pkl_to_store(self.pkl_path)
+                return
+            except Exception:
+                logger.exception(f"Error converting {self.pkl_path}. Preloading instead.")
+
+        def preloaded(i, length, fn):
+            # Display which file has been preloaded in the filename box.
+            self.filename_str.set(f"Preloading {fn.stem} ({i}/{length})...")
+            self.master.update()
+
+        # Go through all segmentations
+        logger.info(f"Preloading crypt data of segmentations in {self.seg_dir}.")
+        all_crypt_data = count_segmentations(
+            segmentation_fps(self.seg_dir), on_counted=preloaded
+        )
+        # Save dictionary as contour store
+        save_crypt_data(all_crypt_data, self.seg_dir)
         # Reset filename display
         self.filename_str.set(f"{self.filename}")
-        # Save all the pickled crypt data into Excel file
+        # Save all the preloaded crypt data into Excel file
         # Create excel in parent dir of the dir of the currently loaded file.
         try:
-            if not hasattr(self, "excel"):
-                # Create a new sheet with name Pre-Load (counter)
-                self.excel = Excel(self.directory.parent, f"Pre-Load ({self.counter})")
-            logger.info(f"Saving preloaded crypt data to {self.excel.filepath}.")
-            for fn in all_crypt_data:
-                # Get data and save to Excel
-                fn_crypt_data = all_crypt_data[fn]
-                # Handle if crypt_data load was an error
-                if type(fn_crypt_data) == str:
-                    mc = f"ERROR: {fn_crypt_data}"
-                    shape = st = sa = ss = ""
-                else:
-                    mc = len(fn_crypt_data["contours"])
-                    shape = str(fn_crypt_data["shape"])
-                    size_params = ["size_total", "size_av", "size_std"]
-                    st, sa, ss = (int(fn_crypt_data[x]) for x in size_params)
-                data = {
-                    "Filename": fn,
-                    "Model Count": mc,
-                    "Shape": shape,
-                    "Size Total": st,
-                    "Size Average": sa,
-                    "Size Stdev": ss,
-                }
-                self.excel.append(data)
-            # Now delete self.excel so data gets saved to a new sheet
-            del self.excel
+            table = crypt_data_table(all_crypt_data)
+            if hasattr(self, "excel"):
+                logger.info(f"Saving preloaded crypt data to {self.excel.filepath}.")
+                self.excel.append_table(table)
+                # Now delete self.excel so data gets saved to a new sheet
+                del self.excel
+            else:
+                # Create a new sheet with name Pre-Load (counter), all at once
+                excel = Excel(self.directory.parent, f"Pre-Load ({self.counter})", table)
+                logger.info(f"Saved preloaded crypt data to {excel.filepath}.")
             logger.info(f"Successfuly saved Excel file.")
         except Exception:
             logger.exception("Error saving preloaded crypt data to crypt_counts.xlsx")
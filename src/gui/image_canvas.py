@@ -4,6 +4,7 @@ import cv2
 from PIL import Image, ImageTk, ImageDraw
 
 import src.parameters
+from src.count.mask_rle import read_segmentation
 
 MAC_OS = src.parameters.MAC_OS
 CANVAS_COLOR = src.parameters.CANVAS_COLOR
@@ -12,14 +13,16 @@ CRYPT_COLOR = src.parameters.CRYPT_COLOR
 FIRST_CRYPT_COLOR = src.parameters.FIRST_CRYPT_COLOR
 PROBLEM_CRYPT_COLOR = src.parameters.PROBLEM_CRYPT_COLOR
 PROBLEM_COORD_RADIUS = src.parameters.PROBLEM_COORD_RADIUS
+LOD_MAX_SCREEN_ERROR = src.parameters.LOD_MAX_SCREEN_ERROR
 
 
 def seg_to_mask(seg):
-    """Given a binary labelmap segmentation .png, returns a 2D uint8 mask
-    (255 or 0) for pasting onto other images.
+    """Given a binary labelmap segmentation .png or run-length encoded mask (see
+    mask_rle.py), returns a 2D uint8 mask (255 or 0) for pasting onto other
+    images.
     """
     if type(seg) == str:
-        seg_arr = np.array(Image.open(seg)).astype(np.uint8)
+        seg_arr = read_segmentation(seg)
     elif type(seg) == Image.Image:
         seg_arr = np.array(seg).astype(np.uint8)
     elif type(seg) == np.ndarray:
@@ -51,6 +54,7 @@ class ImageCanvas:
         self.GUI = GUI
         self.outlines = []
         self.pil_image = None
+        self.lod_tolerance = None  # tolerance of the drawn contours (None if exact)
         self.hover_coords_display = tk.StringVar()
         self.hover_crypt_display = tk.StringVar()
 
@@ -63,7 +67,8 @@ class ImageCanvas:
             return
         # Draw the borders (and the first crypt borders)
         width = self.GUI.outline_width
-        contours = self.GUI.crypt_data["contours"]
+        self.lod_tolerance = self.zoom_lod_tolerance()
+        contours = self.display_contours()
         borders = np.zeros(self.GUI.crypt_data["shape"], dtype=np.uint8)
         first_borders = borders.copy()
         borders = cv2.drawContours(
@@ -82,6 +87,39 @@ class ImageCanvas:
         # Reload image now with new outlines
         self.redraw_image()
 
+    def zoom_lod_tolerance(self):
+        """Returns the largest simplification tolerance of the crypt contours
+        whose error is at most LOD_MAX_SCREEN_ERROR screen pixels at the current
+        zoom, or None if only the exact contours are precise enough.
+        """
+        tolerances = self.GUI.crypt_data.get("lod_contours", {})
+        # Screen pixels per image pixel
+        zoom = np.sqrt(abs(np.linalg.det(self.mat_affine[:2, :2])))
+        fine_enough = [t for t in tolerances if t * zoom <= LOD_MAX_SCREEN_ERROR]
+        return max(fine_enough) if fine_enough else None
+
+    def display_contours(self):
+        """Returns the crypt contours at the level of detail that is drawn. Counts,
+        sizes and picking crypts always use the exact contours.
+        """
+        lod_contours = self.GUI.crypt_data.get("lod_contours", {})
+        if self.lod_tolerance not in lod_contours:
+            return self.GUI.crypt_data["contours"]
+        return lod_contours[self.lod_tolerance]
+
+    def redraw_at_zoom(self):
+        """Redraws the image, and also the outlines if the zoom changed the level
+        of detail of the crypt contours.
+        """
+        if (
+            self.GUI.outline_width
+            and self.GUI.crypt_data
+            and self.zoom_lod_tolerance() != self.lod_tolerance
+        ):
+            self.draw_outlines()
+        else:
+            self.redraw_image()
+
     def erase_outlines(self):
         """Deletes all outlines (and crypt highlights) drawn on image."""
         # Reset image by replacing it with a copy of the original image.
@@ -103,7 +141,7 @@ class ImageCanvas:
         coords = [x for x in labels if type(x) == tuple]
         labels = [x for x in labels if type(x) != tuple]
         # Highlight the crypt(s) specified by the indices
-        contours_to_draw = [self.GUI.crypt_data["contours"][i - 1] for i in labels]
+        contours_to_draw = [self.display_contours()[i - 1] for i in labels]
         crypt_to_draw = np.zeros(self.GUI.crypt_data["shape"], dtype=np.uint8)
         crypt_to_draw = cv2.drawContours(
             crypt_to_draw,
@@ -172,7 +210,7 @@ class ImageCanvas:
         if self.pil_image == None:
             return
         self.zoom_fit(self.pil_image.width, self.pil_image.height)
-        self.redraw_image()
+        self.redraw_at_zoom()
 
     def mouse_wheel(self, event):
         """マウスホイールを回した"""
@@ -188,7 +226,7 @@ class ImageCanvas:
                 self.rotate_at(-5, event.x, event.y)
             else:
                 self.rotate_at(5, event.x, event.y)
-        self.redraw_image()
+        self.redraw_at_zoom()
 
     def mouse_hover(self, event):
         """Displays the crypt label of the hovered pixel (if any) and
@@ -213,7 +251,9 @@ class ImageCanvas:
         self.draw_outlines()
 
     def get_crypt_label(self, coords):
-        """Returns the display label of the crypt at the given coords."""
+        """Returns the display label of the crypt at the given coords, testing
+        against the exact contours (the simplified ones are only drawn).
+        """
         for i, contour in enumerate(self.GUI.crypt_data["contours"]):
             # For each contour, test if coords are within it.
             result = cv2.pointPolygonTest(contour, coords, False)
@@ -153,3 +153,56 @@ def line_segments_intersect(p1, q1, p2, q2):
 
     # If none of the cases
     return False
+
+
+# Vectorized versions of the above, testing one line segment against many
+
+
+def orientations(p, q, r):
+    """Returns the orientation of each ordered triplet (p, q, r) like orientation,
+    where each of p, q and r is a single (x, y) point or an (n, 2) array of them.
+    """
+    p, q, r = (np.asarray(a, dtype=np.float64) for a in (p, q, r))
+    val = (q[..., 1] - p[..., 1]) * (r[..., 0] - q[..., 0]) - (
+        q[..., 0] - p[..., 0]
+    ) * (r[..., 1] - q[..., 1])
+    # 1 : Clockwise, 2 : Counterclockwise, 0 : Collinear
+    return np.where(val > 0, 1, np.where(val < 0, 2, 0))
+
+
+def on_segments(p, q, r):
+    """Returns whether each point q lies within the bounding box of segment pr
+    like onSegment, with the points given as in orientations.
+    """
+    p, q, r = (np.asarray(a) for a in (p, q, r))
+    return np.all((q <= np.maximum(p, r)) & (q >= np.minimum(p, r)), axis=-1)
+
+
+def angles_between_vectors(a, b):
+    """Returns the angles (in degrees) between the vectors a and b (arrays of
+    shape (..., 2)) like angle_between_vectors. Angles with a zero vector are NaN.
+    """
+    dot_product = np.sum(a * b, axis=-1)
+    magnitudes = np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosine_angle = dot_product / magnitudes
+    return np.degrees(np.arccos(np.clip(cosine_angle, -1.0, 1.0)))
+
+
+def line_segment_intersects_segments(p1, q1, p2s, q2s):
+    """Returns a boolean array of whether the line segment p1q1 intersects each
+    of the line segments p2sq2s (arrays of shape (n, 2)), with the same general
+    and collinear special cases as line_segments_intersect.
+    """
+    o1 = orientations(p1, q1, p2s)
+    o2 = orientations(p1, q1, q2s)
+    o3 = orientations(p2s, q2s, p1)
+    o4 = orientations(p2s, q2s, q1)
+    # General case
+    intersects = (o1 != o2) & (o3 != o4)
+    # Special cases, where a segment end is collinear with and on the other
+    intersects |= (o1 == 0) & on_segments(p1, p2s, q1)
+    intersects |= (o2 == 0) & on_segments(p1, q2s, q1)
+    intersects |= (o3 == 0) & on_segments(p2s, p1, q2s)
+    intersects |= (o4 == 0) & on_segments(p2s, q1, q2s)
+    return intersects
@@ -29,6 +29,14 @@ def crop_label(labeled_img, label, return_binary_mask=True, return_bbox=False, p
         return cropped_blob
 
 
+def tissue_mask(img, threshold):
+    """Returns the binary mask (np.array) of the tissue in the given PIL image,
+    i.e. of all pixels with grayscale intensity below threshold.
+    """
+    arr = np.array(img.convert("L"), dtype=np.uint8)
+    return arr < threshold
+
+
 def labelmap(blob_mask, return_sizes=False, connectivity=4):
     """Returns a labelmap with given connectivity of given binary mask. If
     desired, returns the sizes of all labels including bkgd (always 0th label).
@@ -22,10 +22,65 @@ ENV_VARS = {
     "nnUNet_preprocessed": r"C:\Users\Public\AutoCryptCount\nnUNet_preprocessed",
     "nnUNet_results": r"C:\Users\Public\AutoCryptCount\nnUNet_results",
 }
+NNUNET_FOLDS = (0, 1, 2, 3, 4)  # folds to ensemble, e.g. (0,) for single-fold predictions
+NNUNET_STEP_SIZE = 0.5  # sliding-window step as fraction of patch size (larger is faster, max 1)
+NNUNET_PREDICTOR = "command"  # or "in-process" to use predictor.py and its options below
+RESOURCE_SAMPLE_INTERVAL = 30  # seconds between resource samples of the predict command
+
+# predictor.py
+SKIP_BACKGROUND_PATCHES = True  # skip sliding-window patches without tissue
+TILED_PREDICTION_MIN_PIXELS = 6000 * 6000  # predict larger slices in macro-tiles
+MACRO_TILE_SIZE = 4096  # side length of macro-tiles in pixels (bounds peak memory)
+MACRO_TILE_OVERLAP = 512  # overlap of neighbouring macro-tiles in pixels
+PATCH_BATCH_SIZE = 8  # patches per network pass when batching small slices (0 disables)
+BATCH_MAX_PIXELS = 2500 * 2500  # slices up to this size are batched together
+BATCH_MAX_SLICES = 16  # max number of slices whose patches are batched together
+PREPROCESSING_CACHE = True  # cache preprocessed slice images in nnUNet_preprocessed
+
+# preprocessing_cache.py
+PREPROCESSING_CACHE_MAX_GB = 20  # least recently used entries are evicted beyond this size
+
+# calibrate.py
+CALIBRATION_SAMPLE_SIZE = 5  # number of slice images to run calibrations on
+CALIBRATION_STEP_SIZES = (0.5, 0.6, 0.75, 0.9, 1.0)  # step sizes to sweep, first is reference
+CALIBRATION_MIN_DICE = 0.98  # min mean Dice with reference for an acceptable step size
+CALIBRATION_MAX_COUNT_DIFF = 1.0  # max mean absolute crypt count difference with reference
+
+# pipeline.py
+PIPELINE_PREDICT_WORKERS = 1  # predictor threads, each loads the model (e.g. one per GPU)
+PIPELINE_COUNT_WORKERS = 2  # counting processes
+PIPELINE_QUEUE_SIZE = 8  # slices waiting per stage before the previous stage waits
+
+# crypt_count.py
+COUNT_WORKERS = 4  # processes counting segmentations in parallel (1 counts in this process)
+COUNT_CHUNK_SIZE = 4  # segmentations submitted to a counting process at a time
+COUNT_PROGRESS_INTERVAL = 10  # min seconds between progress logs while counting
+COUNT_CACHE = True  # only recount segmentations changed since they were last counted
+LOD_TOLERANCES = (1, 4, 16)  # approxPolyDP tolerances in pixels of simplified display contours
+SPLIT_ENGINE = "defects"  # or "watershed" to split touching crypts with split_engines.py
+SPLIT_REPORT_SIZE = 10  # slowest blobs to split logged after counting, with their complexity
+
+# split_engines.py
+WATERSHED_PEAK_FRACTION = 0.6  # crypt centres are where the distance to the border is this fraction of its max
+
+# strip_extraction.py
+STRIP_HEIGHT = 256  # rows of a segmentation decoded at a time when counting in strips
+STRIP_MIN_AREA = 50_000_000  # pixels of segmentations large enough to count in strips
+
+# spatial.py
+SPATIAL_NEIGHBOURS = 5  # k of the k-nearest-neighbour distances of each crypt
+SPATIAL_DENSITY_RADIUS = 500  # radius in pixels within which local crypt density is counted
+SPATIAL_GRID_SIZE = 250  # pixels between the points of the crypt density map of a slice
 
 # crypt_contour.py
 MIN_CRYPT_SIZE = 2000  # area in pixels
 DEFECT_THRESHOLD = 10  # length in pixels
+CONVEX_SOLIDITY = None  # e.g. 0.98 to not split blobs at least this solid, faster but may miss shallow waists (None disables)
+SPLIT_BUDGET = 2_000_000  # max defect pairs x points searched to split a contour, above it only the deepest defects are paired
+
+# sweep.py
+SWEEP_MIN_CRYPT_SIZES = tuple(range(1000, 3500, 250))  # MIN_CRYPT_SIZE values to sweep
+SWEEP_DEFECT_THRESHOLDS = tuple(range(4, 24, 2))  # DEFECT_THRESHOLD values to sweep
 
 # image_canvas.py
 CANVAS_COLOR = "black"
@@ -34,3 +89,4 @@ CRYPT_COLOR = "#89FC00"
 FIRST_CRYPT_COLOR = "#00ffc1"
 PROBLEM_CRYPT_COLOR = (255, 0, 0, 128)
 PROBLEM_COORD_RADIUS = 100
+LOD_MAX_SCREEN_ERROR = 1  # max error in screen pixels of simplified displayed contours
@@ -0,0 +1,223 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from natsort import natsorted
+
+import src.parameters
+from src.logger import time_since
+from src.prepare.process_trial_data import process_trial_data
+from src.count.crypt_count import (
+    count_key,
+    load_crypt_data,
+    log_slowest_contours,
+    process_segmentations,
+    save_crypt_data,
+    crypt_data_to_excel,
+)
+from src.count.spatial import spatial_analytics_to_excel
+
+logger = logging.getLogger(__name__)
+
+NNUNET_PREDICTOR = src.parameters.NNUNET_PREDICTOR
+PIPELINE_PREDICT_WORKERS = src.parameters.PIPELINE_PREDICT_WORKERS
+PIPELINE_COUNT_WORKERS = src.parameters.PIPELINE_COUNT_WORKERS
+PIPELINE_QUEUE_SIZE = src.parameters.PIPELINE_QUEUE_SIZE
+
+
+def run_pipeline(trial_dir):
+    """Prepares, predicts and counts the trial data in trial_dir. With in-process
+    predictions, the three stages overlap in a TrialPipeline. Otherwise, they run
+    one after the other.
+    """
+    trial_dir = Path(trial_dir)
+    if NNUNET_PREDICTOR == "in-process":
+        TrialPipeline(trial_dir).run()
+        return
+    from src.predict.predict import run_predictions
+
+    seg_dir = trial_dir / "Slice Segmentations"
+    process_trial_data(trial_dir)
+    run_predictions(trial_dir / "Slice Images", seg_dir)
+    process_segmentations(seg_dir)
+    crypt_data_to_excel(seg_dir / "crypt_data.json", trial_dir)
+    spatial_analytics_to_excel(seg_dir, trial_dir)
+
+
+class TrialPipeline:
+
+    def __init__(
+        self,
+        trial_dir,
+        predict_workers=PIPELINE_PREDICT_WORKERS,
+        count_workers=PIPELINE_COUNT_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+    ):
+        """Scheduler that overlaps preparing, predicting and counting the trial
+        data in trial_dir. Each slice image is predicted as soon as it is saved
+        and each segmentation is counted as soon as it is predicted, with
+        predict_workers predictor threads and count_workers counting processes.
+        Each stage holds at most queue_size slices waiting for the next stage,
+        beyond which the previous stage waits (backpressure).
+        """
+        self.trial_dir = Path(trial_dir)
+        self.slice_dir = self.trial_dir / "Slice Images"
+        self.seg_dir = self.trial_dir / "Slice Segmentations"
+        self.predict_workers = predict_workers
+        self.count_workers = count_workers
+        self.predict_queue = queue.Queue(maxsize=queue_size)
+        self.count_queue = queue.Queue(maxsize=queue_size)
+        self.count_slots = threading.BoundedSemaphore(count_workers)
+        self.queued = set()  # slice images queued for prediction
+        self.all_crypt_data = {}
+        self.keys = {}  # count keys of the saved segmentations
+        self.failed = []
+        self.busy = {"prepare": 0.0, "predict": 0.0, "count": 0.0}
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Runs the pipeline, leaving the trial folder as the prepare, predict and
+        count functions do when run one after the other.
+        """
+        start_time = time.time()
+        logger.info(
+            f"Running pipeline with {self.predict_workers} predict and {self.count_workers} count workers in {self.trial_dir}."
+        )
+        self.seg_dir.mkdir(parents=True, exist_ok=True)
+        predictors = [
+            threading.Thread(target=self.predict_worker, name=f"predict_{i}")
+            for i in range(self.predict_workers)
+        ]
+        counter = threading.Thread(target=self.count_worker, name="count")
+        for thread in predictors + [counter]:
+            thread.start()
+        try:
+            prepare_start = time.time()
+            self.prepare()
+            # Also predict any slice images that were already there
+            for img_fp in natsorted(self.slice_dir.glob("*_0000.png")):
+                self.enqueue(img_fp)
+            self.busy["prepare"] = time.time() - prepare_start
+        finally:
+            # Let each stage finish its queue before stopping the next
+            for _ in predictors:
+                self.predict_queue.put(None)
+            for thread in predictors:
+                thread.join()
+            self.count_queue.put(None)
+            counter.join()
+        log_slowest_contours(self.all_crypt_data)
+        # Errors and unsaved segmentations are not cached, so that they are recounted
+        keys = {
+            fn: key
+            for fn, key in self.keys.items()
+            if fn in self.all_crypt_data and type(self.all_crypt_data[fn]) != str
+        }
+        save_crypt_data(self.all_crypt_data, self.seg_dir, keys)
+        crypt_data_to_excel(self.seg_dir / "crypt_data.json", self.trial_dir)
+        spatial_analytics_to_excel(self.seg_dir, self.trial_dir)
+        if self.failed:
+            logger.error(f"Pipeline failed for {len(self.failed)} slices: {self.failed}")
+        logger.info(
+            f"Finished pipeline of {len(self.queued)} slices in {time_since(start_time)} (busy time of stages: "
+            + ", ".join(f"{stage} {round(t)} s" for stage, t in self.busy.items())
+            + ")."
+        )
+
+    def prepare(self):
+        """Prepares the trial data, queueing each slice image for prediction as
+        soon as it is saved.
+        """
+        process_trial_data(self.trial_dir, on_slice_saved=self.enqueue)
+
+    def enqueue(self, img_fp):
+        """Queues the slice image at img_fp for prediction, waiting while the
+        predict queue is full.
+        """
+        img_fp = Path(img_fp)
+        if img_fp in self.queued or not img_fp.name.endswith("_0000.png"):
+            return
+        self.queued.add(img_fp)
+        self.predict_queue.put(img_fp)
+
+    def predict_worker(self):
+        """Predicts queued slice images until stopped, saving each segmentation
+        in the background and queueing it for counting.
+        """
+        from src.predict.predictor import segmentation_filename
+
+        try:
+            predictor = self.load_predictor()
+        except Exception:
+            logger.exception("Error loading predictor. Skipping predictions.")
+            predictor = None
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            while (img_fp := self.predict_queue.get()) is not None:
+                if predictor is None:
+                    self.failed.append(img_fp.name)
+                    continue
+                predict_start = time.time()
+                try:
+                    seg, properties = predictor.predict_slice(img_fp)
+                except Exception:
+                    logger.exception(
+                        f"Error predicting {img_fp.name}. Skipping and moving on."
+                    )
+                    self.failed.append(img_fp.name)
+                    continue
+                seg_fp = self.seg_dir / segmentation_filename(img_fp)
+                writer.submit(self.save_segmentation, predictor, seg, properties, seg_fp)
+                with self.lock:
+                    self.busy["predict"] += time.time() - predict_start
+                logger.info(f"Predicted {img_fp.name} in {time_since(predict_start)}.")
+                self.count_queue.put((seg_fp, seg[0]))
+
+    def load_predictor(self):
+        """Returns a new predictor of slice images for a predict worker."""
+        from src.predict.predictor import CryptPredictor
+
+        return CryptPredictor()
+
+    def save_segmentation(self, predictor, seg, properties, seg_fp):
+        """Saves the segmentation .png file and computes its count key, logging
+        any error.
+        """
+        try:
+            predictor.save_segmentation(seg, properties, seg_fp)
+            key = count_key(seg_fp)
+            with self.lock:
+                self.keys[seg_fp.stem] = key
+        except Exception:
+            logger.exception(f"Error saving segmentation {seg_fp.name}.")
+            self.failed.append(seg_fp.name)
+
+    def count_worker(self):
+        """Counts queued segmentations in a pool of processes until stopped."""
+        # Spawn processes so that they do not inherit the predictor threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.count_workers, mp_context=context) as pool:
+            while (item := self.count_queue.get()) is not None:
+                seg_fp, seg_arr = item
+                # Wait for a free slot so that counting also applies backpressure
+                self.count_slots.acquire()
+                future = pool.submit(load_crypt_data, seg_arr, seg_fp)
+                future.add_done_callback(
+                    lambda f, seg_fp=seg_fp, start=time.time(): self.counted(
+                        f, seg_fp, start
+                    )
+                )
+
+    def counted(self, future, seg_fp, start_time):
+        """Stores the crypt data of a counted segmentation."""
+        self.count_slots.release()
+        try:
+            crypt_data = future.result()
+        except Exception as e:
+            logger.error(f"Error counting {seg_fp.name}: {e}")
+            crypt_data = str(e)
+        with self.lock:
+            self.all_crypt_data[seg_fp.stem] = crypt_data
+            self.busy["count"] += time.time() - start_time
@@ -0,0 +1,281 @@
+import argparse
+import logging
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from natsort import natsorted
+import numpy as np
+from PIL import Image
+
+import src.parameters
+from src.logger import setup_logger, add_trial_log, summarize_warnings, log_complete
+from src.predict.predict import run_predictions
+from src.count.crypt_count import get_crypt_data
+
+logger = logging.getLogger(__name__)
+
+LOG_FP = src.parameters.LOG_FP
+NNUNET_FOLDS = src.parameters.NNUNET_FOLDS
+NNUNET_STEP_SIZE = src.parameters.NNUNET_STEP_SIZE
+CALIBRATION_SAMPLE_SIZE = src.parameters.CALIBRATION_SAMPLE_SIZE
+CALIBRATION_STEP_SIZES = src.parameters.CALIBRATION_STEP_SIZES
+CALIBRATION_MIN_DICE = src.parameters.CALIBRATION_MIN_DICE
+CALIBRATION_MAX_COUNT_DIFF = src.parameters.CALIBRATION_MAX_COUNT_DIFF
+BATCH_MAX_PIXELS = src.parameters.BATCH_MAX_PIXELS
+BATCH_MAX_SLICES = src.parameters.BATCH_MAX_SLICES
+
+
+def sample_slice_images(
+    slice_images_dirpath, sample_size=CALIBRATION_SAMPLE_SIZE, max_pixels=None
+):
+    """Returns a reproducible random sample of the .png filepaths in
+    slice_images_dirpath, sorted alphanumerically. If max_pixels is given, only
+    samples images of up to that many pixels.
+    """
+    fps = natsorted(Path(slice_images_dirpath).glob("*.png"))
+    if max_pixels:
+        fps = [fp for fp in fps if np.prod(Image.open(fp).size) <= max_pixels]
+    rng = random.Random(2)  # fixed random seed so calibrations are comparable
+    return natsorted(rng.sample(fps, min(sample_size, len(fps))))
+
+
+def copy_sample(sample_fps, work_dir):
+    """Copies the sampled slice images into a 'Slice Images' folder in work_dir
+    and returns the path to that folder.
+    """
+    sample_dir = Path(work_dir, "Slice Images")
+    sample_dir.mkdir()
+    for fp in sample_fps:
+        shutil.copy(fp, sample_dir / fp.name)
+    return sample_dir
+
+
+def time_predictions(sample_dir, seg_dir, **kwargs):
+    """Runs predictions on sample_dir into seg_dir with the given run_predictions
+    kwargs and returns the wall time in seconds. The preprocessing cache is not
+    used, so that earlier runs do not speed up the later ones.
+    """
+    start_time = time.time()
+    run_predictions(sample_dir, seg_dir, cache=False, **kwargs)
+    return time.time() - start_time
+
+
+def dice(seg_fp1, seg_fp2):
+    """Returns the Dice coefficient of the two binary segmentation .png files."""
+    arr1 = np.array(Image.open(seg_fp1).convert("L"), dtype=bool)
+    arr2 = np.array(Image.open(seg_fp2).convert("L"), dtype=bool)
+    total = arr1.sum() + arr2.sum()
+    # Two empty segmentations agree perfectly
+    if total == 0:
+        return 1.0
+    return 2 * np.logical_and(arr1, arr2).sum() / total
+
+
+def count_crypts(seg_dir):
+    """Returns a dict of the crypt count of each segmentation in seg_dir."""
+    counts = {}
+    for seg_fp in natsorted(Path(seg_dir).glob("*.png")):
+        counts[seg_fp.stem] = len(get_crypt_data(seg_fp)["contours"])
+    return counts
+
+
+def calibrate_folds(trial_dir, folds, sample_size=CALIBRATION_SAMPLE_SIZE):
+    """Runs predictions with the full fold ensemble (NNUNET_FOLDS) and with the
+    given subset of folds on a sample of the trial's slice images. Logs the
+    per-slice crypt count differences and the prediction times, and returns the
+    per-slice report as a list of dicts.
+    """
+    slice_images_dirpath = Path(trial_dir, "Slice Images")
+    sample_fps = sample_slice_images(slice_images_dirpath, sample_size)
+    logger.info(
+        f"Calibrating folds {tuple(folds)} against ensemble {tuple(NNUNET_FOLDS)} on {len(sample_fps)} slices: {[fp.name for fp in sample_fps]}"
+    )
+    times, counts = {}, {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample_dir = copy_sample(sample_fps, work_dir)
+        for name, run_folds in [("ensemble", NNUNET_FOLDS), ("subset", folds)]:
+            seg_dir = Path(work_dir, name)
+            times[name] = time_predictions(sample_dir, seg_dir, folds=run_folds)
+            counts[name] = count_crypts(seg_dir)
+    # Compare the crypt counts slice by slice
+    report = []
+    for fn, ensemble_count in counts["ensemble"].items():
+        subset_count = counts["subset"].get(fn)
+        diff = subset_count - ensemble_count if subset_count is not None else "n/a"
+        report.append(
+            {
+                "Filename": fn,
+                "Ensemble Count": ensemble_count,
+                "Subset Count": subset_count,
+                "Difference": diff,
+            }
+        )
+        logger.info(
+            f"     {fn}: ensemble {ensemble_count}, subset {subset_count}, difference {diff}"
+        )
+    # Summarize the speed/accuracy trade-off
+    diffs = [abs(row["Difference"]) for row in report if row["Difference"] != "n/a"]
+    if diffs:
+        logger.info(
+            f"Mean absolute count difference {sum(diffs) / len(diffs):.2f}, max {max(diffs)}."
+        )
+    else:
+        logger.warning("No slices could be compared between ensemble and subset.")
+    logger.info(
+        f"Prediction time: ensemble {round(times['ensemble'])} s, subset {round(times['subset'])} s ({times['ensemble'] / max(times['subset'], 1e-6):.1f}x speedup)."
+    )
+    return report
+
+
+def calibrate_step_size(
+    trial_dir,
+    step_sizes=CALIBRATION_STEP_SIZES,
+    sample_size=CALIBRATION_SAMPLE_SIZE,
+    min_dice=CALIBRATION_MIN_DICE,
+    max_count_diff=CALIBRATION_MAX_COUNT_DIFF,
+):
+    """Sweeps the sliding-window step sizes on a sample of the trial's slice
+    images, measuring the prediction wall time and the Dice and crypt count
+    agreement with the first (reference) step size. Chooses the fastest step size
+    with a mean Dice of at least min_dice and a mean absolute crypt count
+    difference of at most max_count_diff, records it in the log, and returns it
+    along with the sweep results as a list of dicts.
+    """
+    slice_images_dirpath = Path(trial_dir, "Slice Images")
+    sample_fps = sample_slice_images(slice_images_dirpath, sample_size)
+    logger.info(
+        f"Calibrating step sizes {tuple(step_sizes)} on {len(sample_fps)} slices: {[fp.name for fp in sample_fps]}"
+    )
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample_dir = copy_sample(sample_fps, work_dir)
+        ref_dir = None
+        for step_size in step_sizes:
+            seg_dir = Path(work_dir, f"step_{step_size}")
+            seconds = time_predictions(sample_dir, seg_dir, step_size=step_size)
+            counts = count_crypts(seg_dir)
+            # The first step size is the reference for all others
+            if ref_dir is None:
+                ref_dir, ref_counts = seg_dir, counts
+            common = [fn for fn in counts if fn in ref_counts]
+            dices = [dice(ref_dir / f"{fn}.png", seg_dir / f"{fn}.png") for fn in common]
+            count_diffs = [abs(counts[fn] - ref_counts[fn]) for fn in common]
+            result = {
+                "Step Size": step_size,
+                "Time [s]": round(seconds, 1),
+                "Mean Dice": float(np.mean(dices)) if common else 0.0,
+                "Mean Count Difference": float(np.mean(count_diffs)) if common else np.inf,
+            }
+            results.append(result)
+            logger.info(
+                f"     Step size {step_size}: {result['Time [s]']} s, mean Dice {result['Mean Dice']:.4f}, mean absolute count difference {result['Mean Count Difference']:.2f}"
+            )
+    # Choose the fastest step size that still agrees with the reference
+    acceptable = [
+        r
+        for r in results
+        if r["Mean Dice"] >= min_dice and r["Mean Count Difference"] <= max_count_diff
+    ]
+    if not acceptable:
+        logger.warning("No step size could be calibrated. Keeping current step size.")
+        return NNUNET_STEP_SIZE, results
+    chosen = min(acceptable, key=lambda r: r["Time [s]"])["Step Size"]
+    logger.info(
+        f"Chosen step size: NNUNET_STEP_SIZE = {chosen} (currently {NNUNET_STEP_SIZE} in parameters.py)."
+    )
+    return chosen, results
+
+
+def benchmark_batching(
+    trial_dir, sample_size=4 * CALIBRATION_SAMPLE_SIZE, predictor=None
+):
+    """Benchmarks the in-process prediction throughput of a sample of the
+    trial's small slices (up to BATCH_MAX_PIXELS), predicted one at a time and
+    with their patches batched together by predictor (a new CryptPredictor by
+    default). Logs and returns the throughputs in images per minute.
+    """
+    from src.predict.predictor import CryptPredictor
+
+    slice_images_dirpath = Path(trial_dir, "Slice Images")
+    sample_fps = sample_slice_images(slice_images_dirpath, sample_size, BATCH_MAX_PIXELS)
+    if not sample_fps:
+        logger.warning(f"No slices of up to {BATCH_MAX_PIXELS} pixels to benchmark.")
+        return
+    logger.info(f"Benchmarking batched predictions on {len(sample_fps)} small slices.")
+    if predictor is None:
+        predictor = CryptPredictor()
+    # Fill the preprocessing cache first so that both runs hit it alike
+    if predictor.cache is not None:
+        for fp in sample_fps:
+            predictor.preprocess_slice(fp)
+    # Predict one at a time
+    start_time = time.time()
+    for fp in sample_fps:
+        predictor.predict_slice(fp)
+    single_seconds = time.time() - start_time
+    # Predict in batched groups
+    start_time = time.time()
+    for i in range(0, len(sample_fps), BATCH_MAX_SLICES):
+        predictor.predict_slices_batched(sample_fps[i : i + BATCH_MAX_SLICES])
+    batched_seconds = time.time() - start_time
+    throughputs = {
+        "single": 60 * len(sample_fps) / single_seconds,
+        "batched": 60 * len(sample_fps) / batched_seconds,
+    }
+    logger.info(
+        f"Throughput: one at a time {throughputs['single']:.1f} images/minute, batched {throughputs['batched']:.1f} images/minute ({single_seconds / batched_seconds:.1f}x speedup)."
+    )
+    return throughputs
+
+
+def main():
+    """Command line entry point for the prediction calibrations."""
+    parser = argparse.ArgumentParser(
+        description="Calibrate auto-crypt-count predictions on a trial data folder."
+    )
+    subparsers = parser.add_subparsers(dest="calibration", required=True)
+    folds_parser = subparsers.add_parser(
+        "folds", help="Compare a subset of folds against the full fold ensemble."
+    )
+    folds_parser.add_argument("trial_dir", type=Path, help="Trial data folder.")
+    folds_parser.add_argument(
+        "-f", "--folds", nargs="+", type=int, required=True, help="Folds to compare."
+    )
+    folds_parser.add_argument(
+        "-n", "--sample-size", type=int, default=CALIBRATION_SAMPLE_SIZE
+    )
+    step_parser = subparsers.add_parser(
+        "step-size", help="Sweep sliding-window step sizes and choose the fastest."
+    )
+    step_parser.add_argument("trial_dir", type=Path, help="Trial data folder.")
+    step_parser.add_argument(
+        "-s", "--step-sizes", nargs="+", type=float, default=CALIBRATION_STEP_SIZES
+    )
+    step_parser.add_argument(
+        "-n", "--sample-size", type=int, default=CALIBRATION_SAMPLE_SIZE
+    )
+    batching_parser = subparsers.add_parser(
+        "batching", help="Benchmark batched in-process predictions of small slices."
+    )
+    batching_parser.add_argument("trial_dir", type=Path, help="Trial data folder.")
+    batching_parser.add_argument(
+        "-n", "--sample-size", type=int, default=4 * CALIBRATION_SAMPLE_SIZE
+    )
+    args = parser.parse_args()
+    # Log to both the public and the trial log
+    setup_logger(LOG_FP)
+    add_trial_log(args.trial_dir / "log.log")
+    if args.calibration == "folds":
+        calibrate_folds(args.trial_dir, args.folds, args.sample_size)
+    elif args.calibration == "step-size":
+        calibrate_step_size(args.trial_dir, args.step_sizes, args.sample_size)
+    elif args.calibration == "batching":
+        benchmark_batching(args.trial_dir, args.sample_size)
+    summarize_warnings()
+    log_complete()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import subprocess
 import logging
 import os
+import re
+import threading
 from pathlib import Path
 import time
 from natsort import natsorted
@@ -14,15 +16,41 @@ from src.logger import time_since
 # Check that nnUNetv2 is indeed installed, ModuleNotFoundError otherwise
 if not importlib.util.find_spec("nnunetv2"):
     raise ModuleNotFoundError("Moduel nnunetv2 was not found.")
+# psutil is optional, without it only the elapsed time of commands is monitored
+PSUTIL_AVAILABLE = bool(importlib.util.find_spec("psutil"))
+if PSUTIL_AVAILABLE:
+    import psutil
 
 logger = logging.getLogger(__name__)
 
 ENV_VARS = src.parameters.ENV_VARS
 NNUNET_DATASET = src.parameters.NNUNET_DATASET
+NNUNET_FOLDS = src.parameters.NNUNET_FOLDS
+NNUNET_STEP_SIZE = src.parameters.NNUNET_STEP_SIZE
+NNUNET_PREDICTOR = src.parameters.NNUNET_PREDICTOR
+RESOURCE_SAMPLE_INTERVAL = src.parameters.RESOURCE_SAMPLE_INTERVAL
+PREPROCESSING_CACHE = src.parameters.PREPROCESSING_CACHE
 
 
-def run_predictions(slice_images_dirpath):
-    """Runs predictions on images in slice_images_dirpath."""
+def run_predictions(
+    slice_images_dirpath,
+    segmentations_dirpath=None,
+    folds=NNUNET_FOLDS,
+    step_size=NNUNET_STEP_SIZE,
+    on_segmentation=None,
+    on_saved=None,
+    cache=PREPROCESSING_CACHE,
+):
+    """Runs predictions on images in slice_images_dirpath, ensembling the given
+    folds of the trained model with the given sliding-window step size.
+    Segmentations are saved to segmentations_dirpath, defaulting to 'Slice
+    Segmentations' next to slice_images_dirpath. Predicts with the nnUNetv2_predict
+    command or in-process depending on NNUNET_PREDICTOR. In-process, the function
+    on_segmentation(seg_fp, seg_arr) is called with each segmentation array as
+    soon as it is predicted, and on_saved(seg_fp) once its .png file is written.
+    Preprocessed slice images are only cached in-process, if cache. Returns the
+    return code of the predictions (0 if successful).
+    """
     # First delete any files starting with '.' in slice_images_dirpath
     hidden_files = natsorted(slice_images_dirpath.glob(".*"))
     if hidden_files:
@@ -43,30 +71,182 @@ def run_predictions(slice_images_dirpath):
             f"Detected non-png files in Slice Images directory: {[x.name for x in non_png_files]}"
         )
     # Finally run the predict command
-    segmentations_dirpath = Path(slice_images_dirpath).parent / "Slice Segmentations"
-    cmd = f'nnUNetv2_predict -i "{slice_images_dirpath}" -o "{segmentations_dirpath}" -d {NNUNET_DATASET} -c 2d'
-    run_command(cmd, env_vars=ENV_VARS)
+    if segmentations_dirpath is None:
+        segmentations_dirpath = Path(slice_images_dirpath).parent / "Slice Segmentations"
+    folds_str = " ".join(str(f) for f in folds)
+    logger.info(f"Predicting with folds: {folds_str} and step size: {step_size}")
+    if NNUNET_PREDICTOR == "in-process":
+        from src.predict.predictor import predict_in_process
+
+        return predict_in_process(
+            slice_images_dirpath,
+            segmentations_dirpath,
+            folds,
+            step_size,
+            on_segmentation,
+            on_saved,
+            cache,
+        )
+    if on_segmentation is not None or on_saved is not None:
+        raise ValueError(
+            "on_segmentation and on_saved require in-process predictions."
+        )
+    cmd = f'nnUNetv2_predict -i "{slice_images_dirpath}" -o "{segmentations_dirpath}" -d {NNUNET_DATASET} -c 2d -f {folds_str} -step_size {step_size}'
+    return run_command(cmd, env_vars=ENV_VARS)
 
 
 def run_command(command, env_vars=None):
-    """Runs given command."""
+    """Runs given command, logging its stdout line by line as it arrives along
+    with the progress of nnUNet predictions and samples of the command's
+    resource usage. Returns its return code.
+    """
     start_time = time.time()
     logger.info(f"Running command: {command}")
     env = os.environ.copy()  # Use the current environment
     if env_vars:
         env.update(env_vars)  # Add new environment variables
-    process = subprocess.run(
-        command, stdout=subprocess.PIPE, stderr=sys.stderr, text=True, env=env
+    # Stop python from buffering the command's stdout so that lines arrive live
+    env["PYTHONUNBUFFERED"] = "1"
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=sys.stderr,
+        text=True,
+        bufsize=1,
+        env=env,
     )
-    # Log stdout
-    if process.stdout:
-        logger.info(f"Logging STDOUT from command...")
-        for line in process.stdout.strip().split("\n"):
-            logger.info(line)
-        logger.info(f"Finished logging STDOUT from command.")
+    monitor = ResourceMonitor(process.pid, start_time)
+    monitor.start()
+    progress = PredictionProgress(start_time)
+    try:
+        # Log stdout as it arrives
+        for line in process.stdout:
+            line = line.rstrip()
+            if line:
+                logger.info(line)
+                progress.update(line)
+    except BaseException:
+        # Stop the command rather than wait for it, e.g. on KeyboardInterrupt
+        process.kill()
+        raise
+    finally:
+        return_code = process.wait()
+        monitor.stop()
+    monitor.log_summary(progress.cases_done)
     # Check if there was an error
-    return_code = process.returncode
     if return_code == 0:
         logger.info(f"Command completed successfully in {time_since(start_time)}")
     else:
         logger.error(f"Error running command. Failed with return code {return_code}.")
+    return return_code
+
+
+class PredictionProgress:
+
+    # Lines printed by nnUNetv2_predict
+    TOTAL_PATTERN = re.compile(r"There are (\d+) cases that I would like to predict")
+    DONE_PATTERN = re.compile(r"done with (\S+)")
+
+    def __init__(self, start_time):
+        """Tracks the number of cases predicted by nnUNetv2_predict from its
+        stdout lines and estimates the time remaining.
+        """
+        self.start_time = start_time
+        self.cases_total = None
+        self.cases_done = 0
+
+    def update(self, line):
+        """Updates the progress with a stdout line and logs the ETA if a case
+        was completed.
+        """
+        match = self.TOTAL_PATTERN.search(line)
+        if match:
+            self.cases_total = int(match.group(1))
+            return
+        match = self.DONE_PATTERN.search(line)
+        if not match:
+            return
+        self.cases_done += 1
+        elapsed = time.time() - self.start_time
+        if self.cases_total:
+            remaining = elapsed / self.cases_done * (self.cases_total - self.cases_done)
+            logger.info(
+                f"Predicted {self.cases_done}/{self.cases_total} cases in {round(elapsed)} s, ETA {round(remaining)} s."
+            )
+        else:
+            logger.info(f"Predicted {self.cases_done} cases in {round(elapsed)} s.")
+
+
+class ResourceMonitor:
+
+    def __init__(self, pid, start_time, interval=RESOURCE_SAMPLE_INTERVAL):
+        """Samples the CPU usage and memory (RSS) of the process with given pid
+        and all of its child processes every interval seconds in a background
+        thread, logging each sample. Without psutil only the elapsed time is
+        logged.
+        """
+        self.pid = pid
+        self.start_time = start_time
+        self.interval = interval
+        self.cpu_samples = []
+        self.peak_rss = 0
+        self.processes = {}  # psutil processes by pid, to keep their CPU counters
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Starts sampling in the background."""
+        if not PSUTIL_AVAILABLE:
+            logger.info("psutil is not installed, only monitoring elapsed time.")
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and waits for the background thread to finish."""
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self):
+        self.sample()  # First CPU sample only starts the CPU counters
+        while not self._stop_event.wait(self.interval):
+            cpu, rss = self.sample()
+            elapsed = round(time.time() - self.start_time)
+            if cpu is None:
+                logger.info(f"Resources: elapsed {elapsed} s.")
+                continue
+            self.cpu_samples.append(cpu)
+            self.peak_rss = max(self.peak_rss, rss)
+            logger.info(
+                f"Resources: CPU {cpu:.0f}%, RSS {rss / 2**20:.0f} MB, elapsed {elapsed} s."
+            )
+
+    def sample(self):
+        """Returns the summed CPU percent (since the last sample) and RSS (in
+        bytes) of the process and its children, or (None, None) if unavailable.
+        """
+        if not PSUTIL_AVAILABLE:
+            return None, None
+        try:
+            parent = psutil.Process(self.pid)
+            processes = [parent] + parent.children(recursive=True)
+        except psutil.Error:
+            return None, None
+        cpu = rss = 0
+        for process in processes:
+            # Reuse process objects as their CPU percent is relative to last call
+            process = self.processes.setdefault(process.pid, process)
+            try:
+                cpu += process.cpu_percent(None)
+                rss += process.memory_info().rss
+            except psutil.Error:
+                continue  # Process ended in the meantime
+        return cpu, rss
+
+    def log_summary(self, cases_done=0):
+        """Logs the peak RSS, mean CPU usage and seconds per case of the command."""
+        elapsed = time.time() - self.start_time
+        summary = f"Command summary: elapsed {round(elapsed)} s"
+        if self.cpu_samples:
+            summary += f", peak RSS {self.peak_rss / 2**20:.0f} MB, mean CPU {sum(self.cpu_samples) / len(self.cpu_samples):.0f}%"
+        if cases_done:
+            summary += f", {elapsed / cases_done:.1f} s per case ({cases_done} cases)"
+        logger.info(summary + ".")
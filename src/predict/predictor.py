@@ -0,0 +1,459 @@
+import os
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import cv2
+import torch
+from PIL import Image
+from natsort import natsorted
+
+import src.parameters
+from src.logger import time_since
+from src.image_segmentation.utils import tissue_mask
+from src.predict.preprocessing_cache import PreprocessingCache, plan_hash
+
+# nnUNet reads its folder paths from the environment when it is imported
+os.environ.update(src.parameters.ENV_VARS)
+
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from torch._dynamo import OptimizedModule
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.export_prediction import (
+    convert_predicted_logits_to_segmentation_with_correct_shape,
+)
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+from nnunetv2.utilities.helpers import dummy_context, empty_cache
+
+logger = logging.getLogger(__name__)
+
+NNUNET_DATASET = src.parameters.NNUNET_DATASET
+NNUNET_FOLDS = src.parameters.NNUNET_FOLDS
+NNUNET_STEP_SIZE = src.parameters.NNUNET_STEP_SIZE
+TISSUE_INTENSITY_THRESHOLD = src.parameters.TISSUE_INTENSITY_THRESHOLD
+SKIP_BACKGROUND_PATCHES = src.parameters.SKIP_BACKGROUND_PATCHES
+TILED_PREDICTION_MIN_PIXELS = src.parameters.TILED_PREDICTION_MIN_PIXELS
+MACRO_TILE_SIZE = src.parameters.MACRO_TILE_SIZE
+MACRO_TILE_OVERLAP = src.parameters.MACRO_TILE_OVERLAP
+PATCH_BATCH_SIZE = src.parameters.PATCH_BATCH_SIZE
+BATCH_MAX_PIXELS = src.parameters.BATCH_MAX_PIXELS
+BATCH_MAX_SLICES = src.parameters.BATCH_MAX_SLICES
+PREPROCESSING_CACHE = src.parameters.PREPROCESSING_CACHE
+
+
+def pad_to_shape(arr, shape):
+    """Pads arr with zeros (False) evenly on both sides of each dimension up to
+    the given shape, the same way nnUNet pads images smaller than a patch.
+    """
+    diffs = [s - a for s, a in zip(shape, arr.shape)]
+    if not any(diffs):
+        return arr
+    return np.pad(arr, [(d // 2, d - d // 2) for d in diffs])
+
+
+def tile_bounds(length, tile_size, overlap):
+    """Returns the (start, stop) of evenly spaced tiles of tile_size covering
+    length with at least the given overlap, along with the (start, stop) of the
+    part of each tile to keep when stitching (split at the overlap midpoints).
+    """
+    if length <= tile_size:
+        return [(0, length)], [(0, length)]
+    n = int(np.ceil((length - overlap) / (tile_size - overlap)))
+    starts = [round(i * (length - tile_size) / (n - 1)) for i in range(n)]
+    tiles = [(start, start + tile_size) for start in starts]
+    cuts = [(stop + next_start) // 2 for (_, stop), next_start in zip(tiles, starts[1:])]
+    keeps = list(zip([0] + cuts, cuts + [length]))
+    return tiles, keeps
+
+
+def read_uint8_image(img_fp):
+    """Returns the image at img_fp as a uint8 array of shape (c, 1, height,
+    width) like nnUNet's NaturalImage2DIO, but without its float32 copy.
+    """
+    arr = np.asarray(Image.open(img_fp))
+    if arr.ndim == 3:
+        return arr.transpose((2, 0, 1))[:, None]
+    return arr[None, None]
+
+
+class CryptPredictor(nnUNetPredictor):
+
+    def __init__(
+        self,
+        folds=NNUNET_FOLDS,
+        step_size=NNUNET_STEP_SIZE,
+        skip_background=SKIP_BACKGROUND_PATCHES,
+        cache=PREPROCESSING_CACHE,
+    ):
+        """nnUNetPredictor of the trained 2d crypt model that predicts slice
+        images one at a time within this process. If skip_background, the
+        sliding-window patches without any tissue are not run through the
+        network and are predicted as background instead. If cache, preprocessed
+        slice images are cached on disk in nnUNet_preprocessed, so that repeated
+        predictions of the same slices skip preprocessing.
+        """
+        if torch.cuda.is_available():
+            device = torch.device("cuda")
+        else:
+            # Same as nnUNetv2_predict: let torch use all cores on the CPU
+            torch.set_num_threads(multiprocessing.cpu_count())
+            device = torch.device("cpu")
+        super().__init__(tile_step_size=step_size, device=device, allow_tqdm=False)
+        model_dir = get_output_folder(
+            NNUNET_DATASET, "nnUNetTrainer", "nnUNetPlans", "2d"
+        )
+        logger.info(f"Loading folds {tuple(folds)} of model at {model_dir} on {device}.")
+        self.initialize_from_trained_model_folder(model_dir, folds)
+        self.reader = self.plans_manager.image_reader_writer_class()
+        self.preprocessor = self.configuration_manager.preprocessor_class(verbose=False)
+        self.skip_background = skip_background
+        self.cache = None
+        if cache:
+            plan_id = plan_hash(self.plans_manager.plans, "2d", self.dataset_json)
+            cache_dir = Path(os.environ["nnUNet_preprocessed"], "auto-crypt-count cache")
+            self.cache = PreprocessingCache(cache_dir, plan_id)
+        # Tissue mask of the current slice and counts of its (skipped) patches
+        self.patch_mask = None
+        self.patches_total = self.patches_skipped = 0
+
+    def predict_slice(self, img_fp):
+        """Returns the segmentation (np.array of shape (1, height, width)) and
+        properties of the slice image at img_fp. Slices larger than
+        TILED_PREDICTION_MIN_PIXELS are predicted in macro-tiles.
+        """
+        self.patches_total = self.patches_skipped = 0
+        width, height = Image.open(img_fp).size
+        if width * height > TILED_PREDICTION_MIN_PIXELS:
+            return self.predict_slice_tiled(img_fp)
+        data, properties, mask = self.preprocess_slice(img_fp)
+        return self.predict_preprocessed(data, properties, mask), properties
+
+    def predict_slice_tiled(
+        self, img_fp, tile_size=MACRO_TILE_SIZE, overlap=MACRO_TILE_OVERLAP
+    ):
+        """Returns the segmentation and properties of the slice image at img_fp,
+        predicting it in overlapping macro-tiles that are stitched together at
+        the middle of their overlaps. Only the uint8 image and segmentation are
+        held in memory in full; nnUNet's float32 data and logits are bounded by
+        the tile size.
+        """
+        img = read_uint8_image(img_fp)
+        height, width = img.shape[2:]
+        row_tiles, row_keeps = tile_bounds(height, tile_size, overlap)
+        col_tiles, col_keeps = tile_bounds(width, tile_size, overlap)
+        logger.info(
+            f"Predicting {img_fp.name} ({width}x{height}) in {len(row_tiles) * len(col_tiles)} macro-tiles."
+        )
+        properties = {"spacing": (999, 1, 1)}
+        seg = np.zeros((1, height, width), dtype=np.uint8)
+        for (y0, y1), (keep_y0, keep_y1) in zip(row_tiles, row_keeps):
+            for (x0, x1), (keep_x0, keep_x1) in zip(col_tiles, col_keeps):
+                tile = img[:, :, y0:y1, x0:x1]
+                mask = None
+                if self.skip_background:
+                    tile_img = Image.fromarray(np.moveaxis(tile[:, 0], 0, -1).squeeze())
+                    mask = tissue_mask(tile_img, TISSUE_INTENSITY_THRESHOLD)
+                tile_seg, _ = self.predict_array(
+                    tile.astype(np.float32), dict(properties), mask
+                )
+                seg[:, keep_y0:keep_y1, keep_x0:keep_x1] = tile_seg[
+                    :, keep_y0 - y0 : keep_y1 - y0, keep_x0 - x0 : keep_x1 - x0
+                ]
+        return seg, properties
+
+    def predict_array(self, data, properties, mask=None):
+        """Returns the segmentation and properties of the raw image data (as read
+        by nnUNet's image reader), skipping patches outside of the 2D tissue mask
+        if given.
+        """
+        data, properties, mask = self.preprocess_array(data, properties, mask)
+        return self.predict_preprocessed(data, properties, mask), properties
+
+    def predict_preprocessed(self, data, properties, mask=None):
+        """Returns the segmentation of the preprocessed data, skipping patches
+        outside of the preprocessed tissue mask if given.
+        """
+        self.patch_mask = mask
+        try:
+            logits = self.predict_logits_from_preprocessed_data(torch.from_numpy(data))
+        finally:
+            self.patch_mask = None
+        return self.logits_to_segmentation(logits, properties)
+
+    def preprocess_slice(self, img_fp):
+        """Returns the preprocessed data and properties of the slice image at
+        img_fp, from the preprocessing cache if possible, along with its tissue
+        mask matched to the preprocessed data if skipping background patches.
+        """
+        cached = key = None
+        if self.cache is not None:
+            key = self.cache.key(img_fp)
+            cached = self.cache.load(key)
+        if cached is None:
+            data, properties = self.reader.read_images([str(img_fp)])
+            data, properties, _ = self.preprocess_array(data, properties)
+            if self.cache is not None:
+                self.cache.save(key, data, properties)
+        else:
+            data, properties = cached
+        mask = None
+        if self.skip_background:
+            mask = tissue_mask(Image.open(img_fp), TISSUE_INTENSITY_THRESHOLD)
+            mask = self.preprocessed_mask(mask, properties, data.shape[1:])
+        return data, properties, mask
+
+    def preprocess_array(self, data, properties, mask=None):
+        """Returns the raw image data preprocessed by nnUNet, its properties, and
+        the 2D tissue mask (if given) matched to the preprocessed data.
+        """
+        data, _, properties = self.preprocessor.run_case_npy(
+            data,
+            None,
+            properties,
+            self.plans_manager,
+            self.configuration_manager,
+            self.dataset_json,
+        )
+        if mask is not None:
+            mask = self.preprocessed_mask(mask, properties, data.shape[1:])
+        return data, properties, mask
+
+    def logits_to_segmentation(self, logits, properties):
+        """Returns the segmentation of the given logits in the original shape."""
+        return convert_predicted_logits_to_segmentation_with_correct_shape(
+            logits.cpu(),
+            self.plans_manager,
+            self.configuration_manager,
+            self.label_manager,
+            properties,
+        )
+
+    def predict_slices_batched(self, img_fps, batch_size=PATCH_BATCH_SIZE):
+        """Returns a list of the segmentations and properties of the slice
+        images at img_fps, running the sliding-window patches of all the slices
+        through the network together in batches of batch_size patches. Meant for
+        small slices, which on their own underfill the batches.
+        """
+        self.patches_total = self.patches_skipped = 0
+        patch_size = self.configuration_manager.patch_size
+        # Preprocess each slice and get its sliding-window patches
+        cases = []
+        for img_fp in img_fps:
+            data, properties, self.patch_mask = self.preprocess_slice(img_fp)
+            data, revert_padding = pad_nd_image(
+                torch.from_numpy(data), patch_size, "constant", {"value": 0}, True, None
+            )
+            slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+            self.patch_mask = None
+            cases.append((data, properties, revert_padding, slicers))
+        patches = [(i, sl) for i, case in enumerate(cases) for sl in case[3]]
+        # Accumulate the Gaussian-weighted predictions of all folds in float32
+        heads = self.label_manager.num_segmentation_heads
+        logits = [torch.zeros((heads, *case[0].shape[1:])) for case in cases]
+        n_predictions = [torch.zeros(case[0].shape[1:]) for case in cases]
+        gaussian = 1
+        if self.use_gaussian:
+            gaussian = compute_gaussian(
+                tuple(patch_size),
+                sigma_scale=1.0 / 8,
+                value_scaling_factor=10,
+                dtype=torch.float32,
+                device=torch.device("cpu"),
+            )
+        self.network = self.network.to(self.device)
+        self.network.eval()
+        autocast = (
+            torch.autocast(self.device.type, enabled=True)
+            if self.device.type == "cuda"
+            else dummy_context()
+        )
+        with torch.inference_mode(), autocast:
+            for params in self.list_of_parameters:
+                if not isinstance(self.network, OptimizedModule):
+                    self.network.load_state_dict(params)
+                else:
+                    self.network._orig_mod.load_state_dict(params)
+                for start in range(0, len(patches), batch_size):
+                    batch = patches[start : start + batch_size]
+                    x = torch.stack([cases[i][0][sl] for i, sl in batch])
+                    predictions = self._internal_maybe_mirror_and_predict(
+                        x.to(self.device)
+                    )
+                    for (i, sl), prediction in zip(batch, predictions.float().cpu()):
+                        logits[i][sl] += prediction * gaussian
+                        n_predictions[i][sl[1:]] += gaussian
+        empty_cache(self.device)
+        # Normalize, revert padding, and convert each slice's logits
+        results = []
+        for (_, properties, revert_padding, _), case_logits, case_n in zip(
+            cases, logits, n_predictions
+        ):
+            case_logits /= case_n
+            case_logits = case_logits[(slice(None), *revert_padding[1:])]
+            # Pixels without any predicted patch are background
+            background = torch.isnan(case_logits[0])
+            case_logits[0][background] = 1
+            case_logits[1:, background] = 0
+            results.append((self.logits_to_segmentation(case_logits, properties), properties))
+        return results
+
+    def save_segmentation(self, seg, properties, seg_fp):
+        """Saves the segmentation from predict_slice to seg_fp as nnUNet does."""
+        self.reader.write_seg(seg, str(seg_fp), properties)
+
+    def preprocessed_mask(self, mask, properties, shape):
+        """Returns the 2D mask of the raw slice image transposed, cropped and
+        resized to match the preprocessed image of given (1, height, width) shape.
+        """
+        mask = mask[None].transpose(self.plans_manager.transpose_forward)
+        bbox = properties["bbox_used_for_cropping"]
+        mask = mask[tuple(slice(start, stop) for start, stop in bbox)]
+        if mask.shape != tuple(shape):
+            resized = cv2.resize(
+                mask[0].astype(np.uint8),
+                (shape[2], shape[1]),
+                interpolation=cv2.INTER_NEAREST,
+            )
+            mask = resized[None].astype(bool)
+        return mask
+
+    def _internal_get_sliding_window_slicers(self, image_size):
+        """Returns nnUNet's sliding-window slicers, without the patches that
+        contain no tissue if there is a tissue mask for the current slice.
+        """
+        slicers = super()._internal_get_sliding_window_slicers(image_size)
+        if self.patch_mask is None:
+            return slicers
+        mask = pad_to_shape(self.patch_mask, image_size)
+        tissue_slicers = [sl for sl in slicers if mask[sl[1:]].any()]
+        self.patches_total += len(slicers)
+        self.patches_skipped += len(slicers) - len(tissue_slicers)
+        return tissue_slicers
+
+    def predict_sliding_window_return_logits(self, input_image):
+        """Returns nnUNet's sliding-window logits. Pixels that were not covered
+        by any predicted patch (NaN after nnUNet's normalization by the number of
+        predictions) are set to background.
+        """
+        logits = super().predict_sliding_window_return_logits(input_image)
+        if self.patch_mask is not None:
+            background = torch.isnan(logits[0])
+            logits[0][background] = 1
+            logits[1:, background] = 0
+        return logits
+
+    @property
+    def fraction_skipped(self):
+        """Returns the fraction of patches skipped for the current slice."""
+        return self.patches_skipped / self.patches_total if self.patches_total else 0.0
+
+
+def segmentation_filename(img_fp):
+    """Returns the nnUNet segmentation filename of a slice image filepath."""
+    return Path(img_fp).name.replace("_0000.png", ".png")
+
+
+def group_slices(img_fps, max_pixels=BATCH_MAX_PIXELS, max_slices=BATCH_MAX_SLICES):
+    """Returns a list of (img_fps, batched) groups of the given slice images.
+    If PATCH_BATCH_SIZE, slices of up to max_pixels are grouped by up to
+    max_slices to have their patches batched together. Larger slices are
+    predicted on their own.
+    """
+    groups, small = [], []
+    for img_fp in img_fps:
+        width, height = Image.open(img_fp).size
+        if PATCH_BATCH_SIZE and width * height <= max_pixels:
+            small.append(img_fp)
+            if len(small) == max_slices:
+                groups.append((small, True))
+                small = []
+        else:
+            groups.append(([img_fp], False))
+    if small:
+        groups.append((small, True))
+    return groups
+
+
+def predict_in_process(
+    slice_images_dirpath,
+    segmentations_dirpath,
+    folds=NNUNET_FOLDS,
+    step_size=NNUNET_STEP_SIZE,
+    on_segmentation=None,
+    on_saved=None,
+    cache=PREPROCESSING_CACHE,
+):
+    """Predicts the slice images in slice_images_dirpath with a CryptPredictor,
+    batching the patches of small slices together, and saves the segmentations
+    into segmentations_dirpath. The .png files are written in a background
+    thread, and if given, on_segmentation(seg_fp, seg_arr) is called with each 2D
+    segmentation array in the meantime. If given, on_saved(seg_fp) is called in
+    the background thread once each .png file is written. Preprocessed slice
+    images are cached if cache (see CryptPredictor). Returns 0 if all slices were
+    predicted and saved successfully, 1 otherwise.
+    """
+    start_time = time.time()
+    predictor = CryptPredictor(folds, step_size, cache=cache)
+    segmentations_dirpath = Path(segmentations_dirpath)
+    segmentations_dirpath.mkdir(parents=True, exist_ok=True)
+    img_fps = natsorted(Path(slice_images_dirpath).glob("*_0000.png"))
+    logger.info(f"Predicting {len(img_fps)} slice images in-process.")
+    failed = []
+    writes = {}
+    done = patches_total = patches_skipped = 0
+
+    def save_segmentation(seg, properties, seg_fp):
+        predictor.save_segmentation(seg, properties, seg_fp)
+        if on_saved is not None:
+            on_saved(seg_fp)
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for group, batched in group_slices(img_fps):
+            group_start = time.time()
+            try:
+                if batched:
+                    results = predictor.predict_slices_batched(group)
+                else:
+                    results = [predictor.predict_slice(group[0])]
+            except Exception:
+                logger.exception(
+                    f"Error predicting {[fp.name for fp in group]}. Skipping and moving on."
+                )
+                failed.extend(fp.name for fp in group)
+                continue
+            for img_fp, (seg, properties) in zip(group, results):
+                seg_fp = segmentations_dirpath / segmentation_filename(img_fp)
+                writes[img_fp.name] = writer.submit(
+                    save_segmentation, seg, properties, seg_fp
+                )
+                if on_segmentation is not None:
+                    on_segmentation(seg_fp, seg[0])
+            done += len(group)
+            patches_total += predictor.patches_total
+            patches_skipped += predictor.patches_skipped
+            names = group[0].name
+            if batched:
+                names = f"{len(group)} batched slices {group[0].name} to {group[-1].name}"
+            msg = f"Predicted {done}/{len(img_fps)}: {names} in {time_since(group_start)}"
+            if predictor.skip_background:
+                msg += f", skipped {100 * predictor.fraction_skipped:.1f}% of patches (no tissue)"
+            logger.info(msg + ".")
+    # All segmentations have been written once the writer is shut down
+    for name, write in writes.items():
+        if write.exception() is not None:
+            logger.error(f"Error saving segmentation of {name}: {write.exception()}")
+            failed.append(name)
+    if predictor.skip_background and patches_total:
+        logger.info(
+            f"Skipped {patches_skipped}/{patches_total} ({100 * patches_skipped / patches_total:.1f}%) sliding-window patches containing no tissue."
+        )
+    if predictor.cache is not None:
+        predictor.cache.log_summary()
+    if failed:
+        logger.error(f"Predictions failed for {len(failed)} slice images: {failed}")
+        return 1
+    logger.info(f"Finished in-process predictions in {time_since(start_time)}.")
+    return 0
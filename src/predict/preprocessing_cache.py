@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import uuid
+from pathlib import Path
+import numpy as np
+
+import src.parameters
+from src.utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+PREPROCESSING_CACHE_MAX_GB = src.parameters.PREPROCESSING_CACHE_MAX_GB
+
+
+def plan_hash(plans, configuration, dataset_json):
+    """Returns the sha256 hex digest identifying the nnUNet plans, configuration
+    name and dataset.json, which together determine the preprocessing.
+    """
+    identity = {"plans": plans, "configuration": configuration, "dataset": dataset_json}
+    return hashlib.sha256(
+        json.dumps(identity, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class PreprocessingCache:
+
+    def __init__(self, cache_dir, plan_id, max_gb=PREPROCESSING_CACHE_MAX_GB):
+        """On-disk cache of nnUNet-preprocessed slice images in cache_dir, keyed
+        by the hash of the image file and the plan_id (see plan_hash). Each
+        entry is a .npy file of the preprocessed data and a .pkl file of its
+        properties. The least recently used entries are evicted once the cache
+        exceeds max_gb.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.plan_id = plan_id
+        self.max_bytes = max_gb * 2**30
+        self.hits = self.misses = 0
+
+    def key(self, img_fp):
+        """Returns the cache key of the slice image at img_fp."""
+        return hashlib.sha256((file_hash(img_fp) + self.plan_id).encode()).hexdigest()
+
+    def load(self, key):
+        """Returns the cached (data, properties) of key, or None on a miss."""
+        data_fp, properties_fp = self.entry_fps(key)
+        try:
+            data = np.load(data_fp)
+            with open(properties_fp, "rb") as file:
+                properties = pickle.load(file)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            # Not cached, or evicted or being written in the meantime
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        os.utime(data_fp)
+        self.hits += 1
+        return data, properties
+
+    def save(self, key, data, properties):
+        """Caches the preprocessed data and properties under key, then evicts the
+        least recently used entries if the cache is over its size budget.
+        """
+        data_fp, properties_fp = self.entry_fps(key)
+        # Write to temporary files first so that entries are never partial
+        tmp = f".{uuid.uuid4().hex}.tmp"
+        with open(properties_fp.with_name(properties_fp.name + tmp), "wb") as file:
+            pickle.dump(properties, file, protocol=-1)
+        with open(data_fp.with_name(data_fp.name + tmp), "wb") as file:
+            np.save(file, data)
+        os.replace(properties_fp.with_name(properties_fp.name + tmp), properties_fp)
+        os.replace(data_fp.with_name(data_fp.name + tmp), data_fp)
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in its
+        size budget.
+        """
+        entries = []
+        for data_fp in self.cache_dir.glob("*.npy"):
+            properties_fp = data_fp.with_suffix(".pkl")
+            try:
+                stat = data_fp.stat()
+                size = stat.st_size + properties_fp.stat().st_size
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, data_fp, properties_fp))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, data_fp, properties_fp in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            logger.debug(f"Evicting {data_fp.stem} from preprocessing cache.")
+            data_fp.unlink(missing_ok=True)
+            properties_fp.unlink(missing_ok=True)
+            total -= size
+
+    def entry_fps(self, key):
+        """Returns the .npy data and .pkl properties filepaths of key."""
+        return self.cache_dir / f"{key}.npy", self.cache_dir / f"{key}.pkl"
+
+    def log_summary(self):
+        """Logs the cache hits and misses."""
+        total = self.hits + self.misses
+        if total:
+            logger.info(
+                f"Preprocessing cache: {self.hits}/{total} hits ({100 * self.hits / total:.0f}%), {self.misses} misses."
+            )
@@ -11,7 +11,7 @@ from src.prepare.wsi import WSI
 logger = logging.getLogger(__name__)
 
 
-def process_trial_data(trial_data_dir):
+def process_trial_data(trial_data_dir, on_slice_saved=None):
     """Given a directory containing all WSI (.svs files), creates and populates the
     following folder structure:
     - wsi_data_dir
@@ -19,6 +19,8 @@ def process_trial_data(trial_data_dir):
             - Thumbnails
         - Slice Images
         - Slice Segmentations
+    If given, on_slice_saved(fp) is called with the filepath of each slice image as
+    soon as it is saved.
     """
     trial_start = time.time()
     logger.info(f"Processing trial data in {trial_data_dir}")
@@ -62,7 +64,9 @@ def process_trial_data(trial_data_dir):
             # Save thumbnails with slice boxes drawn
             w.draw_GI_slice_boxes(slice_data, Path(thumbnail_dir, w.filename + ".png"))
             # Save the slice images, appending '_0000' to filenames for nnUNet
-            w.save_GI_slices(slice_data, slice_dir, append="_0000")
+            w.save_GI_slices(
+                slice_data, slice_dir, append="_0000", on_saved=on_slice_saved
+            )
             logger.info(f"Finished processing WSI file in {time_since(trial_start)}.")
         except Exception:
             logger.exception(f"Error processing {fp.name}. Skipping and moving on.")
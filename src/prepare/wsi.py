@@ -6,7 +6,7 @@ import logging
 import src.parameters
 from src.image_segmentation.svs import SVS
 from src.image_segmentation.png import PNG
-from src.image_segmentation.utils import crop_label, labelmap
+from src.image_segmentation.utils import crop_label, labelmap, tissue_mask
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +29,7 @@ class WSI(SVS):
         """Returns the binary thresholded mask (np.array) of the slide tissue."""
         if not hasattr(self, "_tissue_mask"):
             # Get binary mask of thumbnail below threshold
-            arr = np.array(self.thumbnail.convert("L"), dtype=np.uint8)
-            self._tissue_mask = arr < TISSUE_INTENSITY_THRESHOLD
+            self._tissue_mask = tissue_mask(self.thumbnail, TISSUE_INTENSITY_THRESHOLD)
         return self._tissue_mask
 
     def get_GI_slice_data(self):
@@ -94,10 +93,11 @@ class WSI(SVS):
         # Save the drawn thumbnail image
         draw_thumbnail.save(output_fp)
 
-    def save_GI_slices(self, slice_data, output_dir, append=None):
+    def save_GI_slices(self, slice_data, output_dir, append=None, on_saved=None):
         """Saves the cropped image of each of the 9 slices from slice_data in either
         'full' or 'thumbnail' (faster) resolution as desired. Appends 'append' to
-        filename when saving.
+        filename when saving. If given, on_saved(fp) is called with the filepath of
+        each slice image as soon as it is saved.
         """
         # Loop through the slices, cropping and saving each with a 2% margin
         for data in slice_data.values():
@@ -130,4 +130,7 @@ class WSI(SVS):
                 png.norm_HnE()
             # Save the image with append to filename
             append = append if append else ""
-            png.save(Path(output_dir, png.filename + f"{append}.png"))
+            fp = Path(output_dir, png.filename + f"{append}.png")
+            png.save(fp)
+            if on_saved is not None:
+                on_saved(fp)
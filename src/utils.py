@@ -0,0 +1,10 @@
+import hashlib
+
+
+def file_hash(fp, chunk_size=2**20):
+    """Returns the sha256 hex digest of the contents of the file at fp."""
+    sha = hashlib.sha256()
+    with open(fp, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -101,6 +101,316 @@ def test_predict():
     run_predictions(slice_images_dirpath)
 
 
+def test_run_command():
+    import sys
+    import time
+    from src.predict.predict import PredictionProgress, run_command
+
+    logger.info("Running test: test_run_command")
+    # Progress from the lines printed by nnUNetv2_predict
+    progress = PredictionProgress(time.time())
+    for line in [
+        "There are 2 cases that I would like to predict",
+        "Predicting case_1:",
+        "done with case_1",
+        "done with case_2",
+    ]:
+        progress.update(line)
+    assert progress.cases_total == 2 and progress.cases_done == 2
+
+    class LogTimes(logging.Handler):
+        def __init__(self, interrupt=False):
+            """Records the time of each logged message, raising KeyboardInterrupt
+            on the first line of output if interrupt.
+            """
+            super().__init__()
+            self.times = {}
+            self.interrupt = interrupt
+
+        def emit(self, record):
+            self.times[record.getMessage()] = time.time()
+            if self.interrupt and record.getMessage() == "done with case_1":
+                raise KeyboardInterrupt
+
+    # Each line is logged as soon as the command prints it
+    script = "import time; print('There are 2 cases that I would like to predict'); print('done with case_1'); time.sleep(1); print('done with case_2')"
+    command_logger = logging.getLogger("src.predict.predict")
+    handler = LogTimes()
+    command_logger.addHandler(handler)
+    try:
+        assert run_command([sys.executable, "-c", script]) == 0
+    finally:
+        command_logger.removeHandler(handler)
+    assert handler.times["done with case_2"] - handler.times["done with case_1"] > 0.5
+    assert "Predicted 2/2 cases" in " ".join(handler.times)
+    # An interrupted command is stopped instead of waited for
+    script = "import time; print('done with case_1'); time.sleep(60)"
+    handler = LogTimes(interrupt=True)
+    command_logger.addHandler(handler)
+    start_time = time.time()
+    try:
+        run_command([sys.executable, "-c", script])
+        assert False, "KeyboardInterrupt was not raised"
+    except KeyboardInterrupt:
+        pass
+    finally:
+        command_logger.removeHandler(handler)
+    assert time.time() - start_time < 30
+
+
+def test_calibrate():
+    import random
+    import numpy as np
+    from natsort import natsorted
+    from src.predict.calibrate import dice, sample_slice_images
+
+    logger.info("Running test: test_calibrate")
+    slice_dir = Path(TEST_DATA_DIRPATH, "output/calibrate/Slice Images")
+    if slice_dir.exists():
+        shutil.rmtree(slice_dir)
+    slice_dir.mkdir(parents=True)
+    for i in range(12):
+        size = 20 if i % 3 else 40
+        Image.new("RGB", (size, size)).save(slice_dir / f"slice_{i}_0000.png")
+    # Same sample as the fixed seed, whatever the state of the global RNG
+    random.seed(0)
+    sample = sample_slice_images(slice_dir, 5)
+    random.seed(1)
+    assert sample_slice_images(slice_dir, 5) == sample
+    fps = natsorted(slice_dir.glob("*.png"))
+    assert sample == natsorted(random.Random(2).sample(fps, 5))
+    # Only small images, and no more than there are
+    small = sample_slice_images(slice_dir, 100, max_pixels=20 * 20)
+    assert small == [fp for fp in fps if Image.open(fp).size == (20, 20)]
+    # Dice of segmentations overlapping by half, and of two empty ones
+    seg_dir = slice_dir.parent / "Slice Segmentations"
+    seg_dir.mkdir(exist_ok=True)
+    seg1, seg2 = np.zeros((10, 10), np.uint8), np.zeros((10, 10), np.uint8)
+    seg1[:, :4], seg2[:, 2:6] = 1, 1
+    for name, seg in [("seg1", seg1), ("seg2", seg2), ("empty", seg1 * 0)]:
+        Image.fromarray(seg).save(seg_dir / f"{name}.png")
+    assert dice(seg_dir / "seg1.png", seg_dir / "seg1.png") == 1.0
+    assert dice(seg_dir / "seg1.png", seg_dir / "seg2.png") == 0.5
+    assert dice(seg_dir / "seg1.png", seg_dir / "empty.png") == 0.0
+    assert dice(seg_dir / "empty.png", seg_dir / "empty.png") == 1.0
+
+
+def test_predictor():
+    import numpy as np
+    from src.predict.predictor import (
+        CryptPredictor,
+        group_slices,
+        pad_to_shape,
+        tile_bounds,
+    )
+
+    logger.info("Running test: test_predictor")
+    # Padded evenly on both sides as nnUNet pads images, with odd remainders after
+    mask = np.ones((1, 3, 4), dtype=bool)
+    padded = pad_to_shape(mask, (1, 6, 4))
+    assert padded.shape == (1, 6, 4) and padded.dtype == bool
+    assert padded[0, :, 0].tolist() == [False, True, True, True, False, False]
+    assert pad_to_shape(mask, mask.shape) is mask
+    # Macro-tiles of tile_size cover the image and overlap by at least the margin,
+    # and their kept parts cover it exactly once
+    tile_size, overlap = 64, 16
+    for length in (10, 64, 65, 100, 150, 1000):
+        tiles, keeps = tile_bounds(length, tile_size, overlap)
+        assert tiles[0][0] == 0 and tiles[-1][1] == length
+        assert all(stop - start == min(tile_size, length) for start, stop in tiles)
+        for (_, stop), (next_start, _) in zip(tiles, tiles[1:]):
+            assert stop - next_start >= overlap
+        assert keeps[0][0] == 0 and keeps[-1][1] == length
+        assert all(stop == next_start for (_, stop), (next_start, _) in zip(keeps, keeps[1:]))
+        assert all(t0 <= k0 < k1 <= t1 for (t0, t1), (k0, k1) in zip(tiles, keeps))
+
+    class StubPredictor(CryptPredictor):
+        def __init__(self, edge):
+            """Predicts each pixel by thresholding its first channel, without a
+            model, but gets the pixels within edge of the tile borders wrong.
+            """
+            self.skip_background = False
+            self.edge = edge
+
+        def predict_array(self, data, properties, mask=None):
+            seg = (data[0] > 127).astype(np.uint8)
+            inner = seg[:, self.edge : -self.edge, self.edge : -self.edge].copy()
+            seg = 1 - seg
+            seg[:, self.edge : -self.edge, self.edge : -self.edge] = inner
+            return seg, properties
+
+    # Stitched tiles keep only the tile centers, so the segmentation is the same
+    # as predicting the whole image away from its borders
+    output_dir = Path(TEST_DATA_DIRPATH, "output/predictor")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    img_arr = np.random.default_rng(2).integers(0, 256, (100, 150, 3), dtype=np.uint8)
+    img_fp = output_dir / "tiled_0000.png"
+    Image.fromarray(img_arr).save(img_fp)
+    edge = overlap // 4
+    seg, _ = StubPredictor(edge).predict_slice_tiled(img_fp, tile_size, overlap)
+    assert seg.shape == (1, 100, 150)
+    expected = img_arr[edge:-edge, edge:-edge, 0] > 127
+    assert np.array_equal(seg[0, edge:-edge, edge:-edge], expected)
+    # Small slices are batched by up to max_slices, large ones predicted alone
+    sizes = [10, 10, 10, 30, 10, 10]
+    img_fps = [output_dir / f"group_{i}_0000.png" for i in range(len(sizes))]
+    for img_fp, size in zip(img_fps, sizes):
+        Image.new("RGB", (size, size)).save(img_fp)
+    groups = group_slices(img_fps, max_pixels=10 * 10, max_slices=2)
+    assert groups == [
+        (img_fps[0:2], True),
+        ([img_fps[3]], False),
+        (img_fps[2:3] + img_fps[4:5], True),
+        (img_fps[5:6], True),
+    ]
+
+
+def test_preprocessing_cache():
+    import os
+    import numpy as np
+    from nnunetv2.imageio.natural_image_reader_writer import NaturalImage2DIO
+    from src.predict.calibrate import benchmark_batching
+    from src.predict.predictor import CryptPredictor
+    from src.predict.preprocessing_cache import PreprocessingCache
+
+    logger.info("Running test: test_preprocessing_cache")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/preprocessing_cache")
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    slice_dir = output_dir / "Slice Images"
+    slice_dir.mkdir(parents=True)
+    img_fps = [slice_dir / f"slice_{i}_0000.png" for i in range(3)]
+    for i, img_fp in enumerate(img_fps):
+        Image.new("RGB", (20, 20), (i, i, i)).save(img_fp)
+    # Keyed by the image contents and the plan
+    cache = PreprocessingCache(output_dir / "cache", "plan")
+    keys = [cache.key(img_fp) for img_fp in img_fps]
+    assert len(set(keys)) == 3
+    other_plan_cache = PreprocessingCache(output_dir / "cache", "other plan")
+    assert other_plan_cache.key(img_fps[0]) != keys[0]
+    # A miss before saving, then a hit with the saved entry
+    assert cache.load(keys[0]) is None and cache.misses == 1
+    data = np.arange(1000, dtype=np.float32).reshape(1, 1, 10, 100)
+    for key in keys:
+        cache.save(key, data, {"spacing": (999, 1, 1)})
+    loaded_data, properties = cache.load(keys[0])
+    assert cache.hits == 1
+    assert np.array_equal(loaded_data, data) and properties == {"spacing": (999, 1, 1)}
+    # The least recently used entries are evicted down to the size limit
+    entry_size = sum(fp.stat().st_size for fp in cache.entry_fps(keys[0]))
+    for i, key in enumerate(keys):
+        os.utime(cache.entry_fps(key)[0], (i, i))
+    cache.load(keys[0])  # now the most recently used
+    cache.max_bytes = 2 * entry_size
+    cache.evict()
+    assert [cache.entry_fps(key)[0].exists() for key in keys] == [True, False, True]
+
+    class StubPredictor(CryptPredictor):
+        def __init__(self, cache):
+            """Preprocesses slice images with the given cache by converting them
+            to float32, recording the cache hits of each prediction.
+            """
+            self.skip_background = False
+            self.reader = NaturalImage2DIO()
+            self.cache = cache
+            self.hits = []
+
+        def preprocess_array(self, data, properties, mask=None):
+            return data.astype(np.float32), properties, mask
+
+        def predict_slice(self, img_fp):
+            hits = self.cache.hits
+            self.preprocess_slice(img_fp)
+            self.hits.append(("single", self.cache.hits - hits))
+
+        def predict_slices_batched(self, img_fps):
+            hits = self.cache.hits
+            for img_fp in img_fps:
+                self.preprocess_slice(img_fp)
+            self.hits.append(("batched", self.cache.hits - hits))
+
+    # Both timed runs of the batching benchmark hit the cache for every slice
+    predictor = StubPredictor(PreprocessingCache(output_dir / "cache", "benchmark"))
+    benchmark_batching(output_dir, sample_size=3, predictor=predictor)
+    assert predictor.hits == [("single", 1)] * 3 + [("batched", 3)]
+
+
+def test_pipeline():
+    import numpy as np
+    import cv2
+    from src.pipeline import TrialPipeline
+    from src.count.crypt_count import count_key
+    from src.count.contour_store import ContourStore
+
+    logger.info("Running test: test_pipeline")
+    trial_dir = Path(TEST_DATA_DIRPATH, "output/pipeline")
+    if trial_dir.exists():
+        shutil.rmtree(trial_dir)
+    slice_dir = trial_dir / "Slice Images"
+    slice_dir.mkdir(parents=True)
+
+    def save_slice(i):
+        """Saves slice image i with i + 1 separate discs and returns its path."""
+        img_arr = np.zeros((200, 80 * (i + 2)), dtype=np.uint8)
+        for j in range(i + 1):
+            cv2.circle(img_arr, (40 + 80 * j, 100), 30, 255, -1)
+        img_fp = slice_dir / f"slice_{i}_0000.png"
+        Image.fromarray(img_arr).convert("RGB").save(img_fp)
+        return img_fp
+
+    class StubPredictor:
+        def __init__(self, predicted):
+            """Predicts slice images by thresholding them, without a model,
+            recording the name of each predicted slice in predicted.
+            """
+            self.predicted = predicted
+
+        def predict_slice(self, img_fp):
+            self.predicted.append(img_fp.name)
+            img_arr = np.array(Image.open(img_fp).convert("L"))
+            return (img_arr > 127).astype(np.uint8)[None], {}
+
+        def save_segmentation(self, seg, properties, seg_fp):
+            Image.fromarray(seg[0]).save(seg_fp)
+
+    class StubPipeline(TrialPipeline):
+        def __init__(self, trial_dir):
+            """TrialPipeline that saves synthetic slice images instead of
+            preparing WSIs, and predicts them with a StubPredictor.
+            """
+            super().__init__(trial_dir, count_workers=2, queue_size=1)
+            self.predicted, self.counted_names = [], []
+
+        def prepare(self):
+            for i in range(2, 4):
+                self.enqueue(save_slice(i))
+
+        def load_predictor(self):
+            return StubPredictor(self.predicted)
+
+        def counted(self, future, seg_fp, start_time):
+            self.counted_names.append(seg_fp.stem)
+            super().counted(future, seg_fp, start_time)
+
+    # Slices already there and prepared ones are each predicted and counted once
+    for i in range(2):
+        save_slice(i)
+    pipeline = StubPipeline(trial_dir)
+    pipeline.run()
+    names = [f"slice_{i}" for i in range(4)]
+    assert not pipeline.failed
+    assert sorted(pipeline.predicted) == [f"{name}_0000.png" for name in names]
+    assert sorted(pipeline.counted_names) == names
+    assert sorted(pipeline.all_crypt_data) == names
+    for i, name in enumerate(names):
+        assert len(pipeline.all_crypt_data[name]["contours"]) == i + 1
+    assert (trial_dir / "crypt_counts.xlsx").exists()
+    # With the count keys of the saved segmentations, so nothing is recounted
+    store = ContourStore(pipeline.seg_dir / "crypt_data.json")
+    for name in names:
+        assert store.key(name) == count_key(pipeline.seg_dir / f"{name}.png")
+
+
 def test_cryptcontour():
     from src.count.crypt_contour import get_all_separated_contours
 
@@ -115,6 +425,205 @@ def test_cryptcontour():
     get_all_separated_contours(seg_fp, img_fp, plot_all=True, output_dir=output_dir)
 
 
+def test_line_contour_intersects():
+    import random
+    import numpy as np
+    import cv2
+    from src.count.crypt_contour import CryptContour, line_contour_intersects
+    from src.image_segmentation.line_utils import (
+        dist,
+        point_line_dist,
+        line_segments_intersect,
+    )
+
+    logger.info("Running test: test_line_contour_intersects")
+
+    def loop_line_contour_intersects(p1, p2, contour):
+        """Reference implementation, looping over the contour points."""
+        contour_coords = contour[:, 0, :]
+        intersection_coords = []
+        for i in range(len(contour_coords) - 1):
+            c1, c2 = contour_coords[i], contour_coords[i + 1]
+            if line_segments_intersect(p1, p2, c1, c2):
+                if point_line_dist(*c1, p1, p2) <= point_line_dist(*c2, p1, p2):
+                    coord = c1
+                else:
+                    coord = c2
+                if intersection_coords and dist(intersection_coords[-1], coord) <= 2:
+                    continue
+                intersection_coords.append(coord)
+        return intersection_coords
+
+    random.seed(2)
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    n_lines = 0
+    for seg_fp in sorted(seg_dir.glob("*.png")):
+        seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+        contours, _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+        for contour in contours:
+            crypt_contour = CryptContour(contour)
+            if not crypt_contour.large_enough:
+                continue
+            coords = [tuple(c) for c in contour[:, 0, :]]
+            x, y, width, height = cv2.boundingRect(contour)
+            # Lines between defects, as when splitting
+            defects = crypt_contour.defects if crypt_contour.defects is not None else []
+            fars = [crypt_contour.defect_Coords(defect)[2] for defect in defects]
+            lines = [(far, other_far) for far in fars for other_far in fars]
+            # Lines between random contour points
+            lines += [tuple(random.sample(coords, 2)) for _ in range(20)]
+            # Horizontal and vertical lines through contour points (collinear cases)
+            for cx, cy in random.sample(coords, 10):
+                lines += [((x, int(cy)), (x + width, int(cy)))]
+                lines += [((int(cx), y), (int(cx), y + height))]
+            for p1, p2 in lines:
+                expected = loop_line_contour_intersects(p1, p2, contour)
+                result = line_contour_intersects(p1, p2, contour)
+                assert len(result) == len(expected), (seg_fp.name, p1, p2)
+                assert all(np.array_equal(r, e) for r, e in zip(result, expected))
+            n_lines += len(lines)
+    logger.info(f"Vectorized line contour intersects equivalent on {n_lines} lines.")
+
+
+def test_best_defect_pair():
+    import numpy as np
+    import cv2
+    from src.count.crypt_contour import (
+        CryptContour,
+        line_contour_intersects,
+        score_parralelity,
+    )
+    from src.image_segmentation.line_utils import dist
+
+    logger.info("Running test: test_best_defect_pair")
+
+    def loop_best_defect_pair(crypt_contour):
+        """Reference implementation, scoring every pair of defects in a loop."""
+        sep_coords = None
+        best_score = np.inf
+        for defect in crypt_contour.defects:
+            hull_int = crypt_contour.hull_Intersection(defect)
+            far = crypt_contour.defect_Coords(defect)[2]
+            for other_defect in crypt_contour.defects:
+                if np.array_equal(defect, other_defect):
+                    continue
+                other_hull_int = crypt_contour.hull_Intersection(other_defect)
+                other_far = crypt_contour.defect_Coords(other_defect)[2]
+                score = score_parralelity(hull_int, far, other_hull_int, other_far)
+                if dist(far, other_far) < 3:
+                    score = 0
+                elif len(line_contour_intersects(far, other_far, crypt_contour.contour)) > 2:
+                    score = np.inf
+                if score < best_score:
+                    best_score = score
+                    sep_coords = (far, other_far)
+        return sep_coords
+
+    def check_contours(contours, defect_threshold):
+        """Checks both implementations on every contour with at least 3
+        defects met while separating contours, and returns how many there were.
+        """
+        n_checked = 0
+        crypt_contours = [
+            CryptContour(c, defect_threshold, min_crypt_size=0, split_budget=np.inf)
+            for c in contours
+        ]
+        for crypt_contour in crypt_contours:
+            defects = crypt_contour.defects
+            if defects is not None and len(defects) >= 3:
+                result = crypt_contour.best_defect_pair()
+                expected = loop_best_defect_pair(crypt_contour)
+                if expected is None:
+                    assert result is None
+                else:
+                    assert result is not None
+                    assert all(np.array_equal(r, e) for r, e in zip(result, expected))
+                n_checked += 1
+            crypt_contours.extend(crypt_contour.split_crypt_contours() or [])
+        return n_checked
+
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    n_checked = 0
+    for seg_fp in sorted(seg_dir.glob("*.png")):
+        seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+        contours, _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+        for defect_threshold in [2, 5, 10]:
+            n_checked += check_contours(contours, defect_threshold)
+    # Symmetric blobs, whose pairs of defects tie: a cross, a square with a
+    # notch in the middle of each side and a square of 4 identical circles
+    synthetic = np.zeros((3, 300, 300), dtype=np.uint8)
+    synthetic[0, 120:180, 40:260] = synthetic[0, 40:260, 120:180] = 1
+    synthetic[1, 50:250, 50:250] = 1
+    for x, y in [(150, 50), (150, 240), (50, 150), (240, 150)]:
+        synthetic[1, y : y + 10, x - 5 : x + 5] = 0
+    for x, y in [(110, 110), (190, 110), (110, 190), (190, 190)]:
+        cv2.circle(synthetic[2], (x, y), 45, 1, -1)
+    for seg_arr in synthetic:
+        contours, _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        n_checked_synthetic = check_contours(contours, 2)
+        assert n_checked_synthetic >= 1
+        n_checked += n_checked_synthetic
+    logger.info(f"Best defect pair equivalent on {n_checked} contours with 3+ defects.")
+
+
+def test_split_contour():
+    import random
+    import numpy as np
+    import cv2
+    from src.count.crypt_contour import split_contour
+
+    logger.info("Running test: test_split_contour")
+
+    def origin_split_contour(contour, separation_coords):
+        """Reference implementation, slicing the raw halves out of the contour
+        at the separation coords and rasterizing them from the image origin.
+        """
+        (x1, y1), (x2, y2) = separation_coords
+        idx1 = np.where((contour[:, 0, 0] == x1) & (contour[:, 0, 1] == y1))[0][0]
+        idx2 = np.where((contour[:, 0, 0] == x2) & (contour[:, 0, 1] == y2))[0][0]
+        idx1, idx2 = min(idx1, idx2), max(idx1, idx2)
+        halves = [
+            contour[idx1 : idx2 + 1],
+            np.concatenate((contour[idx2:], contour[: idx1 + 1])),
+        ]
+        contours = []
+        for half in halves:
+            x, y, width, height = cv2.boundingRect(half)
+            arr = np.zeros(shape=(y + height, x + width), dtype=np.uint8)
+            arr = cv2.drawContours(arr, [half], -1, 1, cv2.FILLED)
+            contours.append(
+                cv2.findContours(arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0][0]
+            )
+        return contours
+
+    random.seed(3)
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    shift = np.array([20000, 20000], dtype=np.int32)
+    n_splits = 0
+    for seg_fp in sorted(seg_dir.glob("*.png")):
+        seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+        contours, _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+        for contour in contours:
+            coords = [tuple(c) for c in contour[:, 0, :]]
+            for _ in range(5):
+                sep_coords = random.sample(coords, 2)
+                result = split_contour(contour, sep_coords)
+                expected = origin_split_contour(contour, sep_coords)
+                assert len(result) == len(expected) == 2
+                assert all(np.array_equal(r, e) for r, e in zip(result, expected))
+                # Splitting far from the origin gives the same, shifted, contours
+                shifted = split_contour(contour + shift, [c + shift for c in sep_coords])
+                assert all(np.array_equal(s - shift, r) for s, r in zip(shifted, result))
+                n_splits += 1
+    logger.info(f"Bbox-local split contour equivalent on {n_splits} splits.")
+
+
 def test_cryptcount():
     from src.count.crypt_count import process_segmentations, crypt_data_to_excel
 
@@ -132,7 +641,466 @@ def test_cryptcount():
     # Count crypts
     process_segmentations(seg_dir)
     # Save to excel
-    crypt_data_to_excel(Path(seg_dir, "crypt_data.pkl"), seg_dir)
+    crypt_data_to_excel(Path(seg_dir, "crypt_data.json"), seg_dir)
+
+
+def test_count_segmentations():
+    import numpy as np
+    from src.count.crypt_count import count_segmentations
+
+    logger.info("Running test: test_count_segmentations")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    seg_fps = list(seg_dir.glob("*.png"))
+    serial = count_segmentations(seg_fps, workers=1)
+    parallel = count_segmentations(seg_fps, workers=2, chunk_size=2)
+    # Same natsorted order and same contours
+    assert list(serial) == list(parallel)
+    for fn in serial:
+        contours, parallel_contours = (
+            serial[fn]["contours"],
+            parallel[fn]["contours"],
+        )
+        assert len(contours) == len(parallel_contours), fn
+        assert all(np.array_equal(c, p) for c, p in zip(contours, parallel_contours))
+
+
+def test_count_cache():
+    from src.count.crypt_count import process_segmentations
+    from src.count.contour_store import ContourStore
+
+    logger.info("Running test: test_count_cache")
+    seg_input_dir = Path(
+        TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations/"
+    )
+    seg_dir = Path(TEST_DATA_DIRPATH, "output/count_cache/Slice Segmentations/")
+    if seg_dir.exists():
+        shutil.rmtree(seg_dir)
+    shutil.copytree(seg_input_dir, seg_dir)
+    # Count everything, then recount with all segmentations cached
+    process_segmentations(seg_dir, cache=True)
+    store = ContourStore(seg_dir / "crypt_data.json")
+    counted = dict(store.items())
+    keys = {fn: store.key(fn) for fn in store}
+    assert all(keys.values())
+    process_segmentations(seg_dir, cache=True)
+    cached = dict(ContourStore(seg_dir / "crypt_data.json").items())
+    assert list(cached) == list(counted)
+    assert all(len(cached[fn]["contours"]) == len(counted[fn]["contours"]) for fn in counted)
+    # A changed segmentation gets a new key
+    seg_fp = sorted(seg_dir.glob("*.png"))[0]
+    Image.new("L", (10, 10)).save(seg_fp)
+    process_segmentations(seg_dir, cache=True)
+    store = ContourStore(seg_dir / "crypt_data.json")
+    assert store.key(seg_fp.stem) != keys[seg_fp.stem]
+    assert store[seg_fp.stem]["contours"] == []
+
+
+def test_contour_store():
+    import pickle
+    import numpy as np
+    from src.count.crypt_count import count_segmentations
+    from src.count.contour_store import ContourStore, convert_pkl_to_store, save_contour_store
+
+    logger.info("Running test: test_contour_store")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/contour_store")
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True)
+    all_crypt_data = count_segmentations(seg_dir.glob("*.png"), workers=1)
+    all_crypt_data["error_slice"] = "Example error"
+    # Convert a legacy crypt_data.pkl and load each slice back
+    crypt_data_fp = output_dir / "crypt_data.pkl"
+    with open(crypt_data_fp, "wb") as file:
+        pickle.dump(all_crypt_data, file, protocol=-1)
+    store = ContourStore(convert_pkl_to_store(crypt_data_fp))
+    assert list(store) == list(all_crypt_data)
+    for fn, expected in all_crypt_data.items():
+        if type(expected) == str:
+            assert store[fn] == expected
+            continue
+        loaded = store[fn]
+        assert loaded["shape"] == expected["shape"]
+        assert loaded["size_total"] == expected["size_total"]
+        assert len(loaded["contours"]) == len(expected["contours"])
+        for contour, expected_contour in zip(loaded["contours"], expected["contours"]):
+            assert contour.dtype == np.int32 and contour.shape == expected_contour.shape
+            assert np.array_equal(contour, expected_contour)
+        # Simplified display contours, with fewer points than the exact ones
+        assert set(loaded["lod_contours"]) == set(expected["lod_contours"])
+        for tolerance, lod_contours in expected["lod_contours"].items():
+            loaded_lod_contours = loaded["lod_contours"][tolerance]
+            assert all(np.array_equal(c, e) for c, e in zip(loaded_lod_contours, lod_contours))
+            assert all(len(c) <= len(e) for c, e in zip(lod_contours, expected["contours"]))
+    # Saving again swaps in new points and offsets via the index, leaving one
+    # pair, while a store opened before still reads its own
+    fn = next(fn for fn, data in all_crypt_data.items() if type(data) != str and data["contours"])
+    old_contours = store[fn]["contours"]
+    all_crypt_data[fn] = dict(all_crypt_data[fn], contours=all_crypt_data[fn]["contours"][:1])
+    save_contour_store(all_crypt_data, store.index_fp)
+    new_store = ContourStore(store.index_fp)
+    assert len(new_store[fn]["contours"]) == 1
+    assert new_store.points_fp != store.points_fp
+    assert sorted(output_dir.glob("*.npy")) == sorted([new_store.points_fp, new_store.offsets_fp])
+    assert all(np.array_equal(a, b) for a, b in zip(store[fn]["contours"], old_contours))
+    assert len(store[fn]["contours"]) == len(old_contours) > 1
+
+
+def test_sweep():
+    import numpy as np
+    import cv2
+    from src.count.sweep import sweep_parameters
+    from src.count.crypt_contour import CryptContour
+
+    logger.info("Running test: test_sweep")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    min_crypt_sizes, defect_thresholds = (500, 2000, 4000), (2, 10, 30)
+    table = sweep_parameters(seg_dir, min_crypt_sizes, defect_thresholds)
+    # Same counts as separating the contours with each parameter pair
+    for seg_fp in sorted(seg_dir.glob("*.png")):
+        seg_arr = np.array(Image.open(seg_fp).convert("L"), dtype=np.uint8)
+        contours, _ = cv2.findContours(
+            seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
+        )
+        for min_crypt_size in min_crypt_sizes:
+            for defect_threshold in defect_thresholds:
+                count = sum(
+                    len(CryptContour(c, defect_threshold, min_crypt_size).separated_contours)
+                    for c in contours
+                )
+                assert table.loc[seg_fp.stem, (min_crypt_size, defect_threshold)] == count
+
+
+def test_split_engines():
+    import time
+    import numpy as np
+    import cv2
+    from src.count.crypt_count import get_crypt_data
+    from src.count.split_engines import (
+        SPLIT_ENGINES,
+        compare_split_engines,
+        watershed_separated_contours,
+    )
+
+    logger.info("Running test: test_split_engines")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    counts = compare_split_engines(seg_dir)
+    assert set(counts) == set(SPLIT_ENGINES)
+    # Each engine can be used to count
+    seg_fp = sorted(seg_dir.glob("*.png"))[0]
+    for engine in SPLIT_ENGINES:
+        crypt_data = get_crypt_data(seg_fp, split_engine=engine)
+        assert len(crypt_data["contours"]) == counts[engine][seg_fp.stem]
+    # A row of crypts joined by shallow peaks whose basins are all too small,
+    # which are dropped together rather than with one watershed each
+    n_crypts = 40
+    seg_arr = np.zeros((160, 130 * n_crypts + 40), dtype=np.uint8)
+    for i in range(n_crypts):
+        cv2.circle(seg_arr, (80 + 130 * i, 80), 50, 255, -1)
+        if i < n_crypts - 1:
+            cv2.circle(seg_arr, (145 + 130 * i, 80), 32, 255, -1)
+    (contour,), _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    trace = {}
+    start_time = time.time()
+    separated_contours = watershed_separated_contours(contour, min_crypt_size=4000, trace=trace)
+    assert time.time() - start_time < 5
+    assert len(separated_contours) == n_crypts
+    assert trace["markers"] == 2 * n_crypts - 1 and trace["watersheds"] == 2
+
+
+def test_split_budget():
+    import numpy as np
+    import cv2
+    from src.count.crypt_contour import CryptContour
+    from src.count.crypt_count import get_crypt_data, log_slowest_contours
+
+    logger.info("Running test: test_split_budget")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    all_crypt_data = {}
+    for seg_fp in sorted(seg_dir.glob("*.png")):
+        crypt_data = all_crypt_data[seg_fp.stem] = get_crypt_data(seg_fp)
+        times = [trace["time"] for trace in crypt_data["split_traces"]]
+        assert times == sorted(times, reverse=True)
+        # Crypts from the example segmentations are within the split budget
+        assert not any(trace["over_budget"] for trace in crypt_data["split_traces"])
+    log_slowest_contours(all_crypt_data)
+    # A cluster of touching crypts with many defects
+    seg_arr = np.zeros((1400, 1400), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    for x, y, radius in zip(*rng.integers(100, 1300, (2, 300)), rng.integers(25, 45, 300)):
+        cv2.circle(seg_arr, (int(x), int(y)), int(radius), 255, -1)
+    contours, _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    contour = max(contours, key=len)
+    unlimited = CryptContour(contour, split_budget=np.inf)
+    unlimited_contours = unlimited.separated_contours
+    trace = unlimited.split_trace
+    assert trace["points"] == len(contour) and trace["defects"] >= 3
+    assert trace["splits"] == len(unlimited_contours) - 1 and trace["depth"] >= 1
+    assert trace["over_budget"] == 0
+    # Within the budget, the same split; over it, only the 2 deepest defects are paired
+    within = CryptContour(contour, split_budget=len(contour) * trace["defects"] ** 2)
+    assert len(within.separated_contours) == len(unlimited_contours)
+    assert within.split_trace["over_budget"] == 0
+    over = CryptContour(contour, split_budget=1)
+    over.separated_contours
+    assert over.split_trace["over_budget"] >= 1
+
+
+def test_contour_features():
+    import numpy as np
+    import cv2
+    from src.count.crypt_contour import ContourFeatures, CryptContour
+
+    logger.info("Running test: test_contour_features")
+    # Two heavily overlapping crypts, solid but with a waist deeper than the threshold
+    seg_arr = np.zeros((400, 600), dtype=np.uint8)
+    cv2.circle(seg_arr, (200, 200), 150, 255, -1)
+    cv2.circle(seg_arr, (320, 200), 150, 255, -1)
+    contours, _ = cv2.findContours(seg_arr, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    crypt_contour = CryptContour(contours[0], defect_thresh=10)
+    assert crypt_contour.features.solidity > 0.98
+    assert len(crypt_contour.separated_contours) == 2
+
+    class CountWarnings(logging.Handler):
+        def __init__(self):
+            """Counts the logged warnings."""
+            super().__init__(logging.WARNING)
+            self.count = 0
+
+        def emit(self, record):
+            self.count += 1
+
+    # Defects of a self-intersecting contour are only searched for (and the error
+    # logged) once
+    contour = np.array(
+        [[42, 31], [25, 13], [15, 2], [3, 0], [8, 40], [32, 45], [25, 30], [48, 36]]
+        + [[31, 27], [27, 46], [13, 40], [33, 0]],
+        dtype=np.int32,
+    )[:, None]
+    features = ContourFeatures(contour)
+    handler = CountWarnings()
+    contour_logger = logging.getLogger("src.count.crypt_contour")
+    contour_logger.addHandler(handler)
+    try:
+        assert features.all_defects is None and features.all_defects is None
+        assert features.defects(10) is None
+    finally:
+        contour_logger.removeHandler(handler)
+    assert handler.count == 1
+    assert not features.defects_found
+
+
+def test_strip_extraction():
+    import numpy as np
+    import cv2
+    from PIL import Image
+    from src.count.mask_rle import read_contours
+
+    logger.info("Running test: test_strip_extraction")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/strip_extraction")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    seg_arr = np.array(Image.open(sorted(seg_dir.glob("*.png"))[0]).convert("L"))
+    # Add a crypt in the hole of another, which is not an external contour
+    seg_arr[:100, :100] = 255
+    seg_arr[10:90, 10:90] = 0
+    seg_arr[40:60, 40:60] = 255
+    for mode in ["L", "1", "P", "RGB"]:
+        seg_fp = output_dir / f"seg_{mode}.png"
+        Image.fromarray(seg_arr).convert(mode).save(seg_fp)
+        shape, contours = read_contours(seg_fp, min_area=np.inf)
+        # Bands of 1 row and of a height that does not divide the segmentation's
+        for band_height in [1, 100]:
+            strip_shape, strip_contours = read_contours(seg_fp, band_height, min_area=0)
+            assert strip_shape == shape
+            assert len(strip_contours) == len(contours)
+            assert all(np.array_equal(a, b) for a, b in zip(strip_contours, contours))
+    # 16 bit colour cannot be decoded in bands, so is decoded whole
+    seg_fp = output_dir / "seg_RGB16.png"
+    cv2.imwrite(str(seg_fp), np.repeat(seg_arr[:, :, None].astype(np.uint16) * 257, 3, axis=2))
+    shape, contours = read_contours(seg_fp, min_area=0)
+    assert shape == seg_arr.shape and len(contours) == len(strip_contours)
+    # But a truncated file is an error
+    seg_fp = output_dir / "seg_truncated.png"
+    data = (output_dir / "seg_L.png").read_bytes()
+    seg_fp.write_bytes(data[: len(data) // 2])
+    try:
+        read_contours(seg_fp, min_area=0)
+    except ValueError as e:
+        assert "truncated" in str(e)
+    else:
+        assert False, "Truncated segmentation was read."
+
+
+def test_mask_rle():
+    import os
+    import numpy as np
+    from src.count.contour_store import ContourStore
+    from src.count.crypt_count import get_crypt_data, process_segmentations
+    from src.count.mask_rle import (
+        RLEMask,
+        convert_segmentations,
+        read_contours,
+        read_segmentation,
+        segmentation_fps,
+    )
+
+    logger.info("Running test: test_mask_rle")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/mask_rle/Slice Segmentations")
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    shutil.copytree(seg_dir, output_dir)
+    rle_fps = convert_segmentations(output_dir)
+    assert segmentation_fps(output_dir) == rle_fps
+    for rle_fp in rle_fps:
+        png_fp = rle_fp.with_suffix(".png")
+        seg_arr = read_segmentation(png_fp)
+        rle_mask = RLEMask(rle_fp)
+        assert np.array_equal(rle_mask.decode(), seg_arr)
+        # Regions, including ones past the edges of runs and of the mask
+        for y0, y1, x0, x1 in [(0, 1, 0, 1), (100, 612, 200, 712), (0, 50, 0, seg_arr.shape[1])]:
+            assert np.array_equal(rle_mask.decode(y0, y1, x0, x1), seg_arr[y0:y1, x0:x1])
+        # Contours straight from the mask, whole and in strips
+        shape, contours = read_contours(png_fp, min_area=np.inf)
+        for min_area in [np.inf, 0]:
+            rle_shape, rle_contours = read_contours(rle_fp, 100, min_area)
+            assert rle_shape == shape and len(rle_contours) == len(contours)
+            assert all(np.array_equal(a, b) for a, b in zip(rle_contours, contours))
+    # A .png file predicted again after it was converted is newer than its mask,
+    # so it is the one counted (and not served from the count cache) until it
+    # is converted again
+    process_segmentations(output_dir, workers=1)
+    rle_fp = rle_fps[0]
+    png_fp = rle_fp.with_suffix(".png")
+    seg_arr = read_segmentation(png_fp)
+    seg_arr[:, : seg_arr.shape[1] // 2] = 0
+    Image.fromarray(seg_arr).save(png_fp)
+    rle_ns = rle_fp.stat().st_mtime_ns
+    os.utime(png_fp, ns=(rle_ns + 10**9, rle_ns + 10**9))
+    assert png_fp in segmentation_fps(output_dir)
+    process_segmentations(output_dir, workers=1)
+    counted = ContourStore(output_dir / "crypt_data.json")[png_fp.stem]
+    assert len(counted["contours"]) == len(get_crypt_data(seg_arr)["contours"])
+    assert convert_segmentations(output_dir)[0] == rle_fp
+    assert np.array_equal(RLEMask(rle_fp).decode(), seg_arr)
+    assert segmentation_fps(output_dir) == rle_fps
+    # Once the .png files are deleted, the masks are used in their place
+    convert_segmentations(output_dir, delete=True)
+    assert not list(output_dir.glob("*.png"))
+    assert segmentation_fps(output_dir) == rle_fps
+
+
+def test_morphometrics():
+    import cv2
+    import numpy as np
+    from src.count.crypt_count import process_segmentations
+    from src.count.contour_store import ContourStore
+    from src.count.morphometrics import load_morphometrics, store_morphometrics
+
+    logger.info("Running test: test_morphometrics")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/morphometrics/Slice Segmentations")
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    shutil.copytree(seg_dir, output_dir)
+    # Counted, and then reused from the count cache
+    for _ in range(2):
+        process_segmentations(output_dir, workers=1)
+        table = load_morphometrics(output_dir / "crypt_morphometrics.npz")
+        store = ContourStore(output_dir / "crypt_data.json")
+        assert len(table) == sum(len(crypt_data["contours"]) for _, crypt_data in store.items())
+        for fn, crypt_data in store.items():
+            rows = table[table["slice"] == fn]
+            assert list(rows["crypt"]) == list(range(len(crypt_data["contours"])))
+            for contour, (_, row) in zip(crypt_data["contours"], rows.iterrows()):
+                moments = cv2.moments(contour)
+                assert np.isclose(row["area"], cv2.contourArea(contour))
+                assert np.isclose(row["perimeter"], cv2.arcLength(contour, True))
+                assert np.isclose(row["centroid_x"], moments["m10"] / moments["m00"])
+                assert np.isclose(row["centroid_y"], moments["m01"] / moments["m00"])
+                assert tuple(row[["bbox_x", "bbox_y", "bbox_width", "bbox_height"]]) == cv2.boundingRect(contour)
+                assert 0 <= row["eccentricity"] < 1 and 0 < row["solidity"] <= 1
+    # The same table from the contour store of a counted folder
+    stored_table = load_morphometrics(store_morphometrics(output_dir))
+    assert np.allclose(stored_table.iloc[:, 1:], table.iloc[:, 1:])
+
+
+def test_spatial():
+    import numpy as np
+    import pandas as pd
+    from src.count.crypt_count import process_segmentations
+    from src.count.morphometrics import load_morphometrics
+    from src.count.spatial import (
+        slice_spatial_analytics,
+        spatial_analytics_to_excel,
+        DENSITY_UNIT,
+    )
+
+    logger.info("Running test: test_spatial")
+    seg_dir = Path(TEST_DATA_DIRPATH, "input/example_segmentations/Slice Segmentations")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/spatial/Slice Segmentations")
+    if output_dir.exists():
+        shutil.rmtree(output_dir.parent)
+    shutil.copytree(seg_dir, output_dir)
+    process_segmentations(output_dir, workers=1)
+    spatial_analytics_to_excel(output_dir, output_dir.parent)
+    # Compare with the pairwise distances of the centroids
+    table = load_morphometrics(output_dir / "crypt_morphometrics.npz")
+    spatial = np.load(output_dir / "crypt_spatial.npz")
+    for i, fn in enumerate(spatial["slices"]):
+        centroids = table[table["slice"] == fn][["centroid_x", "centroid_y"]].to_numpy()
+        distances = np.linalg.norm(centroids[:, None] - centroids[None], axis=2)
+        np.fill_diagonal(distances, np.inf)
+        rows = spatial["slice"] == i
+        assert np.allclose(spatial["nn_distance"][rows], distances.min(axis=1))
+        neighbours = (distances <= 500).sum(axis=1)
+        assert np.allclose(spatial["local_density"][rows], DENSITY_UNIT * neighbours / (np.pi * 500**2))
+    excel = pd.read_excel(output_dir.parent / "crypt_counts.xlsx", sheet_name="Spatial (Automated)")
+    assert list(excel["Filename"]) == list(spatial["slices"])
+    # Crypts on a regular lattice are evenly spaced (Clark-Evans index > 1)
+    lattice = np.stack(np.meshgrid(np.arange(10) * 100, np.arange(10) * 100), axis=-1).reshape(-1, 2)
+    analytics = slice_spatial_analytics(lattice, (1000, 1000), k=2, radius=150, grid_size=500)
+    assert np.allclose(analytics["knn_distances"], 100)
+    assert analytics["summary"]["Clark-Evans Index"] > 1
+    assert analytics["density_map"].shape == (2, 2)
+
+
+def test_excel():
+    import pandas as pd
+    from src.count.excel import Excel
+
+    logger.info("Running test: test_excel")
+    output_dir = Path(TEST_DATA_DIRPATH, "output/excel")
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    table = pd.DataFrame(
+        {
+            "Filename": [f"slice_{i}" for i in range(20)],
+            "Model Count": [i if i % 7 else "ERROR: Example error" for i in range(20)],
+            "Size Average": [float("nan") if i % 5 == 0 else i / 3 for i in range(20)],
+        }
+    )
+    # The whole sheet at once, in a new file and in an existing one, is the
+    # same as appending it a row at a time
+    for new_file in [True, False]:
+        bulk_dir = output_dir / f"bulk_{new_file}"
+        rows_dir = output_dir / f"rows_{new_file}"
+        bulk_dir.mkdir(parents=True)
+        rows_dir.mkdir(parents=True)
+        if not new_file:
+            Excel(bulk_dir, "Counter").append(table.iloc[0].to_dict())
+            Excel(rows_dir, "Counter").append(table.iloc[0].to_dict())
+        Excel(bulk_dir, "Pre-Load (Automated)", table)
+        excel = Excel(rows_dir, "Pre-Load (Automated)")
+        for data in table.to_dict("records"):
+            excel.append(data)
+        bulk = pd.read_excel(bulk_dir / "crypt_counts.xlsx", sheet_name=None)
+        rows = pd.read_excel(rows_dir / "crypt_counts.xlsx", sheet_name=None)
+        assert list(bulk) == list(rows)
+        pd.testing.assert_frame_equal(bulk["Pre-Load (Automated)"], rows["Pre-Load (Automated)"])
+        assert list(bulk["Pre-Load (Automated)"]["Filename"]) == list(table["Filename"])
+        assert bulk["version"].iloc[:, 0].tolist() == rows["version"].iloc[:, 0].tolist()
 
 
 def test_cryptgui():
@@ -184,8 +1152,28 @@ def run_all_tests():
     test_wsi()
     test_prepare()
     test_predict()
+    test_run_command()
+    test_calibrate()
+    test_predictor()
+    test_preprocessing_cache()
+    test_pipeline()
     test_cryptcontour()
+    test_line_contour_intersects()
+    test_best_defect_pair()
+    test_split_contour()
     test_cryptcount()
+    test_count_segmentations()
+    test_count_cache()
+    test_contour_store()
+    test_sweep()
+    test_split_engines()
+    test_split_budget()
+    test_contour_features()
+    test_strip_extraction()
+    test_mask_rle()
+    test_morphometrics()
+    test_spatial()
+    test_excel()
     test_cryptgui()
     test_controlgui()
     summarize_warnings()